@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import argparse as ap
+import datetime
+import json
+import multiprocessing as mp
+import numpy as np
+import os
+import platform
+import time
+import traceback
+
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "imageservice"))
+import encoders
+import serveupimage
+import stages
+
+import config as conf
+
+"""
+encoding.py benchmarks the image encoders (see imageservice/encoders.py)
+on a texture as it is posted: the tiled data and its shadows side by
+side, 4096 x 2048 with the default profile. It reports the encode time,
+decode time and size of each format. The texture is made from a
+synthetic cube, or read from an .npy file saved from a real run.
+
+    ./benchmarks/encoding.py --profile default --output encoders.json
+
+"""
+
+ALL_ENCODERS = ["png", "raw_zlib", "raw_zstd", "raw_lz4", "webp"]
+
+
+def makeEncoder(name, profile):
+    """
+    An encoder by benchmark name, with the profile's settings.
+
+    """
+    if name.startswith("raw_"):
+        return encoders.RawEncoder(name[4:], profile.raw_level)
+    return encoders.makeEncoder(ap.Namespace(**dict(vars(profile), encoder=name)))
+
+
+def makeTexture(profile, nlev, shadow_engine):
+    """
+    Makes the texture posted for a synthetic cube at the profile's
+    regrid shape, see serveupimage.cubeToImage.
+
+    """
+    cube = stages.makeCube(profile.regrid_shape[0], profile.regrid_shape[1], nlev)
+    rg = serveupimage.regridTimeSlice(cube, profile.extent, profile.regrid_shape)
+    return serveupimage.cubeToImage(rg, profile.field_width, profile.field_height,
+                                    shadow_engine=shadow_engine)
+
+
+def benchEncoder(name, profile, img, repeat):
+    """
+    Times encoding and decoding an image, and checks the decoded image
+    is the same.
+
+    """
+    result = {"encoder": name, "shape": list(img.shape)}
+    try:
+        encoder = makeEncoder(name, profile)
+        encode_times, decode_times = [], []
+        for _ in range(repeat):
+            start = time.time()
+            data = encoder.encode(img)
+            encode_times.append(time.time() - start)
+            start = time.time()
+            decoded = encoder.decode(data)
+            decode_times.append(time.time() - start)
+        if not np.array_equal(decoded, img):
+            raise ValueError("Decoded image differs from the original")
+    except Exception:
+        result["error"] = traceback.format_exc()
+        return result
+
+    result.update({"mime_type": encoder.mime_type,
+                   "encode_seconds": min(encode_times),
+                   "decode_seconds": min(decode_times),
+                   "bytes": len(data),
+                   "ratio": img.nbytes / float(len(data))})
+    return result
+
+
+def parseArgs():
+    argparser = ap.ArgumentParser()
+    argparser.add_argument("-a", "--profile", default="default",
+        type=str, help="Name of analysis profile settings, as defined in config.py")
+    argparser.add_argument("-l", "--levels", default=59,
+        type=int, help="Number of model levels in the synthetic input")
+    argparser.add_argument("-i", "--input", default=None,
+        type=str, help=".npy file of a texture to use instead of a synthetic one")
+    argparser.add_argument("-e", "--shadow_engine", default="cpu",
+        type=str, help="Shadow engine used to make the synthetic texture")
+    argparser.add_argument("--encoders", default=ALL_ENCODERS, nargs="+",
+        choices=ALL_ENCODERS, help="Encoders to benchmark")
+    argparser.add_argument("-r", "--repeat", default=3,
+        type=int, help="Runs of each encoder, the fastest is reported")
+    argparser.add_argument("-o", "--output", default=None,
+        type=str, help="JSON file to write the results to")
+    return argparser.parse_args()
+
+
+if __name__ == "__main__":
+    call_args = parseArgs()
+    profile = ap.Namespace(**conf.profiles[call_args.profile])
+
+    if call_args.input is not None:
+        img = np.load(call_args.input)
+    else:
+        img = makeTexture(profile, call_args.levels, call_args.shadow_engine)
+
+    results = []
+    for name in call_args.encoders:
+        result = benchEncoder(name, profile, img, call_args.repeat)
+        results.append(result)
+        print(json.dumps(result))
+
+    report = {"profile": call_args.profile,
+              "date": datetime.datetime.utcnow().isoformat(),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "host": platform.node(),
+              "cpus": mp.cpu_count(),
+              "results": results}
+    if call_args.output is not None:
+        with open(call_args.output, "w") as f:
+            json.dump(report, f, indent=2)
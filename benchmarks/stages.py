@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import argparse as ap
+import datetime
+import io
+import json
+import multiprocessing as mp
+import numpy as np
+import os
+import platform
+import resource
+import threading
+import time
+import traceback
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import iris
+import iris.coords
+import iris.coord_systems
+import iris.cube
+
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "imageservice"))
+import dataproc
+import imageproc
+import networking
+import serveupimage
+import shadowproc
+
+import config as conf
+
+"""
+stages.py benchmarks each stage of the image service on its own, using
+synthetic cubes at the sizes in config.profiles (and scaled up variants).
+Every stage runs in a forked process, so that its peak memory can be
+measured separately. Results are written as JSON, to compare between
+releases.
+
+    ./benchmarks/stages.py --profile default --scale 1 2 --output bench.json
+
+"""
+
+ALL_STAGES = ["sanitizeAlt", "restratifyAltLevels", "restratifyAltLevels_lean", "horizRegrid",
+              "horizRegrid_cached", "trimOutsideDomain", "regridData_cached", "regridData_chunked",
+              "procDataCube", "procDataCube_lean",
+              "tileArray", "shadows_cpu", "shadows_cpu_noskip", "shadows_gl", "shadows_gl_noskip",
+              "writePng", "post"]
+
+
+def makeCube(nx, ny, nlev, seed=0):
+    """
+    Makes a synthetic UKV-like cloud fraction cube on a rotated pole
+    grid, with a hybrid height altitude coord, in x, y, z order as
+    returned by serveupimage.loadCube.
+
+    """
+    rs = np.random.RandomState(seed)
+    cs = iris.coord_systems.RotatedGeogCS(37.5, 177.5,
+                                          ellipsoid=iris.coord_systems.GeogCS(6371229.0))
+    x = iris.coords.DimCoord(np.linspace(-11.0, 9.0, nx), standard_name="grid_longitude",
+                             units="degrees", coord_system=cs)
+    y = iris.coords.DimCoord(np.linspace(-6.0, 9.0, ny), standard_name="grid_latitude",
+                             units="degrees", coord_system=cs)
+    z = iris.coords.DimCoord(np.arange(1, nlev + 1), standard_name="model_level_number", units="1")
+
+    eta = np.linspace(0, 1, nlev + 1)[1:]
+    level_height = iris.coords.AuxCoord(40000 * eta**2 + 5, long_name="level_height", units="m")
+    sigma = iris.coords.AuxCoord(np.clip(1 - eta / 0.5, 0, 1)**2, long_name="sigma", units="1")
+
+    # sparse, smoothly varying cloud
+    cloud = rs.rand(nx, ny, nlev).astype(np.float32)
+    cloud[cloud < 0.7] = 0
+    cube = iris.cube.Cube(cloud, standard_name="cloud_area_fraction_in_atmosphere_layer", units="1",
+                          dim_coords_and_dims=[(x, 0), (y, 1), (z, 2)])
+    cube.add_aux_coord(level_height, 2)
+    cube.add_aux_coord(sigma, 2)
+    tunit = "hours since 1970-01-01 00:00:00"
+    cube.add_aux_coord(iris.coords.AuxCoord(394200, standard_name="forecast_reference_time", units=tunit))
+    cube.add_aux_coord(iris.coords.AuxCoord(394203, standard_name="time", units=tunit))
+
+    xx, yy = np.meshgrid(x.points, y.points, indexing="ij")
+    orog = iris.cube.Cube(np.clip(1000 * np.sin(xx / 3.0) * np.cos(yy / 2.0), 0, None),
+                          standard_name="surface_altitude", units="m",
+                          dim_coords_and_dims=[(x.copy(), 0), (y.copy(), 1)])
+
+    return serveupimage.addAltitude(cube, orog)
+
+
+class _DataService(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _measure(func, args, conn):
+    try:
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kB on linux
+        conn.send({"seconds": elapsed, "peak_rss_mb": (peak_rss - start_rss) / 1024.0})
+    except Exception:
+        conn.send({"error": traceback.format_exc()})
+    finally:
+        conn.close()
+
+
+def measure(func, *args):
+    """
+    Runs func(*args) in a forked process and returns its run time and
+    the growth in peak resident memory while it ran.
+
+    """
+    parent, child = mp.Pipe()
+    proc = mp.Process(target=_measure, args=(func, args, child))
+    proc.start()
+    result = parent.recv()
+    proc.join()
+    return result
+
+
+def benchStages(profile, scale, nlev, stages, repeat, post_url):
+    """
+    Benchmarks each stage for a profile, with the horizontal
+    regrid shape multiplied by scale.
+
+    """
+    regrid_shape = [int(profile.regrid_shape[0] * scale),
+                    int(profile.regrid_shape[1] * scale),
+                    profile.regrid_shape[2]]
+    nlat, nlon = regrid_shape[1], regrid_shape[0]
+
+    # make the input to every stage up front, with the in memory path
+    cube = makeCube(regrid_shape[0], regrid_shape[1], nlev)
+    san = dataproc.sanitizeAlt(cube.copy())
+    rs = dataproc.restratifyAltLevels(san, regrid_shape[2])
+    rg = dataproc.horizRegrid(rs, nlat, nlon, profile.extent)
+    weights = dataproc.calcRegridWeights(rs, nlat, nlon, profile.extent)
+    rg = rg[:, :, :-1]
+    trimmed = dataproc.trimOutsideDomain(rg)
+    proced = dataproc.procDataCube(trimmed.copy())
+    field_size = max(profile.field_width, imageproc.planTexture(proced.shape, [3])["width"])
+    tiled = imageproc.tileArray(proced.data, field_size, field_size)
+    data_shape = imageproc.textureLayout(proced.shape, field_size, field_size)["dataShape"]
+    img = np.concatenate([tiled, tiled], 1)
+    png = networking.encodeImage(img, field_size, field_size)
+    payload = {"forecast_time": "2015-01-01T03:00:00.000Z", "mime_type": "image/png"}
+
+    funcs = {"sanitizeAlt": (dataproc.sanitizeAlt, cube),
+             "restratifyAltLevels": (dataproc.restratifyAltLevels, san, regrid_shape[2]),
+             "restratifyAltLevels_lean": (lambda c: dataproc.restratifyAltLevels(c, regrid_shape[2],
+                                                                                 dtype=np.float32), san),
+             "horizRegrid": (dataproc.horizRegrid, rs, nlat, nlon, profile.extent),
+             "horizRegrid_cached": (dataproc.applyRegridWeights, rs, weights, nlat, nlon, profile.extent),
+             "trimOutsideDomain": (dataproc.trimOutsideDomain, rg),
+             "regridData_cached": (lambda c: dataproc.regridData(c, regrid_shape, profile.extent,
+                                                                 shared={}), san),
+             "regridData_chunked": (lambda c: dataproc.regridData(c, regrid_shape, profile.extent,
+                                                                  shared={},
+                                                                  budget=profile.chunk_budget or 64), san),
+             "procDataCube": (dataproc.procDataCube, trimmed),
+             "procDataCube_lean": (lambda c: dataproc.procDataCube(c, lean=True), trimmed),
+             "tileArray": (imageproc.tileArray, proced.data, field_size, field_size),
+             "shadows_cpu": (lambda a: shadowproc.procShadows(a, dataShape=data_shape, engine="cpu"), tiled),
+             "shadows_gl": (lambda a: shadowproc.procShadows(a, dataShape=data_shape, engine="gl"), tiled),
+             "shadows_cpu_noskip": (lambda a: shadowproc.procShadows(a, dataShape=data_shape, engine="cpu",
+                                                                     skipEmpty=False), tiled),
+             "shadows_gl_noskip": (lambda a: shadowproc.procShadows(a, dataShape=data_shape, engine="gl",
+                                                                    skipEmpty=False), tiled),
+             "writePng": (lambda a: imageproc.writePng(a, io.BytesIO(), field_size, field_size * 2,
+                                                       compression=profile.png_compression,
+                                                       filter_type=profile.png_filter_type,
+                                                       threads=profile.png_threads), img),
+             "post": (lambda p: networking.UploadClient(url=post_url).post(p, payload), png)}
+
+    results = []
+    for stage in stages:
+        runs = [measure(*funcs[stage]) for _ in range(repeat)]
+        errors = [r["error"] for r in runs if "error" in r]
+        result = {"stage": stage,
+                  "scale": scale,
+                  "regrid_shape": regrid_shape,
+                  "field_size": field_size}
+        if errors:
+            result["error"] = errors[0]
+        else:
+            result["seconds"] = min(r["seconds"] for r in runs)
+            result["peak_rss_mb"] = max(r["peak_rss_mb"] for r in runs)
+        results.append(result)
+        print(json.dumps(result))
+
+    return results
+
+
+def parseArgs():
+    argparser = ap.ArgumentParser()
+    argparser.add_argument("-a", "--profile", default="default",
+        type=str, help="Name of analysis profile settings, as defined in config.py")
+    argparser.add_argument("-s", "--scale", default=[1.0], nargs="+",
+        type=float, help="Factors to scale the profile's horizontal regrid shape by")
+    argparser.add_argument("-l", "--levels", default=59,
+        type=int, help="Number of model levels in the synthetic input")
+    argparser.add_argument("--stages", default=ALL_STAGES, nargs="+",
+        choices=ALL_STAGES, help="Stages to benchmark")
+    argparser.add_argument("-r", "--repeat", default=3,
+        type=int, help="Runs of each stage, the fastest is reported")
+    argparser.add_argument("-o", "--output", default=None,
+        type=str, help="JSON file to write the results to")
+    return argparser.parse_args()
+
+
+if __name__ == "__main__":
+    call_args = parseArgs()
+    profile = ap.Namespace(**conf.profiles[call_args.profile])
+
+    server = HTTPServer(("127.0.0.1", 0), _DataService)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    post_url = "http://127.0.0.1:%s/" % server.server_port
+
+    results = []
+    for scale in call_args.scale:
+        results += benchStages(profile, scale, call_args.levels, call_args.stages,
+                               call_args.repeat, post_url)
+    server.shutdown()
+
+    report = {"profile": call_args.profile,
+              "date": datetime.datetime.utcnow().isoformat(),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "host": platform.node(),
+              "cpus": mp.cpu_count(),
+              "results": results}
+    if call_args.output is not None:
+        with open(call_args.output, "w") as f:
+            json.dump(report, f, indent=2)
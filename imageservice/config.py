@@ -1,4 +1,6 @@
 import iris
+import os
+import tempfile
 
 max_val = 255 # maximum data value (i.e. 8 bit uint)
 thredds_server = "http://ec2-52-16-245-62.eu-west-1.compute.amazonaws.com:8080/thredds/dodsC/testLab/"
@@ -6,17 +8,105 @@ img_data_server = "http://ec2-52-16-246-202.eu-west-1.compute.amazonaws.com:9000
 source_files = "*.nc"
 topog_file = "/Users/niall/Data/ukv/ukv_orog.pp"
 sea_level = 3 # minimum altitude number
+workers = 2 # number of warm worker processes in the image service
+queue_size = 32 # maximum number of files waiting for a worker
+intake_settle = 3 # seconds a new file's size and mtime must be unchanged before it is processed
+intake_poll = 0.5 # seconds between checks of new files
+intake_check_header = True # also wait until a new file has a netCDF header
+job_lease = 120 # seconds a worker holds a job from the shared job queue without a heartbeat
+job_heartbeat = 30 # seconds between lease renewals
+job_attempts = 3 # claims of a job before it is given up
+job_poll = 2 # seconds a worker waits when the job queue is empty
+metrics_file = "imageservice.prom" # where the image service exports its metrics
+metrics_format = "prometheus" # "prometheus" text file or "jsonl" (JSON lines)
+metrics_interval = 15 # seconds between metrics exports
+upload_concurrency = 4 # simultaneous posts to the data service
+upload_timeout = (10, 120) # connect and read timeouts for posts, in seconds
+upload_retries = 3 # retries of a post after a 5xx or connection error
+upload_backoff = 1.0 # seconds before the first retry, doubling after that
+regrid_cache_dir = os.path.join(tempfile.gettempdir(), "imageservice_regrid") # cached regrid weights
+result_cache_dir = os.path.join(tempfile.gettempdir(), "imageservice_results") # images already posted
+result_cache_bytes = 2 * 1024**3 # maximum size of the cached images
+result_cache_entries = 10000 # maximum number of cached results
+result_cache_skip_posts = False # don't post an image again if it has already been posted
+result_cache_scan_puts = 100 # results added between scans of the cache directory for the results of other processes
+volume_store_dir = os.path.join(tempfile.gettempdir(), "imageservice_volumes") # intermediate volumes, see volumestore.py
+chunk_dir = tempfile.gettempdir() # temporary files of profiles with a chunk_budget, see dataproc.regridChunked
+gl_backend = "glfw" # vispy backend of the gl shadow engine, "egl" renders without a display
 
 # profiles are namespaces which contain setting for different analysis types
+# phenomena are the fields made into images: the name they are posted as, a
+# constraint (e.g. the field's standard name, None if the file has one field)
+# and the data values scaled to 0 and max_val
+# with texture_plan, the images are the smallest textures the regridded data
+# fits in, with texture_channels channels (see imageproc.planTexture), rather
+# than field_width x field_height RGB textures
+# with regrid_cache, slices are regridded with weights precalculated once per
+# grid (see dataproc.calcRegridWeights), which agree with the iris regrid to 6
+# decimal places rather than exactly
+# with chunk_budget (MB), each slice is regridded and scaled a block at a time,
+# with the full size volumes in temporary files, for grids too large to process
+# in memory (see dataproc.regridChunked)
+# slices are processed one at a time in this process unless slice_processes is
+# raised, while the previous slice's images are posted (up to max_in_flight
+# slices at once, see serveupimage.processFile)
 profiles = {
 "default": {"data_constraint": iris.Constraint(model_level_number=lambda v: v.point < 60),
+		 "phenomena": [{"name": "cloud_fraction_in_a_layer", "constraint": None, "value_range": (0.0, 1.0)}],
 		 "extent": [-13.62, 6.406, 47.924, 60.866],
 		 "regrid_shape": [400, 400, 35],
 		 "field_width": 2048,
-		 "field_height": 2048},
+		 "field_height": 2048,
+		 "texture_plan": False,
+		 "texture_channels": [3, 4],
+		 "shadow_engine": "gl",
+		 "encoder": "png",
+		 "png_compression": 6,
+		 "png_filter_type": 0,
+		 "png_threads": 1,
+		 "raw_codec": "zstd",
+		 "raw_level": 3,
+		 "webp_method": 4,
+		 "slice_processes": 1,
+		 "max_in_flight": 2,
+		 "ordered_posts": True,
+		 "regrid_cache": False,
+		 "restratify_engine": "numpy",
+		 "lean": False,
+		 "chunk_budget": None,
+		 "load_mode": "cube",
+		 "result_cache": False,
+		 "volume_store": False,
+		 "light_positions": [(20, 0, 0)],
+		 "lod_factors": [1],
+		 "delta_keyframe_interval": 0},
 "ukv": {"data_constraint": iris.Constraint(model_level_number=lambda v: v.point < 60),
+		 "phenomena": [{"name": "cloud_fraction_in_a_layer", "constraint": None, "value_range": (0.0, 1.0)}],
 		 "extent": [-13.62, 6.406, 47.924, 60.866],
 		 "regrid_shape": [400, 400, 35],
 		 "field_width": 2048,
-		 "field_height": 2048}
+		 "field_height": 2048,
+		 "texture_plan": False,
+		 "texture_channels": [3, 4],
+		 "shadow_engine": "gl",
+		 "encoder": "png",
+		 "png_compression": 6,
+		 "png_filter_type": 0,
+		 "png_threads": 1,
+		 "raw_codec": "zstd",
+		 "raw_level": 3,
+		 "webp_method": 4,
+		 "slice_processes": 1,
+		 "max_in_flight": 2,
+		 "ordered_posts": True,
+		 "regrid_cache": False,
+		 "restratify_engine": "numpy",
+		 "lean": False,
+		 "chunk_budget": None,
+		 "load_mode": "cube",
+		 "result_cache": False,
+		 "volume_store": False,
+		 "light_positions": [(20, 0, 0)],
+		 "lod_factors": [1],
+		 "delta_keyframe_interval": 0}
 } # End of models
\ No newline at end of file
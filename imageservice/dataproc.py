@@ -1,10 +1,17 @@
+import hashlib
 import iris
 import numpy as np
+import os
 import png
+import tempfile
 
 import sys
 sys.path.append("/Users/niall/Projects/monty/lib/")
-import monty.vinterp
+try:
+    import monty.vinterp
+except ImportError:
+    # the numpy restratification engine is used instead
+    monty = None
 
 sys.path.append(".")
 import config as conf
@@ -16,6 +23,14 @@ Called by serveupimage.py
 
 """
 
+# regrid weights by source and target grid, see getRegridWeights
+_regrid_weights = {}
+# the most recent restratification weights, see getRestratifyWeights
+_restratify_weights = {}
+# the most recent restratification weights of each block, see restratifyChunked
+_restratify_blocks = {}
+
+
 def sanitizeAlt(c):
     """
     Takes a cube and sanitizes the altitude coordinates,
@@ -34,22 +49,127 @@ def sanitizeAlt(c):
     return c
 
 
-def restratifyAltLevels(c, nalt):
+def calcRestratifyWeights(src_levels, tgt_levels, axis):
+    """
+    Calculates the linear interpolation indices and weights which take
+    data on src_levels to tgt_levels along axis. Target levels outside
+    of a column's source levels are flagged, to be set to NaN.
+
+    Args:
+        * src_levels (np.Array): the level of every data point, which must be
+            monotonic along axis
+        * tgt_levels (np.Array): 1d array of levels to interpolate to
+        * axis (int): the level axis of src_levels
+
+    """
+    src = np.rollaxis(np.asarray(src_levels, dtype=np.float64), axis, src_levels.ndim)
+    shape = src.shape[:-1]
+    nz = src.shape[-1]
+    src = src.reshape(-1, nz)
+    descending = src[0, 0] > src[0, -1]
+    if descending:
+        src = src[:, ::-1]
+
+    lo = np.empty([src.shape[0], len(tgt_levels)], dtype=np.int16)
+    for k, lev in enumerate(tgt_levels):
+        lo[:, k] = np.clip(np.sum(src <= lev, axis=1) - 1, 0, nz - 2)
+
+    cols = np.arange(src.shape[0])[:, np.newaxis]
+    lower = src[cols, lo]
+    upper = src[cols, lo + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w = np.where(upper > lower, (tgt_levels - lower) / (upper - lower), 0.0)
+    outside = (tgt_levels < src[:, :1]) | (tgt_levels > src[:, -1:])
+
+    return {"lo": lo, "w": w, "outside": outside,
+            "shape": shape, "axis": axis, "descending": descending}
+
+
+def applyRestratifyWeights(weights, data, dtype=np.float64):
+    """
+    Interpolates data onto new levels using weights from
+    calcRestratifyWeights. Points outside of the source levels are NaN.
+    The interpolation is done, and returned, in dtype.
+
+    """
+    axis = weights["axis"]
+    nz = data.shape[axis]
+    values = np.ma.filled(np.ma.asarray(data, dtype=dtype), np.nan)
+    values = np.rollaxis(values, axis, data.ndim).reshape(-1, nz)
+    if weights["descending"]:
+        values = values[:, ::-1]
+
+    cols = np.arange(values.shape[0])[:, np.newaxis]
+    lo, w = weights["lo"], weights["w"]
+    if w.dtype != dtype:
+        w = weights.setdefault("w_%s" % np.dtype(dtype).name, w.astype(dtype))
+    restratified = (1 - w) * values[cols, lo] + w * values[cols, lo + 1]
+    restratified[weights["outside"]] = np.nan
+
+    restratified = restratified.reshape(weights["shape"] + (lo.shape[1],))
+    return np.rollaxis(restratified, data.ndim - 1, axis)
+
+
+def restratifyKey(src_levels, tgt_levels, axis):
+    """
+    Identifies source and target levels, for reusing restratification
+    weights.
+
+    """
+    key = hashlib.sha1(np.ascontiguousarray(src_levels).tobytes())
+    key.update(np.ascontiguousarray(tgt_levels).tobytes())
+    key.update(str(axis).encode("utf-8"))
+
+    return key.hexdigest()
+
+
+def getRestratifyWeights(src_levels, tgt_levels, axis):
+    """
+    Gets the restratification weights, reusing them while the source
+    levels (which only depend on the topography and model levels)
+    and target levels are unchanged.
+
+    """
+    key = restratifyKey(src_levels, tgt_levels, axis)
+    if key not in _restratify_weights:
+        # weights are large, so only keep the latest
+        _restratify_weights.clear()
+        _restratify_weights[key] = calcRestratifyWeights(src_levels, tgt_levels, axis)
+
+    return _restratify_weights[key]
+
+
+def restratifyAltLevels(c, nalt, engine="numpy", dtype=np.float64):
     """
     Restratifies the cube into nalt levels linearly spaced
     between the original min and max alt
 
+    Args:
+        * c (cube): cube with a log_altitude coord, see sanitizeAlt
+        * nalt (int): number of levels
+        * engine (str): "numpy", or "monty" to use monty.vinterp
+        * dtype: the float type the numpy engine interpolates in
+
     """
     log_levs = np.linspace(c.coord("log_altitude").points.min(),
                               c.coord("log_altitude").points.max(),
                               nalt)
     alt_axis, = c.coord_dims("model_level_number")
-    restratified_data = monty.vinterp.interpolate(log_levs,
+    if engine == "monty":
+        restratified_data = monty.vinterp.interpolate(log_levs,
                                                     c.coord("log_altitude").points,
                                                     c.data,
                                                     axis=alt_axis,
                                                     extrapolation=monty.vinterp.EXTRAPOLATE_NAN,
                                                     interpolation=monty.vinterp.INTERPOLATE_LINEAR)
+    elif engine == "numpy":
+        # put the log_altitude points in the same dimension order as the data
+        src_levels = c.coord("log_altitude").points
+        src_levels = src_levels.transpose(np.argsort(c.coord_dims("log_altitude")))
+        weights = getRestratifyWeights(src_levels, log_levs, alt_axis)
+        restratified_data = applyRestratifyWeights(weights, c.data, dtype=dtype)
+    else:
+        raise ValueError("Unknown restratification engine %s" % engine)
 
     newcoords = list(c.dim_coords)
     newcoords[alt_axis] = iris.coords.DimCoord(np.exp(log_levs), long_name="altitude", units="m")
@@ -66,10 +186,10 @@ def restratifyAltLevels(c, nalt):
     return restratified_data_cube
 
 
-def horizRegrid(c, nlat, nlon, extent):
+def targetGrid(nlat, nlon, extent):
     """
-    Takes a cube (in any projection) and regrids it onto a
-    recatilinear nlat x nlon grid spaced linearly between
+    Makes the latitude and longitude coords of a
+    recatilinear nlat x nlon grid spaced linearly between extent
 
     """
     u = iris.unit.Unit("degrees")
@@ -87,6 +207,17 @@ def horizRegrid(c, nlat, nlon, extent):
                                     coord_system=cs)
     latc.guess_bounds()
 
+    return latc, lonc
+
+
+def horizRegrid(c, nlat, nlon, extent):
+    """
+    Takes a cube (in any projection) and regrids it onto a
+    recatilinear nlat x nlon grid spaced linearly between
+
+    """
+    latc, lonc = targetGrid(nlat, nlon, extent)
+
     grid_cube = iris.cube.Cube(np.empty([nlat, nlon]))
     grid_cube.add_dim_coord(latc, 0)
     grid_cube.add_dim_coord(lonc, 1)
@@ -96,14 +227,208 @@ def horizRegrid(c, nlat, nlon, extent):
     return rg_c
 
 
-def trimOutsideDomain(c):
+def _linearIndices(points, targets):
     """
-    When we regrid from polar stereographic to rectalinear, the resultant
-    shape is non-orthogonal, and is surrounded by masked values. This
-    function trims the cube to be an orthogonal region of real data.
+    Finds the lower neighbour index and the weight of the upper
+    neighbour of each target in a monotonic array of points.
 
-    Its a little bespoke and make be unscescesarry if we can swith
-    to an AreaWeighted function.
+    """
+    ascending = points[-1] >= points[0]
+    pts = points if ascending else points[::-1]
+    i = np.clip(np.searchsorted(pts, targets, side="right") - 1, 0, len(pts) - 2)
+    w = (targets - pts[i]) / (pts[i+1] - pts[i])
+    outside = (targets < pts[0]) | (targets > pts[-1])
+    if not ascending:
+        i = len(pts) - 2 - i
+        w = 1 - w
+
+    return i, w, outside
+
+
+def regridKey(c, nlat, nlon, extent):
+    """
+    Identifies a source grid and target grid pair, for caching
+    regrid weights.
+
+    """
+    key = hashlib.sha1()
+    for crd in (c.coord(axis="X"), c.coord(axis="Y")):
+        key.update(np.ascontiguousarray(crd.points, dtype=np.float64).tobytes())
+        key.update(repr(crd.coord_system).encode("utf-8"))
+    key.update(repr((nlat, nlon, [float(e) for e in extent])).encode("utf-8"))
+
+    return key.hexdigest()
+
+
+def calcRegridWeights(c, nlat, nlon, extent):
+    """
+    Calculates the bilinear interpolation indices and weights that
+    regrid the horizontal grid of c onto the target grid, as
+    iris.analysis.Linear(extrapolation_mode='mask') does.
+
+    Returns a dict of nlon x nlat arrays of the x and y indices and
+    weights of the lower neighbours, and a mask of target points
+    outside of the source grid.
+
+    """
+    latc, lonc = targetGrid(nlat, nlon, extent)
+    srcx = c.coord(axis="X")
+    srcy = c.coord(axis="Y")
+
+    lons, lats = np.meshgrid(lonc.points, latc.points, indexing="ij")
+    if srcx.coord_system is not None and srcx.coord_system != lonc.coord_system:
+        xyz = srcx.coord_system.as_cartopy_crs().transform_points(
+            lonc.coord_system.as_cartopy_crs(), lons, lats)
+        px, py = xyz[..., 0], xyz[..., 1]
+    else:
+        px, py = lons, lats
+    if srcx.units == "degrees":
+        # bring target longitudes into the same range as the source
+        px = (px - srcx.points.min()) % 360 + srcx.points.min()
+
+    ix, wx, xoutside = _linearIndices(srcx.points, px)
+    iy, wy, youtside = _linearIndices(srcy.points, py)
+
+    return {"ix": ix, "wx": wx, "iy": iy, "wy": wy,
+            "outside": xoutside | youtside}
+
+
+def getRegridWeights(c, nlat, nlon, extent, cache_dir):
+    """
+    Gets the regrid weights for a source and target grid, calculating
+    them once and then reusing them from memory or from cache_dir.
+
+    """
+    key = regridKey(c, nlat, nlon, extent)
+    if key in _regrid_weights:
+        return _regrid_weights[key]
+
+    path = os.path.join(cache_dir, key + ".npz")
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            weights = dict(cached.items())
+    else:
+        weights = calcRegridWeights(c, nlat, nlon, extent)
+        saveRegridWeights(weights, path)
+    _regrid_weights[key] = weights
+    weights["path"] = path
+
+    return weights
+
+
+def saveRegridWeights(weights, path):
+    """
+    Writes regrid weights to disk, so that restarted
+    workers can reuse them.
+
+    """
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    temp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(temp_path, "wb") as f:
+        np.savez(f, **dict((k, v) for k, v in weights.items() if k != "path"))
+    # rename is atomic, so other workers never see a partial file
+    os.rename(temp_path, path)
+
+
+def applyRegridWeights(c, weights, nlat, nlon, extent):
+    """
+    Regrids a cube using precalculated weights (see calcRegridWeights).
+    All levels are interpolated at once by gathering the four neighbours
+    of each target point.
+
+    The target points are masked where they lie outside of the source grid
+    or where any neighbour which contributes to them is masked.
+
+    """
+    xdim, = c.coord_dims(c.coord(axis="X"))
+    ydim, = c.coord_dims(c.coord(axis="Y"))
+    otherdims = [d for d in range(c.ndim) if d not in (xdim, ydim)]
+    rg_data = regridValues(c.data, weights, xdim, ydim)
+
+    latc, lonc = targetGrid(nlat, nlon, extent)
+    dim_coords_and_dims = [(lonc, xdim), (latc, ydim)]
+    dim_coords_and_dims += [(crd, c.coord_dims(crd)[0]) for crd in c.dim_coords
+                                if c.coord_dims(crd)[0] in otherdims]
+    rg_c = iris.cube.Cube(data=rg_data, dim_coords_and_dims=dim_coords_and_dims)
+    rg_c.metadata = c.metadata
+    for crd in c.aux_coords:
+        if not set(c.coord_dims(crd)) & set([xdim, ydim]):
+            rg_c.add_aux_coord(crd.copy(), c.coord_dims(crd))
+
+    return rg_c
+
+
+def regridValues(data, weights, xdim, ydim):
+    """
+    Regrids the values of an array, whose xdim and ydim are the source
+    grid, see applyRegridWeights. Every level is regridded on its own,
+    so a block of levels gives the same values as the whole array.
+
+    returns a masked array with the target grid in place of the source grid
+
+    """
+    otherdims = [d for d in range(data.ndim) if d not in (xdim, ydim)]
+    data = np.ma.asarray(data).transpose([xdim, ydim] + otherdims)
+    values = np.ma.filled(data, 0)
+    mask = np.ma.getmaskarray(data)
+
+    ix, iy, wx, wy = weights["ix"], weights["iy"], weights["wx"], weights["wy"]
+    extra = (Ellipsis,) + (None,) * len(otherdims)
+    rg_values = 0
+    rg_mask = weights["outside"][extra]
+    for dx, fx in ((0, 1 - wx), (1, wx)):
+        for dy, fy in ((0, 1 - wy), (1, wy)):
+            # keep the data's precision (e.g. float32 in lean mode)
+            w = (fx * fy)[extra].astype(values.dtype)
+            rg_values = rg_values + w * values[ix + dx, iy + dy]
+            rg_mask = rg_mask | (mask[ix + dx, iy + dy] & (w > 0))
+
+    # put the new lon/lat dims where x/y were
+    order = np.argsort([xdim, ydim] + otherdims)
+    return np.ma.MaskedArray(rg_values, mask=rg_mask).transpose(order)
+
+
+def subsetIndices(c, nlat, nlon, extent):
+    """
+    Finds the columns and rows of the grid of c which are needed to
+    regrid it onto the target grid, so that only those need to be
+    loaded. Regridding the subset gives the same result as regridding
+    the whole grid.
+
+    Only the coords of c are used, so it can be a cube which has not
+    loaded its data yet. Returns slices of the X and Y dims.
+
+    """
+    weights = calcRegridWeights(c, nlat, nlon, extent)
+    inside = ~weights["outside"]
+    if not inside.any():
+        raise ValueError("The grid does not overlap the extent %s" % (extent,))
+    # each target point uses the lower neighbour and the one after it
+    ix = weights["ix"][inside]
+    iy = weights["iy"][inside]
+
+    return slice(int(ix.min()), int(ix.max()) + 2), slice(int(iy.min()), int(iy.max()) + 2)
+
+
+def subsetGrid(c, xslice, yslice):
+    """
+    Indexes the X and Y dims of a cube, whatever order they are in.
+
+    """
+    index = [slice(None)] * c.ndim
+    index[c.coord_dims(c.coord(axis="X", dim_coords=True))[0]] = xslice
+    index[c.coord_dims(c.coord(axis="Y", dim_coords=True))[0]] = yslice
+
+    return c[tuple(index)]
+
+
+def calcDomain(c):
+    """
+    Finds the orthogonal region of real data in a regridded cube, see
+    trimOutsideDomain. Returns boolean arrays of the indices to keep in
+    the first and second dimensions.
 
     """
     # assess the top layer as its likely to be free
@@ -111,28 +436,101 @@ def trimOutsideDomain(c):
     altdim, = c.coord_dims("altitude")
     slices = [slice(None)]*c.ndim
     slices[altdim] = -1
-    lonmean = np.mean(c.data[slices].mask, axis=1)
+
+    return domainOfMask(c.data[slices].mask)
+
+
+def domainOfMask(mask):
+    """
+    Finds the region to keep from the mask of the top layer of a
+    regridded cube, see calcDomain.
+
+    """
+    lonmean = np.mean(mask, axis=1)
     glonmean = np.gradient(lonmean)
     uselat = (lonmean < 1.0) & (np.fabs(glonmean) < 0.004)
 
-    latmean = np.mean(c.data[slices].mask, axis=0)
+    latmean = np.mean(mask, axis=0)
     glatmean = np.gradient(latmean)
     uselon = (latmean < 1.0) & (np.fabs(glatmean) < 0.004)
 
+    return uselat, uselon
+
+
+def trimOutsideDomain(c, domain=None):
+    """
+    When we regrid from polar stereographic to rectalinear, the resultant
+    shape is non-orthogonal, and is surrounded by masked values. This
+    function trims the cube to be an orthogonal region of real data.
+
+    Its a little bespoke and make be unscescesarry if we can swith
+    to an AreaWeighted function.
+
+    Args:
+        * c (cube): regridded cube
+        * domain (tuple): the region to keep, as returned by calcDomain.
+            Calculated from c if not given.
+
+    """
+    if domain is None:
+        domain = calcDomain(c)
+    uselat, uselon = domain
+
     return c[uselat, uselon, :]
 
 
-def regridData(c, regrid_shape, extent):
+def regridData(c, regrid_shape, extent, cache_dir=None, restratify_engine="numpy",
+               dtype=np.float64, shared=None, budget=None):
     """
     Regrids a cube onto a nalt x nlat x nlon recatlinear cube
+
+    If cache_dir is given, the horizontal regrid weights and the
+    trimmed domain are calculated for the first cube on a grid and
+    then reused (see getRegridWeights), rather than using iris.
+    restratify_engine and dtype are passed to restratifyAltLevels.
+
+    shared (dict) keeps the regrid weights and trimmed domain of the
+    first cube it is passed with, and reuses them for the next cubes,
+    e.g. other phenomena on the same grid, so that they are all
+    trimmed alike.
+
+    With budget (MB), the cube is regridded a block at a time, see
+    regridChunked.
     """ 
-    c = restratifyAltLevels(c, regrid_shape[2])
-    c = horizRegrid(c, regrid_shape[1], regrid_shape[0], extent)
+    if budget is not None:
+        return regridChunked(c, regrid_shape, extent, budget, cache_dir,
+                             restratify_engine, dtype, shared)
+    c = restratifyAltLevels(c, regrid_shape[2], engine=restratify_engine, dtype=dtype)
+    nlat, nlon = regrid_shape[1], regrid_shape[0]
+    if cache_dir is not None:
+        weights = getRegridWeights(c, nlat, nlon, extent, cache_dir)
+    elif shared is not None:
+        if "regrid_weights" not in shared:
+            shared["regrid_weights"] = calcRegridWeights(c, nlat, nlon, extent)
+        weights = shared["regrid_weights"]
+    else:
+        weights = None
+    if weights is None:
+        c = horizRegrid(c, nlat, nlon, extent)
+    else:
+        c = applyRegridWeights(c, weights, nlat, nlon, extent)
     # remove the to latyer which seems to artificially masked from regridding
     altdim, = c.coord_dims("altitude")
     slices = [slice(None)]*c.ndim
     slices[altdim] = slice(0, -1)
-    c = trimOutsideDomain(c[tuple(slices)])
+    c = c[tuple(slices)]
+    if shared is not None and "domain" in shared:
+        domain = shared["domain"]
+    elif cache_dir is not None:
+        if "uselat" not in weights:
+            weights["uselat"], weights["uselon"] = calcDomain(c)
+            saveRegridWeights(weights, weights["path"])
+        domain = (weights["uselat"], weights["uselon"])
+    else:
+        domain = calcDomain(c)
+    if shared is not None:
+        shared["domain"] = domain
+    c = trimOutsideDomain(c, domain)
 
     if np.isnan(c.data.compressed().mean()):
         raise ValueError("Regridded data is NaN - are the lat/lon ranges compatable?")
@@ -140,7 +538,297 @@ def regridData(c, regrid_shape, extent):
     return c
 
 
-def procDataCube(c):
+def blockSize(n, item_bytes, budget):
+    """
+    The number of n items (e.g. rows or levels) to process at a time,
+    so that the working set of a block, item_bytes for each item, is
+    within budget MB.
+
+    """
+    return int(max(1, min(n, budget * 2**20 // max(item_bytes, 1))))
+
+
+def tempArray(shape, dtype):
+    """
+    A zeroed array kept in a temporary file in conf.chunk_dir rather
+    than in memory, so that only the parts in use are paged in. The
+    file is removed once the array is no longer used.
+
+    """
+    with tempfile.TemporaryFile(dir=conf.chunk_dir) as f:
+        # the mapping keeps its own handle on the file
+        return np.memmap(f, dtype=dtype, mode="w+", shape=tuple(shape))
+
+
+def horizontalGrid(c):
+    """
+    A cube of only the horizontal dim coords of c, for calculating
+    regrid weights (which do not depend on the data) without the
+    other coords of c.
+
+    """
+    x = c.coord(axis="X", dim_coords=True)
+    y = c.coord(axis="Y", dim_coords=True)
+    grid = iris.cube.Cube(np.zeros([len(x.points), len(y.points)], dtype=np.int8))
+    grid.add_dim_coord(x.copy(), 0)
+    grid.add_dim_coord(y.copy(), 1)
+
+    return grid
+
+
+def restratifyChunked(c, nalt, budget, engine="numpy", dtype=np.float64):
+    """
+    Restratifies an x, y, z cube as restratifyAltLevels does, but a
+    block of rows of columns at a time. Each column is interpolated on
+    its own, so the blocks need no halo and give the same values as
+    restratifyAltLevels. The numpy engine's weights of each block are
+    kept in temporary files (see tempArray) and reused while the
+    levels are unchanged, as getRestratifyWeights does in memory.
+
+    returns the nalt x X x Y restratified values, in a temporary file,
+    which are NaN where restratifyAltLevels masks them; and the log
+    altitude levels
+
+    """
+    log_alt = c.coord("log_altitude").points
+    log_levs = np.linspace(log_alt.min(), log_alt.max(), nalt)
+    src_levels = log_alt.transpose(np.argsort(c.coord_dims("log_altitude")))
+    nx, ny, nz = c.shape
+    itemsize = np.dtype(dtype).itemsize
+    rows = blockSize(nx, ny * (nz * (24 + 2 * itemsize) + nalt * (48 + 4 * itemsize)), budget)
+
+    if engine == "numpy":
+        key = "%s-%d" % (restratifyKey(src_levels, log_levs, 2), rows)
+        if key not in _restratify_blocks:
+            # only keep the latest, as getRestratifyWeights does
+            _restratify_blocks.clear()
+            _restratify_blocks[key] = {}
+        block_weights = _restratify_blocks[key]
+    elif engine != "monty":
+        raise ValueError("Unknown restratification engine %s" % engine)
+
+    # levels first, so that a block of levels is contiguous
+    restratified = tempArray([nalt, nx, ny], dtype)
+    for r0 in range(0, nx, rows):
+        r1 = min(r0 + rows, nx)
+        if engine == "monty":
+            block = monty.vinterp.interpolate(log_levs,
+                                              src_levels[r0:r1],
+                                              c.data[r0:r1],
+                                              axis=2,
+                                              extrapolation=monty.vinterp.EXTRAPOLATE_NAN,
+                                              interpolation=monty.vinterp.INTERPOLATE_LINEAR)
+        else:
+            if r0 not in block_weights:
+                weights = calcRestratifyWeights(src_levels[r0:r1], log_levs, 2)
+                for name in ["lo", "w", "outside"]:
+                    on_disk = tempArray(weights[name].shape, weights[name].dtype)
+                    on_disk[...] = weights[name]
+                    weights[name] = on_disk
+                block_weights[r0] = weights
+            # a copy, so that weights cast to dtype are not kept
+            block = applyRestratifyWeights(dict(block_weights[r0]), c.data[r0:r1], dtype=dtype)
+        restratified[:, r0:r1] = np.rollaxis(block, 2)
+
+    return restratified, log_levs
+
+
+def regridChunked(c, regrid_shape, extent, budget, cache_dir=None, restratify_engine="numpy",
+                  dtype=np.float64, shared=None):
+    """
+    Regrids an x, y, z cube as regridData does, for volumes too large
+    to process in memory. Each stage works on a block at a time, sized
+    so that its working set stays within budget MB, and the full size
+    volumes between the stages are kept in temporary files (see
+    tempArray):
+
+    1. restratification, in blocks of rows of columns (see restratifyChunked)
+    2. horizontal regridding, trimming and the NaN check, in blocks of
+       levels, each of which is regridded on its own (see regridValues)
+
+    The regrid weights are always precalculated (from cache_dir, shared
+    or calculated for the cube), rather than regridding with iris. The
+    result is the same, to the bit, as regridData's with the same
+    weights, but its data is in temporary files rather than in memory.
+    Only the lean scaling (see scaleToUint8) or procDataCube with
+    chunked need read it a row at a time.
+
+    """
+    dims = [c.coord_dims(c.coord(axis=axis, dim_coords=True))[0] for axis in "XY"]
+    dims += list(c.coord_dims("model_level_number"))
+    if dims != [0, 1, 2] or c.ndim != 3:
+        raise ValueError("Chunked regridding needs an x, y, z cube, not %s" % c.summary(shorten=True))
+
+    nalt = regrid_shape[2]
+    nlat, nlon = regrid_shape[1], regrid_shape[0]
+    restratified, log_levs = restratifyChunked(c, nalt, budget, restratify_engine, dtype)
+
+    grid = horizontalGrid(c)
+    if cache_dir is not None:
+        weights = getRegridWeights(grid, nlat, nlon, extent, cache_dir)
+    elif shared is not None:
+        if "regrid_weights" not in shared:
+            shared["regrid_weights"] = calcRegridWeights(grid, nlat, nlon, extent)
+        weights = shared["regrid_weights"]
+    else:
+        weights = calcRegridWeights(grid, nlat, nlon, extent)
+    if shared is not None and "domain" in shared:
+        domain = shared["domain"]
+    elif cache_dir is not None and "uselat" in weights:
+        domain = (weights["uselat"], weights["uselon"])
+    else:
+        domain = None
+
+    itemsize = np.dtype(dtype).itemsize
+    levels = blockSize(nalt - 1, c.shape[0] * c.shape[1] * (3 * itemsize + 2) +
+                       nlon * nlat * (5 * itemsize + 3), budget)
+    data = mask = None
+    total, count = 0.0, 0
+    # the top level is left out, as in regridData, and the domain is
+    # found from the one below it, so start from the top
+    for k0 in reversed(range(0, nalt - 1, levels)):
+        k1 = min(k0 + levels, nalt - 1)
+        block = np.ma.masked_invalid(np.rollaxis(restratified[k0:k1], 0, 3))
+        rg_block = regridValues(block, weights, 0, 1)
+        if domain is None:
+            domain = domainOfMask(rg_block[..., -1].mask)
+            if cache_dir is not None:
+                weights["uselat"], weights["uselon"] = domain
+                saveRegridWeights(weights, weights["path"])
+        uselat, uselon = domain
+        rg_block = rg_block[uselat][:, uselon]
+        if data is None:
+            shape = rg_block.shape[:2] + (nalt - 1,)
+            data = tempArray(shape, rg_block.dtype)
+            mask = tempArray(shape, bool)
+        data[..., k0:k1] = rg_block.data
+        mask[..., k0:k1] = rg_block.mask
+        values = rg_block.compressed()
+        total += values.sum()
+        count += values.size
+    if shared is not None:
+        shared["domain"] = domain
+
+    if count == 0 or np.isnan(total / count):
+        raise ValueError("Regridded data is NaN - are the lat/lon ranges compatable?")
+
+    latc, lonc = targetGrid(nlat, nlon, extent)
+    altc = iris.coords.DimCoord(np.exp(log_levs), long_name="altitude", units="m")
+    rg_c = iris.cube.Cube(data=np.ma.MaskedArray(data, mask=mask),
+                          dim_coords_and_dims=[(lonc[uselat], 0), (latc[uselon], 1), (altc[:-1], 2)])
+    rg_c.metadata = c.metadata
+    rg_c.add_aux_coord(c.coord("forecast_reference_time").copy())
+
+    return rg_c
+
+
+def blockMeans(data, factor):
+    """
+    The means of blocks of factor points in every dim of an array,
+    leaving out masked points, see downsampleCube.
+
+    """
+    shape = [n // factor for n in data.shape]
+    data = np.ma.asarray(data)[tuple(slice(0, n * factor) for n in shape)]
+    blocks_shape = []
+    for n in shape:
+        blocks_shape += [n, factor]
+    values = np.ma.filled(data, 0).reshape(blocks_shape)
+    counts = (~np.ma.getmaskarray(data)).reshape(blocks_shape)
+    for axis in range(2 * data.ndim - 1, 0, -2):
+        values = values.sum(axis=axis)
+        counts = counts.sum(axis=axis)
+
+    return np.ma.masked_where(counts == 0, values / np.maximum(counts, 1))
+
+
+def downsampleCube(c, factor, budget=None):
+    """
+    Averages blocks of factor points in every dim of a regridded cube,
+    to make a lower resolution level of detail without regridding again.
+
+    Masked points are left out of the means, and blocks with no data
+    are masked. Points left over at the end of a dim are dropped.
+
+    With budget (MB), the means are worked out for a block of rows at a
+    time, which gives the same values, e.g. for cubes from regridChunked.
+
+    """
+    shape = [n // factor for n in c.shape]
+    rows = max(shape[0], 1)
+    if budget is not None:
+        rows = blockSize(shape[0], factor * int(np.prod(c.shape[1:])) * (2 * c.dtype.itemsize + 18),
+                         budget)
+    blocks = [blockMeans(c.data[r0 * factor:(r0 + rows) * factor], factor)
+              for r0 in range(0, max(shape[0], 1), rows)]
+    means = blocks[0] if len(blocks) == 1 else np.ma.concatenate(blocks)
+
+    dim_coords_and_dims = []
+    for crd in c.dim_coords:
+        dim, = c.coord_dims(crd)
+        points = crd.points[:shape[dim] * factor].reshape(shape[dim], factor).mean(axis=1)
+        dim_coords_and_dims.append((crd.copy(points=points), dim))
+    ds_c = iris.cube.Cube(data=means.astype(c.dtype), dim_coords_and_dims=dim_coords_and_dims)
+    ds_c.metadata = c.metadata
+    for crd in c.aux_coords:
+        if not c.coord_dims(crd):
+            ds_c.add_aux_coord(crd.copy())
+
+    return ds_c
+
+
+def scaleToUint8(data, max_val, value_range=(0.0, 1.0)):
+    """
+    Converts data between value_range into uint8 values between 0 and
+    max_val, with masked and invalid values set to max_val. Works a row
+    at a time, so only the uint8 output is full size.
+
+    """
+    values = np.ma.getdata(data)
+    mask = np.ma.getmask(data)
+    vmin, vmax = value_range
+    scale = float(max_val) / (vmax - vmin)
+    out = np.empty(values.shape, dtype=np.uint8)
+    for i in range(values.shape[0]):
+        row = values[i] - vmin if vmin else values[i]
+        row = row * scale
+        invalid = ~np.isfinite(row)
+        if mask is not np.ma.nomask:
+            invalid |= mask[i]
+        row[invalid] = max_val
+        np.clip(row, 0, max_val, out=row)
+        out[i] = row
+
+    return out
+
+
+def scaleRows(data, max_val, value_range=(0.0, 1.0)):
+    """
+    The uint8 values of procDataCube's float scaling, i.e. what the
+    scaled data is tiled as, worked out a row at a time as
+    scaleToUint8 does, so that only the uint8 output is full size.
+    Unlike scaleToUint8, values outside value_range are not clipped.
+
+    """
+    values = np.ma.getdata(data)
+    mask = np.ma.getmask(data)
+    vmin, vmax = value_range
+    out = np.empty(values.shape, dtype=np.uint8)
+    for i in range(values.shape[0]):
+        row = np.array(values[i])
+        if vmin:
+            row -= vmin
+        row *= max_val / float(vmax - vmin)
+        invalid = ~np.isfinite(row)
+        if mask is not np.ma.nomask:
+            invalid |= mask[i]
+        row[invalid] = max_val
+        out[i] = row
+
+    return out
+
+
+def procDataCube(c, lean=False, value_range=(0.0, 1.0), chunked=False):
     """
     Processes data such that it is suitable for visualisation.
 
@@ -148,10 +836,30 @@ def procDataCube(c):
     Other adjustments should be done here, like adjusting range and saturation.
     E.g. for a 15degC potential temperature surface, all values <15 = 0 and >15=255
 
+    value_range gives the data values which are scaled to 0 and
+    MAX_VAL, e.g. (0, 1) for cloud fraction or (200, 320) for
+    temperature in K.
+
     NB that all masked values will also be converted to MAX_VAL.
 
+    If lean, the data is converted straight to uint8 (see scaleToUint8)
+    rather than through full size float temporaries. If chunked, the
+    data is scaled as it is otherwise, but a row at a time, to the
+    uint8 values it would be tiled as (see scaleRows), e.g. for cubes
+    from regridChunked.
+
     """
-    c.data *= conf.max_val
+    if lean:
+        c.data = scaleToUint8(c.data, conf.max_val, value_range)
+        return c
+    if chunked:
+        c.data = scaleRows(c.data, conf.max_val, value_range)
+        return c
+
+    vmin, vmax = value_range
+    if vmin:
+        c.data -= vmin
+    c.data *= conf.max_val / float(vmax - vmin)
     c.data = np.ma.fix_invalid(c.data, fill_value=conf.max_val)
     c.data = np.ma.filled(c.data, fill_value=conf.max_val)
 
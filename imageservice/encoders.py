@@ -0,0 +1,179 @@
+import io
+import numpy as np
+import png
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    # the zlib raw codec needs no extra packages
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    from PIL import Image
+except ImportError:
+    # only needed by the webp encoder
+    Image = None
+
+import sys
+sys.path.append(".")
+import imageproc
+
+"""
+encoders.py contains the formats images can be posted in, chosen by
+the encoder setting of a profile (see makeEncoder). Every encoder has
+a mime_type, an encode method that turns an i x j x channels uint8
+image into bytes, and a decode method that turns them back, used by
+tests and benchmarks/encoding.py. Images have 1 to 4 channels, or 3
+(RGB) or 4 (RGBA) for webp. Called by networking.py
+
+"""
+
+RAW_MAGIC = b"TRAW"
+# magic, version, height, width, channels, codec
+RAW_HEADER = ">4sBIIBB"
+RAW_CODECS = ["zlib", "zstd", "lz4"]
+
+
+class PngEncoder(object):
+    """
+    A png, see imageproc.writePng.
+
+    Args:
+        * compression (int): zlib compression level, 0-9
+        * filter_type (int): png row filter, see imageproc.filterRows
+        * threads (int): number of row bands to compress in parallel
+
+    """
+    mime_type = "image/png"
+
+    def __init__(self, compression=6, filter_type=0, threads=1):
+        self.compression = compression
+        self.filter_type = filter_type
+        self.threads = threads
+
+    def encode(self, img_data):
+        img = io.BytesIO()
+        imageproc.writePng(img_data, img,
+                           height=img_data.shape[0], width=img_data.shape[1],
+                           nchannels=img_data.shape[2],
+                           compression=self.compression,
+                           filter_type=self.filter_type,
+                           threads=self.threads)
+        return img.getvalue()
+
+    def decode(self, data):
+        width, height, rows, info = png.Reader(bytes=data).asDirect()
+        return np.array(list(rows), dtype=np.uint8).reshape(height, width, info["planes"])
+
+
+class RawEncoder(object):
+    """
+    The uint8 image as it is, after a small header (see RAW_HEADER),
+    compressed with zstd, lz4 or zlib. Larger than a png, but much
+    faster to encode and decode, as there is no row filtering and
+    zstd and lz4 are built for speed.
+
+    Args:
+        * codec (str): "zstd" (needs the zstandard package), "lz4"
+            (needs the lz4 package) or "zlib"
+        * level (int): compression level of the codec
+
+    """
+    mime_type = "application/x-imageservice-raw"
+
+    def __init__(self, codec="zstd", level=3):
+        if codec not in RAW_CODECS:
+            raise ValueError("Unknown raw codec %s" % codec)
+        if codec == "zstd" and zstandard is None:
+            raise ImportError("The zstd raw codec needs the zstandard package")
+        if codec == "lz4" and lz4 is None:
+            raise ImportError("The lz4 raw codec needs the lz4 package")
+        self.codec = codec
+        self.level = level
+
+    def encode(self, img_data):
+        img_data = np.ascontiguousarray(img_data, dtype=np.uint8)
+        if img_data.ndim == 2:
+            img_data = img_data[:, :, np.newaxis]
+        height, width, channels = img_data.shape
+        raw = img_data.tobytes()
+        if self.codec == "zstd":
+            body = zstandard.ZstdCompressor(level=self.level).compress(raw)
+        elif self.codec == "lz4":
+            body = lz4.frame.compress(raw, compression_level=self.level)
+        else:
+            body = zlib.compress(raw, self.level)
+        header = struct.pack(RAW_HEADER, RAW_MAGIC, 1, height, width, channels,
+                             RAW_CODECS.index(self.codec))
+        return header + body
+
+    def decode(self, data):
+        magic, version, height, width, channels, codec = struct.unpack_from(RAW_HEADER, data)
+        if magic != RAW_MAGIC or version != 1:
+            raise ValueError("Not a raw image")
+        body = data[struct.calcsize(RAW_HEADER):]
+        codec = RAW_CODECS[codec]
+        if codec == "zstd":
+            raw = zstandard.ZstdDecompressor().decompress(body)
+        elif codec == "lz4":
+            raw = lz4.frame.decompress(body)
+        else:
+            raw = zlib.decompress(body)
+        return np.frombuffer(raw, dtype=np.uint8).reshape(height, width, channels)
+
+
+class WebpEncoder(object):
+    """
+    A lossless webp, which is usually much smaller than a png of the
+    same image and is decoded natively by browsers. Needs Pillow.
+    The RGB values of transparent pixels are kept (exact), as an RGBA
+    texture holds data in its alpha channel. Webp has no grayscale
+    images, so only RGB and RGBA images can be encoded.
+
+    Args:
+        * method (int): 0-6, higher is slower but smaller
+
+    """
+    mime_type = "image/webp"
+
+    def __init__(self, method=4):
+        if Image is None:
+            raise ImportError("The webp encoder needs the Pillow package")
+        self.method = method
+
+    def encode(self, img_data):
+        if img_data.ndim != 3 or img_data.shape[2] not in (3, 4):
+            raise ValueError("webp images must be RGB or RGBA, not %s" % (img_data.shape,))
+        img = io.BytesIO()
+        Image.fromarray(np.ascontiguousarray(img_data, dtype=np.uint8)).save(
+            img, "WEBP", lossless=True, exact=True, method=self.method)
+        return img.getvalue()
+
+    def decode(self, data):
+        return np.asarray(Image.open(io.BytesIO(data)))
+
+
+def makeEncoder(profile):
+    """
+    The encoder chosen by a profile's encoder setting, with the
+    profile's png, raw or webp settings.
+
+    Args:
+        * profile (namespace): see config.profiles
+
+    """
+    if profile.encoder == "png":
+        return PngEncoder(profile.png_compression, profile.png_filter_type, profile.png_threads)
+    elif profile.encoder == "raw":
+        return RawEncoder(profile.raw_codec, profile.raw_level)
+    elif profile.encoder == "webp":
+        if profile.texture_plan and min(profile.texture_channels) < 3:
+            raise ValueError("webp textures must have 3 or 4 channels, not %s" %
+                             " or ".join(str(c) for c in profile.texture_channels))
+        return WebpEncoder(profile.webp_method)
+    raise ValueError("Unknown encoder %s" % profile.encoder)
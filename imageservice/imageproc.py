@@ -1,5 +1,7 @@
 import numpy as np
-import png
+import struct
+import zlib
+from multiprocessing.pool import ThreadPool
 
 """
 imageproc.py is the top level program called by the imageservice.py. It contains
@@ -8,7 +10,119 @@ functionality dealing with the image. Called by serveupimage.py
 """
     
 
-def tileArray(a, maxx, maxy, maxz=3, padxy=True):
+def _tileView(tiled, datax, datay, maxitiles, maxjtiles):
+    """
+    Returns a view of a tiled array indexed by
+    [channel, tile row, tile column, x, y], such that
+    view[..., x, y] is the (padded) data point x, y of that tile.
+
+    """
+    # tile rows count up from the bottom of the texture
+    flipped = tiled[::-1, ...]
+    view = flipped[:maxjtiles*datay, :maxitiles*datax, :].view()
+    # setting the shape (rather than reshaping) guarantees we get a view
+    view.shape = (maxjtiles, datay, maxitiles, datax, tiled.shape[2])
+    return view.transpose([4, 0, 2, 3, 1])
+
+
+# the largest texture planTexture will use, which WebGL clients support
+MAX_TEXTURE_SIZE = 4096
+
+
+def textureLayout(shape, width, height, channels=3, padxy=True):
+    """
+    How tileArray lays a volume out in a texture, as the uniforms the
+    shadow shader needs (see shadowproc.makeProgram).
+
+    Args:
+        * shape (3-tuple): x, y, z shape of the volume
+        * width, height (int): texture size in pixels
+        * channels (int): 3 (RGB) or 4 (RGBA)
+        * padxy (bool): whether the tiles are padded
+
+    Returns a dict of the texture's width, height and channels, the
+    padded x, y and z shape of a tile (dataShape), nSlicesPerRow,
+    maxRow, nSlices (tiles in a channel) and texLevels (tiles in all
+    channels)
+
+    Raises ValueError if the volume does not fit in the texture
+
+    """
+    pad = 1 if padxy else 0
+    datax, datay = shape[0] + 2*pad, shape[1] + 2*pad
+    nSlicesPerRow = int(width/datax)
+    nRows = int(height/datay)
+    nSlices = nSlicesPerRow * nRows
+    if shape[2] > nSlices * channels:
+        raise ValueError("A %d x %d x %d volume does not fit in a %d x %d x %d texture, "
+                         "which holds %d levels" % (tuple(shape[:3]) + (width, height, channels,
+                                                                        nSlices * channels)))
+
+    return {"width": width,
+            "height": height,
+            "channels": channels,
+            "dataShape": (datax, datay, shape[2]),
+            "nSlicesPerRow": nSlicesPerRow,
+            "maxRow": nRows - 1,
+            "nSlices": nSlices,
+            "texLevels": nSlices * channels}
+
+
+def planTexture(shape, channels=(3, 4), padxy=True, max_size=MAX_TEXTURE_SIZE):
+    """
+    Picks the smallest texture a volume fits in, for tileArray. The
+    texture is square and a power of two on each side, as the shadow
+    engines need, and of the fewest bytes: e.g. an RGBA texture holds
+    a third more levels than an RGB one, so can be half the size on
+    each side when an RGB one would only just overflow.
+
+    Args:
+        * shape (3-tuple): x, y, z shape of the volume
+        * channels (list): the numbers of channels to choose from,
+            3 (RGB) and/or 4 (RGBA)
+        * padxy (bool): whether the tiles are padded
+        * max_size (int): largest width and height to use
+
+    Returns the texture's layout, see textureLayout
+
+    Raises ValueError if the volume does not fit in a max_size texture
+
+    """
+    size = 1
+    while size <= max_size:
+        # a size up is at least 4 times the bytes, so the fewest channels
+        # at the smallest size that fits is the fewest bytes
+        for nchannels in sorted(channels):
+            try:
+                return textureLayout(shape, size, size, nchannels, padxy)
+            except ValueError:
+                pass
+        size *= 2
+
+    raise ValueError("A %d x %d x %d volume does not fit in a %d x %d texture with %s channels" %
+                     (tuple(shape[:3]) + (max_size, max_size, " or ".join(str(c) for c in channels))))
+
+
+def planProfileTexture(profile, lod_factor=1):
+    """
+    The texture layout of a profile's images at a level of detail,
+    whose volumes are 1/lod_factor of profile.regrid_shape. With
+    profile.texture_plan, the smallest texture they fit in (see
+    planTexture), otherwise an RGB texture of the profile's field size.
+
+    Args:
+        * profile (namespace): see config.profiles
+        * lod_factor (int): downsampling factor of the level of detail
+
+    """
+    shape = [n // lod_factor for n in profile.regrid_shape]
+    if profile.texture_plan:
+        return planTexture(shape, profile.texture_channels)
+    return textureLayout(shape, profile.field_width // lod_factor,
+                         profile.field_height // lod_factor)
+
+
+def tileArray(a, maxx, maxy, maxz=3, padxy=True, out=None):
     """
     Flattens an x,y,z 3D array into an array of x,y tiles
     
@@ -21,50 +135,203 @@ def tileArray(a, maxx, maxy, maxz=3, padxy=True):
         * a (numpy array): a 3d numpy array of data
         * max<xyz> (int): the limits of the image size in pixels.
             NB that maxz is either 1 (Grayscale), 3 (RGB) or 4 (RGBA)
+        * padxy (bool): surround each tile with a border of zeros
+        * out (numpy array): optional maxy x maxx x maxz uint8 array
+            to write the tiles into
         
-    This could be made more efficient using stride tricks
-    
+    Returns a maxy x maxx x maxz uint8 array. The data is written
+    tile row by tile row straight into the output through a strided
+    view, so no intermediate arrays are made. Raises ValueError if
+    the levels of a do not all fit (see planTexture).
+
     """
 
     if type(a) is not np.ndarray:
         raise ValueError("a must be a np.Array, not a %s" % type(a))
-    
-    if padxy:
-        padded_a = np.zeros([a.shape[0]+2, a.shape[1]+2, a.shape[2]])
-        padded_a[1:-1, 1:-1, :] = a
+
+    is_pot = lambda n: ((n & (n - 1)) == 0) and n != 0
+    if (not is_pot(maxy) or not is_pot(maxx)):
+        raise ValueError("Dimensions for a texture must be power of two")
+    # raises if the levels do not all fit
+    layout = textureLayout(a.shape, maxx, maxy, maxz, padxy)
+
+    if out is None:
+        out = np.zeros([maxy, maxx, maxz], dtype=np.uint8)
+    elif out.shape != (maxy, maxx, maxz) or out.dtype != np.uint8:
+        raise ValueError("out must be a %d x %d x %d uint8 array" % (maxy, maxx, maxz))
     else:
-        padded_a = a
-    tiled_array = np.zeros([maxx, maxy, maxz])
-    datax, datay, dataz = padded_a.shape
+        out[...] = 0
+
+    pad = 1 if padxy else 0
+    datax, datay, dataz = layout["dataShape"]
+    maxitiles = layout["nSlicesPerRow"]
+    maxjtiles = layout["maxRow"] + 1
+    tilesperlayer = layout["nSlices"]
+
+    tiles = _tileView(out, datax, datay, maxitiles, maxjtiles)
+    tiles = tiles[..., pad:datax-pad, pad:datay-pad]
+    zslices = a.transpose([2, 0, 1])
+    for ztile in range(maxz):
+        z0 = ztile * tilesperlayer
+        nz = min(tilesperlayer, dataz - z0)
+        if nz <= 0:
+            break
+        nrows, ncols = divmod(nz, maxitiles)
+        # whole rows of tiles at once, then any partial row
+        tiles[ztile, :nrows] = zslices[z0:z0+nrows*maxitiles].reshape(
+            nrows, maxitiles, a.shape[0], a.shape[1])
+        if ncols:
+            tiles[ztile, nrows, :ncols] = zslices[z0+nrows*maxitiles:z0+nz]
+
+    return out
+
+
+def untileArray(tiled, shape, padxy=True):
+    """
+    The inverse of tileArray. Recovers the x,y,z 3D array from
+    an array of x,y tiles
+
+    Args:
+        * tiled (numpy array): a tiled array, as returned by tileArray
+        * shape (3-tuple): the shape of the original 3d array
+        * padxy (bool): whether the tiles were padded
+
+    Returns an x, y, z array. This is a view of tiled when the levels
+    fit in the first row of tiles of the first channel, otherwise a
+    copy of the channels which hold them.
+
+    """
+    maxy, maxx, maxz = tiled.shape
+    pad = 1 if padxy else 0
+    datax, datay, dataz = shape[0] + 2*pad, shape[1] + 2*pad, shape[2]
     maxitiles = int(maxx/datax)
     maxjtiles = int(maxy/datay)
-    tilesperlayer = maxitiles * maxjtiles
+    tilesperlayer = maxitiles*maxjtiles
 
-    for zslice in range(dataz):
-        ztile = np.floor(zslice/tilesperlayer)
-        ytile = np.floor((zslice - (ztile * tilesperlayer)) / maxitiles)
-        xtile = np.mod(zslice - (ztile * tilesperlayer), maxitiles)
-        
+    tiles = _tileView(tiled, datax, datay, maxitiles, maxjtiles)
+    tiles = tiles[..., pad:datax-pad, pad:datay-pad]
+    if dataz <= maxitiles:
+        # tile column, x, y -> x, y, tile column
+        return tiles[0, 0, :dataz].transpose([1, 2, 0])
+
+    nchannels = -(-dataz // tilesperlayer)
+    # channel, tile row, tile column, x, y -> x, y, channel, tile row, tile column
+    volume = tiles[:nchannels].transpose([3, 4, 0, 1, 2])
+    volume = volume.reshape(shape[0], shape[1], nchannels*tilesperlayer)
+
+    return volume[..., :dataz]
+
+    
+def filterRows(rows, nchannels, filter_type=0):
+    """
+    Applies a png filter to every row of an image, and prefixes each
+    row with its filter type byte.
+
+    args:
+        * rows: height x (width * nchannels) uint8 array
+        * nchannels: bytes per pixel
+        * filter_type: 0 (None), 1 (Sub), 2 (Up), 3 (Average) or 4 (Paeth)
+
+    Returns a height x (1 + width * nchannels) uint8 array
+
+    """
+    x = rows.astype(np.int16)
+    # a is the byte to the left, b the byte above, c the byte above left
+    a = np.zeros_like(x)
+    a[:, nchannels:] = x[:, :-nchannels]
+    b = np.zeros_like(x)
+    b[1:] = x[:-1]
+
+    if filter_type == 0:
+        filtered = x
+    elif filter_type == 1:
+        filtered = x - a
+    elif filter_type == 2:
+        filtered = x - b
+    elif filter_type == 3:
+        filtered = x - ((a + b) >> 1)
+    elif filter_type == 4:
+        c = np.zeros_like(x)
+        c[1:] = a[:-1]
+        p = a + b - c
+        pa = np.abs(p - a)
+        pb = np.abs(p - b)
+        pc = np.abs(p - c)
+        pred = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+        filtered = x - pred
+    else:
+        raise ValueError("Unknown png filter type %s" % filter_type)
+
+    out = np.empty([rows.shape[0], rows.shape[1] + 1], dtype=np.uint8)
+    out[:, 0] = filter_type
+    out[:, 1:] = filtered.astype(np.uint8)
+    return out
+
+
+def _compressBand(args):
+    band, compression, strategy, last = args
+    compressor = zlib.compressobj(compression, zlib.DEFLATED, -zlib.MAX_WBITS, 8, strategy)
+    data = compressor.compress(band)
+    # a sync flush leaves the raw deflate stream byte aligned so that bands
+    # can be concatenated, only the last band marks the end of the stream
+    data += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return data
+
+
+def deflateBands(data, compression=6, strategy=zlib.Z_DEFAULT_STRATEGY, threads=1):
+    """
+    Compresses a filtered image into a zlib stream. With more than
+    one thread, bands of rows are compressed in parallel and joined
+    into a single stream.
+
+    args:
+        * data: height x row bytes uint8 array
+        * compression: zlib compression level, 0-9
+        * strategy: zlib strategy, e.g. zlib.Z_FILTERED or zlib.Z_RLE
+        * threads: number of bands to compress in parallel
+
+    """
+    bands = [band.tobytes() for band in np.array_split(data, max(1, min(threads, data.shape[0])))]
+    jobs = [(band, compression, strategy, i == len(bands) - 1) for i, band in enumerate(bands)]
+    if len(jobs) == 1:
+        deflated = [_compressBand(jobs[0])]
+    else:
+        pool = ThreadPool(len(jobs))
         try:
-            tiled_array[xtile*datax:(xtile+1)*datax,
-                     ytile*datay:(ytile+1)*datay,
-                     ztile] = padded_a[:, :, zslice]
-        except IndexError:
-            print "Output array saturated at slice", zslice
-            break
+            deflated = pool.map(_compressBand, jobs)
+        finally:
+            pool.close()
+            pool.join()
 
-    # swap from row major to column (or vice versa, not sure which way round this is!)
-    tiled_array = tiled_array.transpose([1, 0, 2])
+    adler = 1
+    for band in bands:
+        adler = zlib.adler32(band, adler)
 
-    is_pot = lambda n: ((n & (n - 1)) == 0) and n != 0
-    if (not is_pot(tiled_array.shape[0]) or not is_pot(tiled_array.shape[1])):
-        raise ValueError("Dimensions for a texture must be power of two")
+    if compression in (0, 1) or strategy >= zlib.Z_HUFFMAN_ONLY:
+        flevel = 0
+    elif compression < 6 and compression >= 0:
+        flevel = 1
+    elif compression in (6, -1):
+        flevel = 2
+    else:
+        flevel = 3
+    cmf = 0x78
+    flg = flevel << 6
+    flg += 31 - (cmf * 256 + flg) % 31
 
-    # revese first axis to be compatible with textures which read from top left
-    return tiled_array[::-1, ...]
+    return struct.pack(">BB", cmf, flg) + b"".join(deflated) + struct.pack(">I", adler & 0xffffffff)
 
-    
-def writePng(array, f, height, width, nchannels=3, alpha="RGB"):
+
+def _pngChunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def writePng(array, f, height, width, nchannels=3, alpha=False,
+             compression=6,
+             filter_type=0,
+             strategy=zlib.Z_DEFAULT_STRATEGY,
+             threads=1):
     """
     Writes a tiled array to a png image
 
@@ -74,9 +341,109 @@ def writePng(array, f, height, width, nchannels=3, alpha="RGB"):
         * height/width: the height/width of the image.
             Must be a power of two number for use with WebGL
             textures. Need not be equal to each other.
+        * nchannels: 1 (Grayscale), 2 (Grayscale + alpha), 3 (RGB) or 4 (RGBA)
+        * alpha: the array also has an alpha channel, e.g. nchannels=3
+            and alpha=True is the same as nchannels=4
+        * compression: zlib compression level, 0-9
+        * filter_type: png row filter, see filterRows
+        * strategy: zlib strategy, e.g. zlib.Z_FILTERED or zlib.Z_RLE
+        * threads: number of row bands to compress in parallel
 
     """
-    
-    png_writer = png.Writer(height=height, width=width, bitdepth=8, alpha=alpha, colormap=True)
-    flat_array = array.reshape(-1, width*nchannels)
-    png_writer.write(f, flat_array)
\ No newline at end of file
+    if alpha and nchannels in (1, 3):
+        nchannels += 1
+    colour_types = {1: 0, 2: 4, 3: 2, 4: 6}
+    if nchannels not in colour_types:
+        raise ValueError("nchannels must be 1, 2, 3 or 4, not %s" % nchannels)
+
+    rows = np.ascontiguousarray(array, dtype=np.uint8).reshape(height, width*nchannels)
+    idat = deflateBands(filterRows(rows, nchannels, filter_type),
+                        compression=compression,
+                        strategy=strategy,
+                        threads=threads)
+
+    f.write(b"\x89PNG\r\n\x1a\n")
+    f.write(_pngChunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8,
+                                          colour_types[nchannels], 0, 0, 0)))
+    chunk_limit = 2**20
+    for start in range(0, len(idat), chunk_limit):
+        f.write(_pngChunk(b"IDAT", idat[start:start+chunk_limit]))
+    f.write(_pngChunk(b"IEND", b""))
+
+
+DELTA_MAGIC = b"TDLT"
+DELTA_HEADER = ">4sBIIBHI"
+
+
+def _blockView(frame, block_size):
+    """
+    Returns a view of a height x width x channels array indexed by
+    [block row, block column, y, x, channel].
+
+    """
+    height, width, nchannels = frame.shape
+    if height % block_size or width % block_size:
+        raise ValueError("Image size %s x %s is not a multiple of the block size %s" %
+                         (height, width, block_size))
+    view = frame.reshape(height // block_size, block_size, width // block_size, block_size, nchannels)
+    return view.transpose([0, 2, 1, 3, 4])
+
+
+def encodeDelta(previous, frame, block_size=32, compression=6):
+    """
+    Encodes the blocks of a tiled image which differ from the previous
+    image, so a client holding the previous image can rebuild this one
+    (see applyDelta).
+
+    The delta is a header (magic, version, height, width, channels,
+    block size and number of changed blocks), the big endian uint32
+    indices of the changed blocks in row major order, and then the
+    zlib compressed bytes of each changed block, as y x channel arrays.
+
+    args:
+        * previous, frame: height x width x channels uint8 arrays
+        * block_size: size in pixels of the square blocks compared
+        * compression: zlib compression level, 0-9
+
+    Returns bytes
+
+    """
+    if previous.shape != frame.shape:
+        raise ValueError("Cannot take a delta between %s and %s images" % (previous.shape, frame.shape))
+    height, width, nchannels = frame.shape
+    blocks = _blockView(frame, block_size)
+    changed = np.any(blocks != _blockView(previous, block_size), axis=(2, 3, 4))
+    rows, cols = np.nonzero(changed)
+
+    header = struct.pack(DELTA_HEADER, DELTA_MAGIC, 1, height, width, nchannels,
+                         block_size, len(rows))
+    indices = (rows * changed.shape[1] + cols).astype(">u4")
+    data = zlib.compress(np.ascontiguousarray(blocks[rows, cols]).tobytes(), compression)
+
+    return header + indices.tobytes() + data
+
+
+def applyDelta(previous, delta):
+    """
+    Rebuilds an image from the previous image and a delta made
+    by encodeDelta.
+
+    Returns a height x width x channels uint8 array
+
+    """
+    header_size = struct.calcsize(DELTA_HEADER)
+    magic, version, height, width, nchannels, block_size, nchanged = struct.unpack(
+        DELTA_HEADER, delta[:header_size])
+    if magic != DELTA_MAGIC or version != 1:
+        raise ValueError("Not a version 1 delta")
+    if previous.shape != (height, width, nchannels):
+        raise ValueError("Delta is for a %s x %s x %s image" % (height, width, nchannels))
+
+    indices = np.frombuffer(delta[header_size:header_size + 4*nchanged], dtype=">u4")
+    data = np.frombuffer(zlib.decompress(delta[header_size + 4*nchanged:]), dtype=np.uint8)
+    frame = previous.copy()
+    blocks = _blockView(frame, block_size)
+    rows, cols = indices // (width // block_size), indices % (width // block_size)
+    blocks[rows, cols] = data.reshape(nchanged, block_size, block_size, nchannels)
+
+    return frame
@@ -1,16 +1,26 @@
 #!/usr/bin/env python
 
 import argparse as ap
-import iris
 import logging
-import subprocess as sp
+import logging.handlers
+import multiprocessing as mp
+import signal
+import threading
 import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 from watchdog.observers import Observer  
 from watchdog.events import PatternMatchingEventHandler 
 
 import sys
 sys.path.append(".")
 import config
+import intake
+import jobqueue
+import metrics
+import workerpool
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -19,6 +29,67 @@ handler.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
+logging.getLogger("workerpool").addHandler(handler)
+logging.getLogger("intake").addHandler(handler)
+logging.getLogger("jobqueue").addHandler(handler)
+
+# files detected but not yet started, by path, with the time they were detected
+pending = {}
+pending_lock = threading.Lock()
+in_progress = set()
+# job start and finish events, and their metrics, sent by the workers
+events = mp.Queue()
+
+
+def warmUp():
+    """
+    Imports the processing modules once in each worker,
+    rather than once per file.
+
+    """
+    import serveupimage
+
+
+def processFile(data_file, profilename):
+    import serveupimage
+    events.put(("started", data_file, None))
+    try:
+        logger.info("Processing " + data_file)
+        summary = serveupimage.processFile(data_file, profilename)
+        logger.info("Finished %s, posts: %s" % (data_file, summary))
+    finally:
+        events.put(("finished", data_file, metrics.drain()))
+
+
+def updateMetrics():
+    """
+    Collects the events and metrics sent by the workers, and updates
+    the queue depth, oldest pending file age and files in progress.
+
+    """
+    while True:
+        try:
+            event, data_file, snapshot = events.get(block=False)
+        except queue.Empty:
+            break
+        with pending_lock:
+            if event == "started":
+                pending.pop(data_file, None)
+                in_progress.add(data_file)
+            else:
+                in_progress.discard(data_file)
+        if snapshot is not None:
+            metrics.merge(snapshot)
+
+    with pending_lock:
+        oldest = min(pending.values()) if pending else None
+        metrics.setGauge("queue_depth", len(pending))
+        metrics.setGauge("files_in_progress", len(in_progress))
+    metrics.setGauge("oldest_pending_seconds", time.time() - oldest if oldest is not None else 0)
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
 
 
 if __name__ == '__main__':
@@ -28,24 +99,70 @@ if __name__ == '__main__':
 
     """
     class MyHandler(PatternMatchingEventHandler):
+        """
+        Records new and changed files with the intake, which submits
+        them once they have finished writing.
+
+        """
+        def detected(self, path):
+            if files.add(path):
+                logger.info("------------------------------------")
+                logger.info(path + " detected")
+                with pending_lock:
+                    pending.setdefault(path, time.time())
+
+        def on_created(self, event):
+            self.detected(event.src_path)
+
+        def on_modified(self, event):
+            self.detected(event.src_path)
 
         def on_moved(self, event):
-            logger.info("------------------------------------")
-            logger.info(event.dest_path + " detected")
-            time.sleep(3)
-            try:
-                logger.info("Submitting " + event.dest_path)
-                sp.Popen(["./serveupimage.py", "--profile", call_args.profile, event.dest_path])
-            except KeyboardInterrupt:
-                raise
-            except BaseException as e:
-                logger.exception(e)
-
-    
+            self.detected(event.dest_path)
+
+    def submit(path):
+        if jobs is None:
+            logger.info("Submitting " + path)
+            pool.submit(path, call_args.profile)
+            return
+        # the workers are on other nodes, see jobqueue.py
+        if jobs.enqueue(path, call_args.profile, jobqueue.fileVersion(path)):
+            logger.info("Enqueued " + path)
+        drop(path)
+
+    def drop(path):
+        with pending_lock:
+            pending.pop(path, None)
+
     argparser = ap.ArgumentParser()
     argparser.add_argument("-a", "--profile", default="default",
         type=str, help="Name of analysis settings, as defined in config.py")
+    argparser.add_argument("-w", "--workers", default=config.workers,
+        type=int, help="Number of worker processes")
+    argparser.add_argument("-q", "--queue-size", default=config.queue_size,
+        type=int, help="Maximum number of files waiting to be processed")
+    argparser.add_argument("-m", "--metrics-file", default=config.metrics_file,
+        type=str, help="File to export metrics to")
+    argparser.add_argument("-f", "--metrics-format", default=config.metrics_format,
+        choices=["prometheus", "jsonl"], help="Prometheus text file or JSON lines")
+    argparser.add_argument("-j", "--job-queue", default=None,
+        type=str, help="Shared job queue database to enqueue files in, for workers "
+                       "on any node to process (see jobqueue.py), rather than local workers")
     call_args = argparser.parse_args()
+    metrics.setLabels(profile=call_args.profile)
+
+    if call_args.job_queue is not None:
+        # the files are processed by jobqueue.py workers, not by a local pool
+        jobs = jobqueue.JobQueue(call_args.job_queue)
+        pool = None
+    else:
+        jobs = None
+        pool = workerpool.WorkerPool(processFile,
+                                     processes=call_args.workers,
+                                     maxsize=call_args.queue_size,
+                                     initializer=warmUp).start()
+    signal.signal(signal.SIGTERM, stop)
+    files = intake.FileIntake(submit, drop).start()
 
     observer = Observer()
     observer.schedule(MyHandler(patterns=[config.source_files],
@@ -55,11 +172,29 @@ if __name__ == '__main__':
 
     logger.info("******* Image Service started *******")
 
+    last_export = time.time()
     try:
         while True:
             time.sleep(1)
+            if pool is not None:
+                pool.checkWorkers()
+            updateMetrics()
+            if jobs is not None:
+                metrics.setGauge("job_queue_depth", jobs.counts().get("queued", 0))
+            if time.time() - last_export > config.metrics_interval:
+                metrics.export(call_args.metrics_file, call_args.metrics_format)
+                last_export = time.time()
     except KeyboardInterrupt:
-        logger.info("******* Image Service stopped *******")
+        if pool is not None:
+            logger.info("******* Image Service stopping, draining %s queued files *******" % pool.qsize())
+        else:
+            logger.info("******* Image Service stopping *******")
         observer.stop()
     observer.join()
+    files.stop()
+    if pool is not None:
+        pool.drain()
+    updateMetrics()
+    metrics.export(call_args.metrics_file, call_args.metrics_format)
+    logger.info("******* Image Service stopped *******")
 
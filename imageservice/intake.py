@@ -0,0 +1,182 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+import sys
+sys.path.append(".")
+import config as conf
+
+"""
+intake.py decides when a newly published file is ready to process.
+Used by imageservice.py, whose watchdog handler only records events
+here, so that it never blocks waiting for a file to finish writing.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# the first bytes of classic (CDF1, CDF2 and CDF5) and netCDF-4 (HDF5) files
+NETCDF_SIGNATURES = [b"CDF\x01", b"CDF\x02", b"CDF\x05", b"\x89HDF\r\n\x1a\n"]
+
+
+def hasNetcdfHeader(path):
+    """
+    Whether a file starts with a netCDF signature, i.e. its header
+    has been written.
+
+    """
+    try:
+        with open(path, "rb") as f:
+            start = f.read(8)
+    except (IOError, OSError):
+        return False
+    return any(start.startswith(signature) for signature in NETCDF_SIGNATURES)
+
+
+class FileIntake(object):
+    """
+    Collects file events and hands each file on once it has stopped
+    changing: its size and modification time must be the same for
+    settle seconds (and, with check_header, it must have a netCDF
+    header). Files are checked every poll seconds on a thread of the
+    intake's own, so a slow file does not hold up the ones behind it.
+
+    Repeated events for a file that is waiting are merged, and events
+    for a file that has already been handed on are ignored unless it
+    has changed since.
+
+    Args:
+        * ready (callable): called with the path of each finished
+            file, e.g. WorkerPool.submit
+        * dropped (callable): called with the path of each file which
+            is dropped rather than handed on, see check
+        * settle (float): seconds a file must be unchanged
+        * poll (float): seconds between checks
+        * check_header (bool): also wait for a netCDF header
+        * history (int): number of handed on files remembered
+
+    """
+    def __init__(self, ready, dropped=None,
+                 settle=conf.intake_settle,
+                 poll=conf.intake_poll,
+                 check_header=conf.intake_check_header,
+                 history=1000):
+        self.ready = ready
+        self.dropped = dropped
+        self.settle = settle
+        self.poll = poll
+        self.check_header = check_header
+        self.history = history
+        # waiting files by path: last seen size and mtime, and since when
+        self.waiting = {}
+        # (size, mtime) of files handed on, oldest first
+        self.handed_on = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def add(self, path):
+        """
+        Records an event for a file. Never blocks.
+
+        returns True if the file is new, False if it was already waiting
+        or has been handed on unchanged
+
+        """
+        with self.lock:
+            if path in self.waiting:
+                return False
+            stat = self._stat(path)
+            if stat is not None and self.handed_on.get(path) == stat:
+                return False
+            self.waiting[path] = (stat, time.time())
+            return True
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def check(self, now=None):
+        """
+        Checks the waiting files once.
+
+        returns the paths of the files which are ready, oldest first,
+        and the paths of the files dropped because they have been
+        removed or have had no netCDF header for 10 x settle seconds.
+        Neither are waiting any more.
+
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            waiting = list(self.waiting.items())
+
+        finished = []
+        gone = []
+        for path, (last, since) in waiting:
+            stat = self._stat(path)
+            if stat != last:
+                # still being written, start again
+                with self.lock:
+                    self.waiting[path] = (stat, now)
+            elif now - since < self.settle:
+                continue
+            elif stat is None:
+                gone.append((path, "was removed before it finished"))
+            elif not self.check_header or hasNetcdfHeader(path):
+                finished.append((since, path, stat))
+            elif now - since >= 10 * self.settle:
+                gone.append((path, "is not a netCDF file"))
+
+        ready = []
+        dropped = []
+        with self.lock:
+            for path, reason in gone:
+                logger.warning("Skipping %s, which %s" % (path, reason))
+                del self.waiting[path]
+                dropped.append(path)
+            for _, path, stat in sorted(finished):
+                del self.waiting[path]
+                self.handed_on.pop(path, None)
+                self.handed_on[path] = stat
+                ready.append(path)
+            while len(self.handed_on) > self.history:
+                self.handed_on.popitem(last=False)
+
+        return ready, dropped
+
+    def _run(self):
+        while not self.stopping.wait(self.poll):
+            ready, dropped = self.check()
+            if self.dropped is not None:
+                for path in dropped:
+                    self.dropped(path)
+            for path in ready:
+                try:
+                    self.ready(path)
+                except Exception as e:
+                    logger.exception(e)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def qsize(self):
+        """
+        Number of files waiting to finish.
+
+        """
+        with self.lock:
+            return len(self.waiting)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+import argparse as ap
+import collections
+import logging
+import multiprocessing as mp
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+
+import sys
+sys.path.append(".")
+import config as conf
+
+"""
+jobqueue.py contains a job queue shared by several nodes, kept in an
+SQLite database on a shared disk. The image service's watcher enqueues
+files (see imageservice.py --job-queue), and workers on any node claim
+them with a lease, which they renew while they work:
+
+    ./jobqueue.py --job-queue /shared/imageservice.sqlite --workers 4
+
+A job whose lease runs out (e.g. its node died) is claimed again by
+another worker, up to conf.job_attempts times in all.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+Job = collections.namedtuple("Job", ["id", "path", "profile", "attempts"])
+
+_schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    version TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_expires REAL,
+    enqueued REAL NOT NULL,
+    finished REAL,
+    error TEXT,
+    UNIQUE (path, profile, version)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, enqueued);
+"""
+
+
+def fileVersion(path):
+    """
+    Identifies the contents of a file by its size and mtime, so that a
+    file which is published again is processed again.
+
+    """
+    st = os.stat(path)
+    return "%d-%r" % (st.st_size, st.st_mtime)
+
+
+def workerName():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+class JobQueue(object):
+    """
+    Jobs move from queued to running (claimed with a lease) to done,
+    or to failed once max_attempts claims have not completed. Every
+    change is made in one transaction, so a job is only ever held by
+    one worker at a time, and a file is enqueued once per version
+    however many watchers see it.
+
+    Each process should open its own JobQueue, which can be shared by
+    its threads.
+
+    Args:
+        * path (str): SQLite database, created if needed
+        * max_attempts (int): claims of a job before it fails
+        * timeout (float): seconds to wait for another node's transaction
+
+    """
+    def __init__(self, path, max_attempts=conf.job_attempts, timeout=30):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # transactions are begun explicitly, see _transaction
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.executescript(_schema)
+
+    def _transaction(self, sql, *args):
+        """
+        Runs a function of the cursor (or a single statement) in one
+        write transaction, returning its result.
+
+        """
+        with self.lock:
+            cursor = self.db.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                if callable(sql):
+                    result = sql(cursor)
+                else:
+                    cursor.execute(sql, args)
+                    result = cursor.rowcount
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+        return result
+
+    def enqueue(self, path, profile, version=""):
+        """
+        Adds a job, unless the same version of the file has already
+        been enqueued for the profile.
+
+        returns True if the job was added
+
+        """
+        return self._transaction("INSERT OR IGNORE INTO jobs (path, profile, version, state, enqueued) "
+                                 "VALUES (?, ?, ?, 'queued', ?)",
+                                 path, profile, version, time.time()) == 1
+
+    def claim(self, owner, lease=conf.job_lease):
+        """
+        Takes the oldest queued job, or a running job whose lease has
+        expired, for lease seconds.
+
+        returns a Job, or None if there are none to claim
+
+        """
+        def claim(cursor):
+            now = time.time()
+            while True:
+                cursor.execute("SELECT id, path, profile, attempts FROM jobs "
+                               "WHERE state = 'queued' OR (state = 'running' AND lease_expires < ?) "
+                               "ORDER BY enqueued LIMIT 1", (now,))
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                job = Job(*row)
+                if job.attempts >= self.max_attempts:
+                    logger.warning("Giving up on %s after %d attempts" % (job.path, job.attempts))
+                    cursor.execute("UPDATE jobs SET state = 'failed', owner = NULL, finished = ?, "
+                                   "error = coalesce(error, 'lease expired') WHERE id = ?", (now, job.id))
+                    continue
+                cursor.execute("UPDATE jobs SET state = 'running', owner = ?, lease_expires = ?, "
+                               "attempts = attempts + 1 WHERE id = ?", (owner, now + lease, job.id))
+                return job._replace(attempts=job.attempts + 1)
+
+        return self._transaction(claim)
+
+    def heartbeat(self, job, owner, lease=conf.job_lease):
+        """
+        Renews a lease for another lease seconds.
+
+        returns False if the lease has been lost (it expired and the job
+        was claimed by another worker)
+
+        """
+        return self._transaction("UPDATE jobs SET lease_expires = ? "
+                                 "WHERE id = ? AND owner = ? AND state = 'running'",
+                                 time.time() + lease, job.id, owner) == 1
+
+    def complete(self, job, owner):
+        """
+        Marks a job done.
+
+        returns False if the lease had been lost
+
+        """
+        return self._transaction("UPDATE jobs SET state = 'done', owner = NULL, finished = ? "
+                                 "WHERE id = ? AND owner = ? AND state = 'running'",
+                                 time.time(), job.id, owner) == 1
+
+    def fail(self, job, owner, error):
+        """
+        Releases a job which raised an error, to be retried unless it
+        has used up its attempts.
+
+        """
+        state = "failed" if job.attempts >= self.max_attempts else "queued"
+        return self._transaction("UPDATE jobs SET state = ?, owner = NULL, error = ?, finished = ? "
+                                 "WHERE id = ? AND owner = ? AND state = 'running'",
+                                 state, str(error), time.time(), job.id, owner) == 1
+
+    def counts(self):
+        """
+        Number of jobs in each state.
+
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT state, count(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+    def close(self):
+        self.db.close()
+
+
+class _Heartbeat(object):
+    """
+    Renews a job's lease in the background while it is processed.
+
+    """
+    def __init__(self, jobs, job, owner, lease, interval):
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._beat,
+                                       args=(jobs, job, owner, lease, interval))
+        self.thread.daemon = True
+
+    def _beat(self, jobs, job, owner, lease, interval):
+        while not self.stopping.wait(interval):
+            if not jobs.heartbeat(job, owner, lease):
+                logger.warning("Lost the lease on %s" % job.path)
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopping.set()
+        self.thread.join()
+
+
+def work(queue_path, target, stopping=None, lease=conf.job_lease,
+         heartbeat=conf.job_heartbeat, poll=conf.job_poll, once=False):
+    """
+    Claims and processes jobs until stopping is set (or, with once,
+    until there are none left).
+
+    Args:
+        * queue_path (str): the JobQueue database
+        * target (callable): called with the path and profile of each job
+        * stopping (mp.Event): set to stop after the current job
+        * lease (float): seconds a claim lasts without a heartbeat
+        * heartbeat (float): seconds between lease renewals
+        * poll (float): seconds to wait when there are no jobs
+        * once (bool): return when there are no jobs to claim
+
+    """
+    jobs = JobQueue(queue_path)
+    owner = workerName()
+    while stopping is None or not stopping.is_set():
+        job = jobs.claim(owner, lease)
+        if job is None:
+            if once:
+                break
+            time.sleep(poll)
+            continue
+
+        logger.info("%s claimed %s (attempt %d)" % (owner, job.path, job.attempts))
+        try:
+            with _Heartbeat(jobs, job, owner, lease, heartbeat):
+                target(job.path, job.profile)
+        except Exception as e:
+            logger.exception(e)
+            jobs.fail(job, owner, e)
+        else:
+            if not jobs.complete(job, owner):
+                logger.warning("%s finished %s after its lease was lost" % (owner, job.path))
+    jobs.close()
+
+
+def processFile(data_file, profilename):
+    import serveupimage
+    summary = serveupimage.processFile(data_file, profilename)
+    logger.info("Finished %s, posts: %s" % (data_file, summary))
+
+
+def _work(queue_path, stopping):
+    # interrupts are handled by the parent, which sets stopping
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import serveupimage
+    work(queue_path, processFile, stopping)
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+    argparser = ap.ArgumentParser()
+    argparser.add_argument("-j", "--job-queue", required=True,
+        type=str, help="Shared job queue database")
+    argparser.add_argument("-w", "--workers", default=conf.workers,
+        type=int, help="Number of worker processes on this node")
+    call_args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    stopping = mp.Event()
+    workers = [mp.Process(target=_work, args=(call_args.job_queue, stopping))
+               for _ in range(call_args.workers)]
+    for worker in workers:
+        worker.start()
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        while True:
+            time.sleep(1)
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logger.warning("Worker %s exited with %s, restarting" % (worker.pid, worker.exitcode))
+                    workers[i] = mp.Process(target=_work, args=(call_args.job_queue, stopping))
+                    workers[i].start()
+    except KeyboardInterrupt:
+        logger.info("Stopping after the current jobs")
+        stopping.set()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,193 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+
+"""
+metrics.py keeps cheap per-stage counters (calls, time, bytes and memory
+growth) for the processing functions, and writes them out for monitoring,
+either as a Prometheus text file or as JSON lines.
+
+Counters are kept per process. Worker processes send theirs to the image
+service with drain, where they are combined with merge and exported.
+
+"""
+
+# stage, labels -> counters
+_stages = {}
+# name, labels -> value
+_gauges = {}
+# labels added to everything recorded in this process, e.g. the profile
+_labels = {}
+_lock = threading.Lock()
+
+
+def setLabels(**labels):
+    """
+    Sets the labels (e.g. profile="ukv") of everything recorded
+    from now on in this process.
+
+    """
+    _labels.clear()
+    _labels.update(labels)
+
+
+def _key(name):
+    return name, tuple(sorted(_labels.items()))
+
+
+def _counters(key):
+    if key not in _stages:
+        _stages[key] = {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                        "bytes": 0, "max_rss_growth_bytes": 0}
+    return _stages[key]
+
+
+def maxRss():
+    """
+    The peak resident memory of this process so far, in bytes.
+
+    """
+    # ru_maxrss is in kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def record(stage, seconds, nbytes=0, rss_growth=0):
+    """
+    Records a call of a stage that took seconds and
+    handled nbytes, and raised the peak resident memory
+    of the process by rss_growth bytes.
+
+    """
+    with _lock:
+        counters = _counters(_key(stage))
+        counters["calls"] += 1
+        counters["seconds"] += seconds
+        counters["max_seconds"] = max(counters["max_seconds"], seconds)
+        counters["bytes"] += nbytes
+        counters["max_rss_growth_bytes"] = max(counters["max_rss_growth_bytes"], rss_growth)
+
+
+def addBytes(stage, nbytes):
+    """
+    Adds to the bytes handled by a stage, without counting a call.
+
+    """
+    with _lock:
+        _counters(_key(stage))["bytes"] += nbytes
+
+
+def timed(stage):
+    """
+    Decorator which records the time taken by every call of a function,
+    and how far it raised the peak memory of the process. A call which
+    stays below the peak of an earlier one records no growth, so this
+    is a lower bound on the memory the stage needs.
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            start_rss = maxRss()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage, time.time() - start, rss_growth=maxRss() - start_rss)
+        return wrapper
+    return decorator
+
+
+def setGauge(name, value):
+    with _lock:
+        _gauges[_key(name)] = value
+
+
+def drain():
+    """
+    Returns the counters recorded in this process and resets them,
+    to be sent to another process and merged.
+
+    """
+    with _lock:
+        snapshot = dict(_stages)
+        _stages.clear()
+    return snapshot
+
+
+def merge(snapshot):
+    """
+    Adds counters from drain (e.g. from a worker process)
+    into this process's counters.
+
+    """
+    with _lock:
+        for key, other in snapshot.items():
+            counters = _counters(key)
+            for name in ("calls", "seconds", "bytes"):
+                counters[name] += other[name]
+            for name in ("max_seconds", "max_rss_growth_bytes"):
+                counters[name] = max(counters[name], other[name])
+
+
+def _formatLabels(labels):
+    return ",".join('%s="%s"' % (k, v) for k, v in labels)
+
+
+def prometheusText(prefix="imageservice"):
+    """
+    The counters and gauges in the Prometheus text exposition format.
+
+    """
+    lines = []
+    with _lock:
+        for name, kind in (("calls", "counter"), ("seconds", "counter"), ("max_seconds", "gauge"),
+                           ("bytes", "counter"), ("max_rss_growth_bytes", "gauge")):
+            metric = "%s_stage_%s" % (prefix, name)
+            if kind == "counter":
+                metric += "_total"
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for (stage, labels), counters in sorted(_stages.items()):
+                lines.append('%s{stage="%s"%s} %s' % (metric, stage,
+                             "," + _formatLabels(labels) if labels else "", counters[name]))
+        for (name, labels), value in sorted(_gauges.items()):
+            metric = "%s_%s" % (prefix, name)
+            lines.append("# TYPE %s gauge" % metric)
+            lines.append("%s{%s} %s" % (metric, _formatLabels(labels), value))
+
+    return "\n".join(lines) + "\n"
+
+
+def jsonLine():
+    """
+    The counters and gauges as a single line of JSON.
+
+    """
+    with _lock:
+        stages = [dict(counters, stage=stage, **dict(labels))
+                  for (stage, labels), counters in sorted(_stages.items())]
+        gauges = [dict(dict(labels), name=name, value=value)
+                  for (name, labels), value in sorted(_gauges.items())]
+
+    return json.dumps({"time": time.time(), "stages": stages, "gauges": gauges})
+
+
+def export(path, fmt="prometheus"):
+    """
+    Writes the metrics to path. Prometheus text files are replaced
+    atomically (for the node exporter textfile collector), JSON
+    lines are appended.
+
+    """
+    if fmt == "prometheus":
+        temp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(temp_path, "w") as f:
+            f.write(prometheusText())
+        os.rename(temp_path, path)
+    elif fmt == "jsonl":
+        with open(path, "a") as f:
+            f.write(jsonLine() + "\n")
+    else:
+        raise ValueError("Unknown metrics format %s" % fmt)
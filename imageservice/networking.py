@@ -1,12 +1,18 @@
+import io
 import iris
+import json
+import mimetypes
 import requests
-import tempfile
-import os
-import tempfile
+import requests.adapters
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 import sys
 sys.path.append(".")
+import encoders
 import imageproc
+import metrics
 import config as conf
 
 """
@@ -15,41 +21,332 @@ posting to the data service. Called by serveupimage.py
 
 """
 
-def getPostDict(cube, mime_type="image/png"):
+_default_client = None
+mimetypes.add_type("image/webp", ".webp")
+
+def getPostDict(cube, mime_type="image/png", light_positions=None,
+                lod_factors=None, lod_factor=1,
+                phenomenon="cloud_fraction_in_a_layer", texture_layout=None):
     """
     Converts relevant cube metadata into a dictionary of metadata which is compatable
     with the data service.
 
+    The phenomenon is the name the data service knows the cube's
+    field by, see the phenomena of config.profiles.
+
+    Images with more than one light list the light positions, in the
+    order of their shadows in the image. Images posted at more than one
+    level of detail give the downsampling factor of this level and all
+    of the levels, in the order they are posted.
+
+    Images in a planned texture (see imageproc.planTexture) give its
+    layout, which clients need to untile the data.
+
     """
     with iris.FUTURE.context(cell_datetime_objects=True):
         payload = {'forecast_reference_time': cube.coord("forecast_reference_time").cell(0).point.isoformat()+".000Z",
                    'forecast_time' : cube.coord("time").cell(0).point.isoformat()+".000Z",
-                   'phenomenon' : 'cloud_fraction_in_a_layer',#cube.var_name,
+                   'phenomenon' : phenomenon,
                    'mime_type' : mime_type,
                    'model' : 'uk_v'}#,
                    # 'data_dimensions': {'x': cube.shape[0], 'y': cube.shape[1], 'z': cube.shape[2]}}
+        if light_positions is not None and len(light_positions) > 1:
+            payload['light_positions'] = json.dumps([list(p) for p in light_positions])
+        if lod_factors is not None and len(lod_factors) > 1:
+            payload['lod_factor'] = lod_factor
+            payload['lod_factors'] = json.dumps(list(lod_factors))
+        if texture_layout is not None:
+            payload['texture_layout'] = json.dumps(texture_layout)
         return payload
 
 
-def postImage(img_data, data, field_width, field_height):
+@metrics.timed("encodeImage")
+def encodeImage(img_data, field_width, field_height,
+                compression=6, filter_type=0, threads=1, encoder=None):
+    """
+    Encodes a tiled image in memory, as a png unless another encoder
+    is given
+
+    Args:
+        * img_data(np.Array): Numpy array of i x j x channels, the data
+            and shadow fields side by side
+        * field_width, field_height (int): size of each field
+        * compression (int): zlib compression level of the png, 0-9
+        * filter_type (int): png row filter, see imageproc.filterRows
+        * threads (int): number of row bands to compress in parallel
+        * encoder: see encoders.makeEncoder, the post's mime_type
+            must be the encoder's
+
+    returns bytes
+    """
+    if img_data.shape[0] != field_height or img_data.shape[1] % field_width:
+        raise ValueError("Image of shape %s is not made of %d x %d fields" %
+                         (img_data.shape[:2], field_height, field_width))
+    if encoder is None:
+        encoder = encoders.PngEncoder(compression, filter_type, threads)
+    img = encoder.encode(img_data)
+    metrics.addBytes("encodeImage", len(img))
+    return img
+
+
+class DeltaEncoder(object):
+    """
+    Turns a sequence of images into keyframes and deltas, see
+    imageproc.encodeDelta. A keyframe is posted every keyframe_interval
+    images, and whenever a delta would be no smaller than the keyframe.
+
+    The post metadata of every image gains a frame_type, "key" or
+    "delta". Deltas also give the forecast_time of the image they
+    apply to (base_time) and of the last keyframe (keyframe_time), so
+    clients can rebuild full images by applying deltas to the keyframe
+    in order.
+
+    Args:
+        * keyframe_interval (int): images from one keyframe to the next
+        * block_size (int): size in pixels of the blocks compared
+        * compression (int): zlib compression level of the deltas
+
+    """
+    mime_type = "application/x-imageservice-delta"
+
+    def __init__(self, keyframe_interval, block_size=32, compression=6):
+        self.keyframe_interval = keyframe_interval
+        self.block_size = block_size
+        self.compression = compression
+        self.previous = None
+        self.previous_time = None
+        self.keyframe_time = None
+        self.since_keyframe = 0
+
+    @metrics.timed("deltaEncode")
+    def encode(self, frame, img, payload):
+        """
+        Chooses what to post for the next image.
+
+        Args:
+            * frame (np.Array): the image as a uint8 array, or None if
+                only the encoded image is available (e.g. from a cache)
+            * img (bytes): the encoded image, posted as a keyframe
+            * payload (dict): post metadata, see getPostDict
+
+        returns the bytes to post and their metadata
+
+        """
+        payload = dict(payload)
+        delta = None
+        if (frame is not None and self.previous is not None and
+                self.since_keyframe < self.keyframe_interval):
+            delta = imageproc.encodeDelta(self.previous, frame, self.block_size, self.compression)
+            if len(delta) >= len(img):
+                delta = None
+
+        if delta is None:
+            payload["frame_type"] = "key"
+            self.keyframe_time = payload["forecast_time"]
+            self.since_keyframe = 1
+            body = img
+        else:
+            payload.update({"frame_type": "delta",
+                            "mime_type": self.mime_type,
+                            "base_time": self.previous_time,
+                            "keyframe_time": self.keyframe_time})
+            self.since_keyframe += 1
+            body = delta
+        self.previous = frame
+        self.previous_time = payload["forecast_time"]
+        metrics.addBytes("deltaEncode", len(body))
+
+        return body, payload
+
+
+class UploadClient(object):
+    """
+    Posts images to the data service over a shared pool of keep-alive
+    connections, with timeouts and retries, recording the latency and
+    size of every post.
+
+    Args:
+        * url (str): the data service image destination
+        * concurrency (int): maximum number of posts in progress at once
+        * timeout (float or tuple): connect and read timeouts in seconds
+        * retries (int): number of retries after a 5xx response or a
+            connection error
+        * backoff (float): seconds to wait before the first retry, doubling
+            for each further retry
+
+    """
+    def __init__(self, url=conf.img_data_server,
+                 concurrency=conf.upload_concurrency,
+                 timeout=conf.upload_timeout,
+                 retries=conf.upload_retries,
+                 backoff=conf.upload_backoff):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.concurrency = concurrency
+        self.pool = None
+        self.pending = []
+        self.stats = []
+        self.lock = threading.Lock()
+
+    def post(self, img, payload):
+        """
+        Posts an encoded image, retrying on server and connection errors.
+        Raises IOError if the post does not succeed.
+
+        Args:
+            * img (bytes): the encoded image
+            * payload (dict): post metadata, see getPostDict
+
+        """
+        start = time.time()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2**(attempt - 1))
+            try:
+                r = self.session.post(self.url, data=payload, timeout=self.timeout,
+                                      files={"data": (fileName(payload["mime_type"]),
+                                                      io.BytesIO(img), payload["mime_type"])})
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = IOError(None, str(e))
+                continue
+            if r.status_code == 201:
+                self._record(start, img, r.status_code, attempt + 1)
+                return
+            error = IOError(r.status_code, r.text)
+            if r.status_code < 500:
+                break
+
+        self._record(start, img, error.errno, attempt + 1)
+        raise error
+
+    def _record(self, start, img, status, attempts):
+        latency = time.time() - start
+        metrics.record("post", latency, len(img))
+        with self.lock:
+            self.stats.append({"latency": latency,
+                               "bytes": len(img),
+                               "status": status,
+                               "attempts": attempts})
+
+    def _postAndNotify(self, img, payload, done, posted):
+        try:
+            self.post(img, payload)
+            if posted is not None:
+                posted()
+        finally:
+            if done is not None:
+                done()
+
+    def submit(self, img, payload, done=None, posted=None):
+        """
+        Posts an image in the background, on one of concurrency threads.
+        Errors are raised by join.
+
+        Args:
+            * img (bytes): the encoded image
+            * payload (dict): post metadata, see getPostDict
+            * done (callable): called when the post finishes, whether
+                or not it succeeded
+            * posted (callable): called when the post succeeds
+
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(self.concurrency)
+        self.pending.append(self.pool.apply_async(self._postAndNotify, (img, payload, done, posted)))
+
+    def join(self):
+        """
+        Waits for all submitted posts, raising the first error.
+
+        """
+        pending, self.pending = self.pending, []
+        for result in pending:
+            result.get()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.session.close()
+
+    def summary(self):
+        """
+        Summarises the posts made so far.
+
+        """
+        with self.lock:
+            stats = list(self.stats)
+        latencies = sorted(s["latency"] for s in stats)
+        return {"posts": len(stats),
+                "failed": len([s for s in stats if s["status"] != 201]),
+                "retries": sum(s["attempts"] - 1 for s in stats),
+                "bytes": sum(s["bytes"] for s in stats),
+                "mean_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+                "max_latency": latencies[-1] if latencies else 0.0}
+
+
+def fileName(mime_type):
+    """
+    The file name an image of a mime type is posted as, e.g. image.png
+
+    """
+    return "image" + (mimetypes.guess_extension(mime_type) or ".bin")
+
+
+def defaultClient():
+    """
+    The upload client shared by posts in this process.
+
+    """
+    global _default_client
+    if _default_client is None:
+        _default_client = UploadClient()
+    return _default_client
+
+
+def postEncodedImage(img, payload, client=None):
+    """
+    Sends an encoded image to the data service via a post
+
+    Args:
+        * img (bytes): the encoded image
+        * payload (dict): post metadata, see getPostDict
+        * client (UploadClient): defaults to a client shared by this process
+    """
+    if client is None:
+        client = defaultClient()
+    client.post(img, payload)
+
+
+@metrics.timed("postImage")
+def postImage(img_data, data, field_width, field_height,
+              compression=6, filter_type=0, threads=1, encoder=None):
     """
     Sends the data to the data service via a post
 
+    The image is encoded in memory and streamed in the multipart post,
+    so nothing is written to disk.
+
     Args:
         * img_data(np.Array): Numpy array of i x j x channels
         * data (cube): The cube metadata is used for the post
             metadata
+        * compression (int): zlib compression level, 0-9
+        * filter_type (int): png row filter, see imageproc.filterRows
+        * threads (int): number of row bands to compress in parallel
+        * encoder: see encoders.makeEncoder, defaults to a png
     """
-    tempfilep = os.path.join(tempfile.gettempdir(), "temp.png")
-    with open(tempfilep, "wb") as img:
-        imageproc.writePng(img_data, img,
-                  height=field_height, width=field_width*2,
-                  nchannels=3, alpha=False)
-    payload = getPostDict(data)
-    try:
-        with open(tempfilep, "rb") as img:
-            r = requests.post(conf.img_data_server, data=payload, files={"data": img})
-        if r.status_code != 201:
-            raise IOError(r.status_code, r.text)
-    finally:
-        os.remove(tempfilep)
\ No newline at end of file
+    img = encodeImage(img_data, field_width, field_height,
+                      compression=compression,
+                      filter_type=filter_type,
+                      threads=threads,
+                      encoder=encoder)
+    mime_type = "image/png" if encoder is None else encoder.mime_type
+    postEncodedImage(img, getPostDict(data, mime_type=mime_type))
@@ -0,0 +1,254 @@
+import glob
+import hashlib
+import json
+import numpy as np
+import os
+import tempfile
+import threading
+
+import sys
+sys.path.append(".")
+import config as conf
+
+"""
+resultcache.py keeps the encoded images of processed time slices on
+local disk, keyed on a hash of everything that goes into them, so that
+a file which is published again (e.g. renamed by THREDDS) is not
+processed and posted again. Used by serveupimage.py
+
+"""
+
+_code_version = None
+
+
+def codeVersion():
+    """
+    A hash of the source of the image service (python modules and
+    shaders), so that results are not reused after the code changes.
+
+    """
+    global _code_version
+    if _code_version is None:
+        key = hashlib.sha1()
+        homeDir = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob.glob(os.path.join(homeDir, "*.py")) +
+                           glob.glob(os.path.join(homeDir, "*.glsl"))):
+            with open(path, "rb") as f:
+                key.update(f.read())
+        _code_version = key.hexdigest()
+
+    return _code_version
+
+
+def dataKey(time_slice):
+    """
+    Identifies the input of a time slice: hashes its data, mask,
+    altitudes and times.
+
+    Args:
+        * time_slice (iris cube): x, y, z cube of one time, see serveupimage.loadCube
+
+    """
+    key = hashlib.sha1()
+    data = np.ma.asarray(time_slice.data)
+    key.update(repr((data.shape, data.dtype.str)).encode("utf-8"))
+    key.update(np.ascontiguousarray(np.ma.getdata(data)).tobytes())
+    key.update(np.packbits(np.ma.getmaskarray(data)).tobytes())
+    for name in ("altitude", "forecast_reference_time", "time"):
+        crd = time_slice.coord(name)
+        key.update(np.ascontiguousarray(crd.points, dtype=np.float64).tobytes())
+        key.update(str(crd.units).encode("utf-8"))
+
+    return key.hexdigest()
+
+
+def sliceKey(time_slice, profilename, profile):
+    """
+    Identifies the image made from a time slice: hashes its input (see
+    dataKey), the profile settings and the code version.
+
+    Args:
+        * time_slice (iris cube): x, y, z cube of one time, see serveupimage.loadCube
+        * profilename (str)
+        * profile (dict): the profile's settings, see config.profiles
+
+    """
+    key = hashlib.sha1()
+    key.update(dataKey(time_slice).encode("utf-8"))
+    # the constraint's repr differs between processes, and its
+    # effect is already in the data
+    settings = sorted((k, v) for k, v in profile.items() if k != "data_constraint")
+    key.update(repr((profilename, settings)).encode("utf-8"))
+    key.update(codeVersion().encode("utf-8"))
+
+    return key.hexdigest()
+
+
+class ResultCache(object):
+    """
+    A directory of encoded images (in whichever format the profile's
+    encoder makes) named by their keys (see sliceKey). The least
+    recently used are removed once there are more than max_entries or
+    they take up more than max_bytes.
+
+    Results are added once they have been posted, with any post
+    metadata which depends on the processing (e.g. texture_layout),
+    which is kept beside the image as json. Reading a result
+    touches its file, so the modification times order the results by
+    use. Results are written atomically, so the cache can be shared by
+    the processes of a pool. Each cache counts the results it adds,
+    and only scans the directory (which takes in the results of other
+    processes) when its count goes over the limits, or after every
+    scan_puts results.
+
+    Args:
+        * path (str): cache directory
+        * max_bytes (int): maximum size of the cached images
+        * max_entries (int): maximum number of results
+        * keep_images (bool): if False only the keys are kept, which is
+            enough to know a result has already been posted
+        * scan_puts (int): results added between scans of the directory
+
+    """
+    suffix = ".result"
+
+    def __init__(self, path=conf.result_cache_dir,
+                 max_bytes=conf.result_cache_bytes,
+                 max_entries=conf.result_cache_entries,
+                 keep_images=not conf.result_cache_skip_posts,
+                 scan_puts=conf.result_cache_scan_puts):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.keep_images = keep_images
+        self.scan_puts = scan_puts
+        # size and number of the results as of the last scan, plus
+        # those added since, see evict
+        self.total = None
+        self.entries = None
+        self.puts = 0
+        # results are added from the threads of networking.UploadClient
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def _infoPath(self, path):
+        return path[:-len(self.suffix)] + ".json"
+
+    def contains(self, key):
+        """
+        Whether a result is cached, with or without its image.
+
+        """
+        path = self._path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return False
+        return True
+
+    def get(self, key):
+        """
+        Returns the cached image, or None if there is none (a miss, or
+        only the key was kept).
+
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                img = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+
+        return img or None
+
+    def getInfo(self, key):
+        """
+        Returns the post metadata cached with a result, see put.
+
+        """
+        try:
+            with open(self._infoPath(self._path(key))) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _writeAtomic(self, path, data):
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # rename is atomic, so other workers never see a partial file
+        os.rename(temp_path, path)
+
+    def put(self, key, img, info=None):
+        """
+        Adds a posted result, or just touches it if it is already cached.
+
+        Args:
+            * key (str): see sliceKey
+            * img (bytes): the encoded image
+            * info (dict): post metadata to cache with the image
+
+        """
+        if self.keep_images:
+            if self.get(key) is not None:
+                return
+        elif self.contains(key):
+            return
+
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # made by another process in the meantime
+                pass
+        path = self._path(key)
+        if info:
+            # before the result, so a cached result always has its metadata
+            self._writeAtomic(self._infoPath(path), json.dumps(info).encode("utf-8"))
+        self._writeAtomic(path, img if self.keep_images else b"")
+
+        with self.lock:
+            if self.total is None:
+                scan = True
+            else:
+                self.total += len(img) if self.keep_images else 0
+                self.entries += 1
+                self.puts += 1
+                scan = (self.puts >= self.scan_puts or self.entries > self.max_entries or
+                        self.total > self.max_bytes)
+        if scan:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache is
+        within max_entries and max_bytes.
+
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.path, "*" + self.suffix)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total > self.max_bytes):
+            _, size, path = entries.pop(0)
+            for remove in (path, self._infoPath(path)):
+                try:
+                    os.remove(remove)
+                except OSError:
+                    pass
+            total -= size
+
+        with self.lock:
+            self.total = total
+            self.entries = len(entries)
+            self.puts = 0
@@ -1,20 +1,29 @@
 #!/usr/bin/env python
 
 import argparse as ap
+import functools
 import iris
+import iris.aux_factory
+import iris.exceptions
 import iris.util
 import io
+import multiprocessing as mp
 import numpy as np
 import os
-import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
 import sys
 sys.path.append(".")
 
 import dataproc
+import encoders
 import imageproc
+import metrics
 import networking
+import resultcache
 import shadowproc
+import volumestore
 
 import config as conf
 
@@ -30,61 +39,202 @@ data service. This includes:
 
 """
 
-def procTimeSliceToImage(
-               data,
-               image_dest,
-               extent,
-               regrid_shape,
-               field_width,
-               field_height):
+# topography cubes by file name, see getTopography
+_topography = {}
+
+
+def regridTimeSlice(data, extent, regrid_shape, regrid_cache=False,
+                    restratify_engine="numpy", lean=False, chunk_budget=None):
     """
-    Main processing function. Processes an model_level_number, lat, lon cube,
-    including all regridding and restratification of data,
-    calculates shadows, and then ultimately posts a tiled
-    image to the data service.
+    Restratifies and regrids a single time slice, see regridPhenomena.
+
+    """
+    return regridPhenomena([data], extent, regrid_shape, regrid_cache,
+                           restratify_engine, lean, chunk_budget)[0]
 
-    Args:
-        * data (iris cube): lat, lon, model_level_number cube 
-        * image_dest (str): URL to the data service image destination
-        * regrid_shape (tuple): lon, lat, alt dimensions to regrid to
-        * field_width (int): image width
-        * field_height (int): image height
 
+@metrics.timed("regridPhenomena")
+def regridPhenomena(data, extent, regrid_shape, regrid_cache=False,
+                    restratify_engine="numpy", lean=False, chunk_budget=None):
     """
+    Restratifies and regrids the cubes of several phenomena at one
+    time, which must be on the same grid and model levels. The
+    sanitized log altitudes are worked out once, from the first cube,
+    and the restratification weights (see dataproc.getRestratifyWeights),
+    regrid weights and trimmed domain are shared by all of them.
+
+    With chunk_budget (MB), each cube is regridded a block at a time,
+    see dataproc.regridChunked.
+
+    returns a list of the regridded cubes
+
+    """
+    shared = {} if len(data) > 1 else None
+    rg_data = []
+    for i, c in enumerate(data):
+        if i == 0:
+            # tidy up any problems arising from the on-the-fly altitude calc
+            c = dataproc.sanitizeAlt(c)
+            log_alt = c.coord("log_altitude")
+            log_alt_dims = c.coord_dims(log_alt)
+        elif c.shape != data[0].shape:
+            raise ValueError("Phenomena must be on the same grid, not %s and %s" %
+                             (data[0].shape, c.shape))
+        else:
+            c.add_aux_coord(log_alt.copy(), log_alt_dims)
+        # regrid and restratify the data
+        rg_data.append(dataproc.regridData(c, regrid_shape=regrid_shape, extent=extent,
+                                           cache_dir=conf.regrid_cache_dir if regrid_cache else None,
+                                           restratify_engine=restratify_engine,
+                                           dtype=np.float32 if lean else np.float64,
+                                           shared=shared,
+                                           budget=chunk_budget))
+        metrics.addBytes("regridPhenomena", rg_data[-1].data.nbytes)
+
+    return rg_data
 
-    # tidy up any problems arising from the on-the-fly altitude calc
-    san_data = dataproc.sanitizeAlt(data) 
-    # regrid and restratify the data
-    rg_data = dataproc.regridData(san_data, regrid_shape=regrid_shape, extent=extent)
+
+@metrics.timed("cubeToImage")
+def cubeToImage(rg_data, field_width, field_height, shadow_engine="gl",
+                shadow_processes=None, lean=False, light_positions=((20, 0, 0),),
+                volumes=None, value_range=(0.0, 1.0), channels=3, chunked=False):
+    """
+    Makes the tiled data and shadows image of a regridded cube
+    (see regridPhenomena). NB the cube's data is scaled in place,
+    from value_range (see dataproc.procDataCube).
+
+    The fields are field_width x field_height textures with channels
+    channels (see imageproc.planProfileTexture). A ValueError is raised
+    if the cube does not fit in them.
+
+    With volumes (see volumestore.SliceVolumes), the processed data,
+    tiled texture (with its layout) and shadows are stored for later
+    reruns.
+
+    With chunked, the data is scaled a row at a time, e.g. for cubes
+    regridded with a chunk budget (see dataproc.procDataCube).
+
+    """
     # do any further processing (saturation etc) and convert to 8 bit uints
-    proced_data = dataproc.procDataCube(rg_data)
+    proced_data = dataproc.procDataCube(rg_data, lean=lean, value_range=value_range,
+                                        chunked=chunked)
+    if volumes is not None:
+        volumes.save("proced", proced_data.data.astype(np.uint8))
 
-    data_tiled = imageproc.tileArray(proced_data.data, field_width, field_height)
-    shadows_tiled = shadowproc.procShadows(data_tiled)
+    layout = imageproc.textureLayout(proced_data.shape, field_width, field_height, channels)
+    data_tiled = imageproc.tileArray(proced_data.data, field_width, field_height, channels)
+    if volumes is not None:
+        volumes.save("tiled", data_tiled, layout)
 
-    img_data_out = np.concatenate([data_tiled, shadows_tiled], 2)
+    img_data_out = volumesToImage(volumes, shadow_engine, shadow_processes, light_positions,
+                                  data_tiled=data_tiled, data_shape=layout["dataShape"])
+    metrics.addBytes("cubeToImage", img_data_out.nbytes)
 
     return img_data_out
 
 
-def loadCube(data_file, topog_file, constraint):
+def volumesToImage(volumes, shadow_engine="gl", shadow_processes=None,
+                   light_positions=((20, 0, 0),), data_tiled=None, data_shape=None):
     """
-    Loads cube and reorders axes into appropriate structure
+    Makes the tiled data and shadows image of a slice from its stored
+    volumes (memory-mapped, see volumestore.SliceVolumes), rendering
+    and storing the shadows if they are not stored.
 
-    The Iris altitude conversion only works on pp files
-    at load time, so we need to pull the nc file from
-    OpenDAP, save a local temporary pp file and then
-    load in with the topography.
+    The shadows are rendered with the padded tile shape data_shape
+    (see imageproc.textureLayout), or that of the stored tiled
+    texture's layout.
 
+    returns the image, or None if the tiled texture is not stored
+
+    """
+    if data_tiled is None:
+        data_tiled = volumes.load("tiled") if volumes is not None else None
+        if data_tiled is None:
+            return None
+    shadows_tiled = volumes.load("shadows") if volumes is not None else None
+    if shadows_tiled is None:
+        if data_shape is None:
+            data_shape = volumes.loadLayout()["dataShape"]
+        shadows_tiled = shadowproc.procShadowsBatch(data_tiled, light_positions,
+                                                    dataShape=tuple(data_shape),
+                                                    engine=shadow_engine,
+                                                    processes=shadow_processes)
+        if volumes is not None:
+            volumes.save("shadows", shadows_tiled)
+
+    return np.concatenate([data_tiled] + list(shadows_tiled), 1)
+
+
+def getTopography(topog_file):
+    """
+    Loads the topography cube, once per process.
+
+    """
+    if topog_file not in _topography:
+        _topography[topog_file] = iris.load_cube(topog_file)
+
+    return _topography[topog_file]
+
+
+def addAltitude(data, topography):
     """
-    opendapcube = iris.load_cube(data_file, constraint)
-    tempfilep = os.path.join(tempfile.gettempdir(), "temporary.pp")
-    iris.save(opendapcube, tempfilep)
-    data, topography = iris.load([tempfilep, topog_file])
+    Adds the hybrid height altitude coord to a cube, using its
+    level_height and sigma coords and the topography, which
+    must be on the same horizontal grid.
+
+    """
+    for axis in ["X", "Y"]:
+        if not np.allclose(data.coord(axis=axis).points, topography.coord(axis=axis).points):
+            raise IOError("Topography is not on the same %s grid as the data" % axis)
+
+    # the data dims which the topography dims map onto
+    orog_dims = tuple(data.coord_dims(topography.coord(dimensions=d, dim_coords=True).name())[0]
+                      for d in range(topography.ndim))
+    orography = iris.coords.AuxCoord(topography.data,
+                                     standard_name="surface_altitude",
+                                     units=topography.units)
+    data.add_aux_coord(orography, orog_dims)
+    factory = iris.aux_factory.HybridHeightFactory(delta=data.coord("level_height"),
+                                                   sigma=data.coord("sigma"),
+                                                   orography=orography)
+    data.add_aux_factory(factory)
+
+    return data
+
+
+def deriveAltitude(data, topog_file, subset=None):
+    """
+    Makes sure a cube has the derived altitude coord, adding it from
+    the topography if the file did not have one.
+
+    Args:
+        * data (iris cube)
+        * topog_file (str): topography on the same grid as the data
+        * subset (tuple): X and Y slices of the topography grid to use,
+            when the data is a subset of the grid (see dataproc.subsetIndices)
+
+    """
+    if "altitude" not in [_.name() for _ in data.derived_coords]:
+        try:
+            topography = getTopography(topog_file)
+            if subset is not None:
+                topography = dataproc.subsetGrid(topography, *subset)
+            data = addAltitude(data, topography)
+        except iris.exceptions.CoordinateNotFoundError as e:
+            raise IOError("Cannot derive altitude coord - %s" % e)
 
     if "altitude" not in [_.name() for _ in data.derived_coords]:
         raise IOError("Derived altitude coord not present - probelm with topography?")
 
+    return data
+
+
+def reorderAxes(data):
+    """
+    Transposes a cube to time, x, y, z order, or x, y, z for a
+    single time.
+
+    """
     xdim, = data.coord_dims(data.coords(dim_coords=True, axis="X")[0])
     ydim, = data.coord_dims(data.coords(dim_coords=True, axis="Y")[0])
     zdim, = data.coord_dims(data.coords(dim_coords=True, axis="Z")[0])
@@ -97,6 +247,134 @@ def loadCube(data_file, topog_file, constraint):
     return data
 
 
+def phenomenaConstraints(profile):
+    """
+    The constraint of each of a profile's phenomena, combined with its
+    data_constraint.
+
+    """
+    return [profile.data_constraint if p["constraint"] is None
+            else profile.data_constraint & iris.Constraint(p["constraint"])
+            for p in profile.phenomena]
+
+
+def loadCube(data_file, topog_file, constraint):
+    """
+    Loads cube and reorders axes into appropriate structure
+
+    The altitude coord is built in memory from the level_height
+    and sigma coords and the topography, which is loaded once per
+    process. So the data is only read once, from OpenDAP,
+    and nothing is written to disk.
+
+    """
+    return loadCubes(data_file, topog_file, [constraint])[0]
+
+
+@metrics.timed("loadCube")
+def loadCubes(data_file, topog_file, constraints):
+    """
+    Loads a cube for each constraint, e.g. the phenomena of a profile
+    (see phenomenaConstraints), opening the file once. See loadCube.
+
+    """
+    cubes = []
+    for data in iris.load_cubes(data_file, constraints):
+        data = deriveAltitude(data, topog_file)
+        metrics.addBytes("loadCube", int(np.prod(data.shape)) * data.dtype.itemsize)
+        cubes.append(reorderAxes(data))
+
+    return cubes
+
+
+@metrics.timed("loadSlice")
+def loadSlice(time_slice, topog_file, subset):
+    """
+    Fetches the data of one time slice of a lazily loaded cube,
+    see streamCube.
+
+    """
+    # touching the data makes iris request it from the server
+    time_slice.data
+    metrics.addBytes("loadSlice", time_slice.data.nbytes)
+    time_slice = deriveAltitude(time_slice, topog_file, subset)
+
+    return reorderAxes(time_slice)
+
+
+def loadSlices(time_slices, topog_file, subset):
+    return [loadSlice(time_slice, topog_file, subset) for time_slice in time_slices]
+
+
+def streamCube(data_file, topog_file, constraint, extent, regrid_shape, ordered=True):
+    """
+    Loads a cube one time slice at a time, as a generator of
+    x, y, z cubes.
+
+    Only the coords are read up front. The model levels selected by
+    the constraint, and the columns and rows of the grid which are
+    needed to regrid onto the extent (see dataproc.subsetIndices), are
+    then requested as index ranges for each time slice, so OPeNDAP
+    servers only send that part of the domain. The next slice is
+    downloaded in a thread while the current one is processed, so at
+    most two slices are resident at a time.
+
+    NB the restratified levels then span the altitudes of the subset,
+    which only differ from the whole grid's if its lowest ground lies
+    outside of the extent.
+
+    Args:
+        * data_file (str): URI of file to analyse
+        * topog_file (str): topography on the same grid as the data
+        * constraint (iris constraint): e.g. the model levels to use
+        * extent (list): lon, lat extent being regridded onto
+        * regrid_shape (list): lon, lat, alt dimensions being regridded onto
+        * ordered (bool): yield the slices in time order
+
+    """
+    for time_slices in streamCubes(data_file, topog_file, [constraint], extent,
+                                   regrid_shape, ordered):
+        yield time_slices[0]
+
+
+def streamCubes(data_file, topog_file, constraints, extent, regrid_shape, ordered=True):
+    """
+    Loads a cube for each constraint (e.g. the phenomena of a profile,
+    see phenomenaConstraints) one time at a time, as a generator of
+    lists of x, y, z cubes. The cubes must be on the same grid and
+    times. See streamCube.
+
+    """
+    cubes = iris.load_cubes(data_file, constraints)
+    subset = dataproc.subsetIndices(cubes[0], regrid_shape[1], regrid_shape[0], extent)
+    by_time = []
+    for data in cubes:
+        data = dataproc.subsetGrid(data, *subset)
+        try:
+            tdim, = data.coord_dims(data.coords(dim_coords=True, axis="T")[0])
+        except IndexError:
+            time_slices = [data]
+        else:
+            time_slices = list(data.slices_over(tdim))
+            if ordered:
+                time_slices.sort(key=lambda c: c.coord("time").points[0])
+        by_time.append(time_slices)
+    by_time = [list(time_slices) for time_slices in zip(*by_time)]
+
+    fetcher = ThreadPool(1)
+    try:
+        pending = fetcher.apply_async(loadSlices, (by_time[0], topog_file, subset))
+        for i in range(len(by_time)):
+            time_slices = pending.get()
+            # drop the lazy slices so their data is freed once processed
+            by_time[i] = None
+            if i + 1 < len(by_time):
+                pending = fetcher.apply_async(loadSlices, (by_time[i + 1], topog_file, subset))
+            yield time_slices
+    finally:
+        fetcher.terminate()
+
+
 def parseArgs():
     argparser = ap.ArgumentParser()
     argparser.add_argument("-a", "--profilename", default="default",
@@ -107,17 +385,331 @@ def parseArgs():
     return call_args
 
 
+def lookupCachedSlice(images, payloads, profilename, profile):
+    """
+    Looks up the images of a time slice in the result cache, see
+    procTimeSlice. A slice is only a hit if every one of its images
+    is cached (with its texture layout, with profile.texture_plan).
+
+    Args:
+        * images (list): phenomenon, time slice cube and lod factor of
+            each image
+        * payloads (list): post metadata of each image
+        * profilename (str)
+        * profile (namespace): see config.profiles
+
+    returns the result cache key of each image, and the posts of the
+    slice if it has already been posted, or None
+
+    """
+    keys = []
+    for p, time_slice, factor in images:
+        key = resultcache.sliceKey(time_slice, profilename, conf.profiles[profilename])
+        keys.append(key if factor == 1 else "%s_%s" % (key, factor))
+    cache = resultcache.ResultCache()
+    if conf.result_cache_skip_posts and all(cache.contains(k) for k in keys):
+        metrics.record("resultCacheHit", 0)
+        return keys, [(None, payload, k, None) for payload, k in zip(payloads, keys)]
+    imgs = [cache.get(k) for k in keys]
+    infos = [cache.getInfo(k) for k in keys]
+    if None not in imgs and not (profile.texture_plan and
+                                 any("texture_layout" not in info for info in infos)):
+        metrics.record("resultCacheHit", 0, sum(len(img) for img in imgs))
+        return keys, [(img, dict(payload, **info), k, None)
+                      for img, payload, info, k in zip(imgs, payloads, infos, keys)]
+
+    return keys, None
+
+
+def loadStoredLevel(profilename, profile, p, factor, payload, input_key, shadow_processes):
+    """
+    Opens the stored volumes of a phenomenon at a level of detail of a
+    time slice (see volumestore.py), and makes its image from them if
+    its tiled texture is stored, see procTimeSlice.
+
+    Args:
+        * profilename (str)
+        * profile (namespace): see config.profiles
+        * p (dict): the phenomenon, see config.profiles
+        * factor (int): the lod factor
+        * payload (dict): post metadata of the image
+        * input_key (str): the input data's key, see resultcache.dataKey
+        * shadow_processes (int): processes used by the cpu shadow engine
+
+    returns the volumes, and the image and its texture layout, or None
+    and None if the level must be processed
+
+    """
+    volumes = volumestore.VolumeStore().slice(profilename,
+                                              payload["forecast_reference_time"],
+                                              payload["forecast_time"],
+                                              volumestore.stageSettings(profile, factor, p, input_key),
+                                              factor,
+                                              p["name"])
+    img_array = volumesToImage(volumes,
+                               profile.shadow_engine,
+                               shadow_processes,
+                               profile.light_positions)
+    layout = volumes.loadLayout() if img_array is not None else None
+
+    return volumes, img_array, layout
+
+
+def procTimeSlice(job):
+    """
+    Processes a time slice and encodes it, ready to post, in the
+    format of profile.encoder (see encoders.makeEncoder). Run in the
+    slice processing pool.
+
+    A time slice holds a cube for each of profile.phenomena, which are
+    regridded together (see regridPhenomena), and each make their own
+    images, scaled from their value_range.
+
+    With more than one profile.lod_factors, an image is made at each
+    level of detail, in that order, from lower resolution copies of the
+    regridded cube (see dataproc.downsampleCube). The fields of a level
+    are 1/factor of the profile's field size, or with
+    profile.texture_plan the smallest texture which holds the level
+    (see imageproc.planProfileTexture). With profile.texture_plan the
+    layout the slice is actually tiled with, after it is trimmed to the
+    data's domain, is posted with the image (see
+    imageproc.textureLayout).
+
+    With profile.chunk_budget, the slice is regridded, downsampled and
+    scaled a block at a time, within that many MB, with the full size
+    volumes in temporary files (see dataproc.regridChunked). The images
+    are the same as without it, with profile.regrid_cache.
+
+    With profile.volume_store, the intermediate volumes of each level
+    are stored (see volumestore.py), and a level whose tiled texture
+    is already stored from the same data (see resultcache.dataKey)
+    with the same settings is made from it without regridding again
+    (see loadStoredLevel).
+
+    With profile.result_cache, a slice which has already been posted
+    is not processed again: its images are read from the result cache,
+    or with conf.result_cache_skip_posts no images are returned at all
+    (see lookupCachedSlice).
+
+    Args:
+        * job (tuple): time slice cubes (one for each phenomenon),
+            profile name and the number of processes for the cpu
+            shadow engine
+
+    returns a list of the encoded image (None if it need not be posted
+    again), post metadata, result cache key and (with
+    profile.delta_keyframe_interval) the image array of each
+    phenomenon and level, and the metrics recorded while processing them
+
+    """
+    time_slices, profilename, shadow_processes = job
+    profile = ap.Namespace(**conf.profiles[profilename])
+    metrics.setLabels(profile=profilename)
+    factors = profile.lod_factors
+    encoder = encoders.makeEncoder(profile)
+    # one image for each phenomenon at each level of detail, in that order
+    images = [(p, time_slice, factor)
+              for p, time_slice in zip(profile.phenomena, time_slices)
+              for factor in factors]
+    # the texture of each level
+    plans = dict((factor, imageproc.planProfileTexture(profile, factor)) for factor in factors)
+
+    def postDict(p, time_slice, factor, layout=None):
+        # clients need the layout of a planned texture to untile it
+        return networking.getPostDict(time_slice,
+                                      mime_type=encoder.mime_type,
+                                      light_positions=profile.light_positions,
+                                      lod_factors=factors,
+                                      lod_factor=factor,
+                                      phenomenon=p["name"],
+                                      texture_layout=layout if profile.texture_plan else None)
+
+    payloads = [postDict(p, time_slice, factor) for p, time_slice, factor in images]
+
+    keys = [None] * len(images)
+    if profile.result_cache:
+        keys, posts = lookupCachedSlice(images, payloads, profilename, profile)
+        if posts is not None:
+            return posts, metrics.drain()
+
+    input_keys = None
+    if profile.volume_store:
+        input_keys = dict((p["name"], resultcache.dataKey(time_slice))
+                          for p, time_slice in zip(profile.phenomena, time_slices))
+
+    levels = None
+    posts = []
+    for i, ((p, time_slice, factor), payload, key) in enumerate(zip(images, payloads, keys)):
+        plan = plans[factor]
+        field_width = plan["width"]
+        field_height = plan["height"]
+        volumes = None
+        img_array = None
+        if profile.volume_store:
+            volumes, img_array, layout = loadStoredLevel(profilename, profile, p, factor, payload,
+                                                         input_keys[p["name"]], shadow_processes)
+        if img_array is None:
+            if levels is None:
+                rg_data = regridPhenomena(time_slices,
+                                          profile.extent,
+                                          profile.regrid_shape,
+                                          profile.regrid_cache,
+                                          profile.restratify_engine,
+                                          profile.lean,
+                                          profile.chunk_budget)
+                # downsample before cubeToImage scales rg_data in place
+                levels = [c if f == 1 else dataproc.downsampleCube(c, f, profile.chunk_budget)
+                          for c in rg_data for f in factors]
+            layout = imageproc.textureLayout(levels[i].shape, field_width, field_height,
+                                             plan["channels"])
+            img_array = cubeToImage(levels[i], field_width, field_height,
+                                    profile.shadow_engine,
+                                    shadow_processes,
+                                    profile.lean,
+                                    profile.light_positions,
+                                    volumes,
+                                    p["value_range"],
+                                    plan["channels"],
+                                    profile.chunk_budget is not None)
+        payload = postDict(p, time_slice, factor, layout)
+        if volumes is not None:
+            volumes.savePayload(payload)
+        img = networking.encodeImage(img_array, field_width, field_height,
+                                     encoder=encoder)
+        # deltas are taken between the uint8 images, see processFile
+        frame = img_array if profile.delta_keyframe_interval else None
+        posts.append((img, payload, key, frame))
+
+    return posts, metrics.drain()
+
+
+def processFile(data_file, profilename):
+    """
+    Processes every time slice in a file and posts the resulting
+    images to the data service.
+
+    The stages are pipelined: slices are loaded by the pool's feeder
+    thread (all at once, or one at a time with profile.load_mode
+    "stream", see streamCube), processed and encoded in
+    profile.slice_processes processes, and posted from this process
+    as they complete. At most profile.max_in_flight slices are loaded
+    but not yet posted. Posts run in the background while the next
+    slice is processed: with profile.ordered_posts one at a time, in
+    forecast time order, otherwise up to conf.upload_concurrency at
+    once. Posted images are added to the result cache, see
+    procTimeSlice. Each phenomenon and level of detail of a slice
+    is posted as a separate image.
+
+    With profile.delta_keyframe_interval, only the blocks of an image
+    which changed since the last slice are posted, with a full
+    keyframe at that interval (see networking.DeltaEncoder). Deltas
+    are taken in the order slices are posted, so are smallest with
+    profile.ordered_posts.
+
+    Returns a summary of the posts, see networking.UploadClient
+
+    Args:
+        * data_file (str): URI of file to analyse
+        * profilename (str): name of analysis profile settings, as defined in config.py
+
+    """
+    profile = ap.Namespace(**conf.profiles[profilename]) # get settings for this type of analysis
+    metrics.setLabels(profile=profilename)
+
+    # the file is opened once for all of the phenomena
+    constraints = phenomenaConstraints(profile)
+    if profile.load_mode == "stream":
+        time_slices = streamCubes(data_file, conf.topog_file, constraints,
+                                  profile.extent, profile.regrid_shape,
+                                  ordered=profile.ordered_posts)
+    elif profile.load_mode == "cube":
+        by_time = []
+        for data in loadCubes(data_file, conf.topog_file, constraints):
+            data_slices = list(data.slices_over("time"))
+            if profile.ordered_posts:
+                data_slices.sort(key=lambda c: c.coord("time").points[0])
+            by_time.append(data_slices)
+        time_slices = [list(phenomena) for phenomena in zip(*by_time)]
+    else:
+        raise ValueError("Unknown load mode %s" % profile.load_mode)
+
+    # slices run in parallel, so each shadow calculation gets one process
+    shadow_processes = 1 if profile.slice_processes > 1 else None
+    in_flight = threading.Semaphore(profile.max_in_flight)
+    stopping = threading.Event()
+
+    def jobs():
+        for time_slice in time_slices:
+            in_flight.acquire()
+            if stopping.is_set():
+                return
+            yield time_slice, profilename, shadow_processes
+
+    if profile.slice_processes > 1:
+        pool = mp.Pool(profile.slice_processes)
+        imap = pool.imap if profile.ordered_posts else pool.imap_unordered
+        results = imap(procTimeSlice, jobs())
+    else:
+        pool = None
+        results = (procTimeSlice(job) for job in jobs())
+
+    def releaseAfter(nposts):
+        # the slice is no longer in flight once all of its posts finish
+        remaining = [nposts]
+        lock = threading.Lock()
+        def done():
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                in_flight.release()
+        return done
+
+    # one chain of keyframes and deltas for each phenomenon and level of detail
+    delta_encoders = {}
+    cache = resultcache.ResultCache()
+    # a single upload thread posts in the order images are submitted
+    client = networking.UploadClient(concurrency=1 if profile.ordered_posts
+                                     else conf.upload_concurrency)
+    try:
+        for posts, slice_metrics in results:
+            metrics.merge(slice_metrics)
+            to_post = []
+            for img, payload, key, frame in posts:
+                if img is None:
+                    # already posted
+                    continue
+                body = img
+                if profile.delta_keyframe_interval:
+                    encoder = delta_encoders.setdefault(
+                        (payload["phenomenon"], payload.get("lod_factor", 1)),
+                        networking.DeltaEncoder(profile.delta_keyframe_interval))
+                    body, payload = encoder.encode(frame, img, payload)
+                # the full image is cached, whether or not a delta is posted,
+                # with the post metadata which depends on the processing
+                info = dict((k, payload[k]) for k in ("texture_layout",) if k in payload)
+                to_post.append((body, payload, key, img, info))
+
+            if not to_post:
+                in_flight.release()
+                continue
+            done = releaseAfter(len(to_post))
+            for body, payload, key, img, info in to_post:
+                posted = None if key is None else functools.partial(cache.put, key, img, info)
+                client.submit(body, payload, done=done, posted=posted)
+        client.join()
+    finally:
+        # wake the feeder if it is waiting, so the pool can shut down
+        stopping.set()
+        in_flight.release()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        client.close()
+
+    return client.summary()
+
+
 if __name__ == "__main__":
     call_args = parseArgs()
-    profile = ap.Namespace(**conf.profiles[call_args.profilename]) # get settings for this type of analysis
-
-    data = loadCube(call_args.data_file, conf.topog_file, profile.data_constraint)
-
-    for time_slice in data.slices_over("time"):
-        img_array = procTimeSliceToImage(time_slice,
-                                         conf.img_data_server,
-                                         profile.extent,
-                                         profile.regrid_shape,
-                                         profile.field_width,
-                                         profile.field_height)
-        post_object = networking.postImage(img_array, data, profile.field_width, profile.field_height)
\ No newline at end of file
+    processFile(call_args.data_file, call_args.profilename)
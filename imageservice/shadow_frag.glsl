@@ -8,11 +8,17 @@ uniform vec3 dataShape;
 uniform int nSlices;
 uniform int nSlicesPerRow;
 uniform int maxRow;
+// 3 for an RGB texture, 4 for RGBA
+uniform int nChannels;
 uniform float alphaCorrection;
 uniform vec2 textureShape;
 uniform float texLevels;
 uniform float steps;
 uniform float ambient;
+// which bricks of the volume hold any data, see shadowcpu.makeOccupancy
+uniform sampler2D occupancyTexture;
+uniform vec3 occupancyShape;
+uniform vec3 brickShape;
 
 float sliceW = dataShape.x;
 float sliceH = dataShape.y;
@@ -49,6 +55,8 @@ float sample3DTexture(sampler2D slices, vec3 p, float sliceW, float sliceH, int
         datum = datumRGB.g;
     }else if (zTile == 2.0){
         datum = datumRGB.b;
+    }else if (zTile == 3.0 && nChannels == 4){
+        datum = datumRGB.a;
     }
     return datum;
 }
@@ -63,6 +71,23 @@ vec4 getRGBAfromDataTex(sampler2D tex, vec3 pos, vec3 dataShape, vec2 texShape){
     float alpha = getDatumAlpha(datum);
     return vec4(color.xyz, alpha);
 }
+float stepsToSkip(vec3 p, vec3 deltaDirection){
+    /* The number of steps the ray can take before it can reach any data,
+       or 0 if it is in an occupied brick and needs sampling. */
+    vec3 brick = floor(p / brickShape);
+    vec3 index = clamp(brick, vec3(0.0), occupancyShape - 1.0);
+    // the bricks are stored as nbz * nby rows of nbx
+    vec2 texel = vec2(index.x, index.z * occupancyShape.y + index.y) + 0.5;
+    float occupied = texture2D(occupancyTexture, texel / vec2(occupancyShape.x, occupancyShape.y * occupancyShape.z)).r;
+    if (occupied > 0.0){
+        return 0.0;
+    }
+    //Steps until the ray crosses the face of the brick it is heading for.
+    vec3 lower = brick * brickShape;
+    vec3 face = mix(lower, lower + brickShape, step(0.0, deltaDirection));
+    vec3 exit = abs(face - p) / max(abs(deltaDirection), vec3(1e-6));
+    return max(floor(min(exit.x, min(exit.y, exit.z))), 1.0);
+}
 float getPathRGBA(vec3 startPos, vec3 dir, float steps, sampler2D tex){
     /* Calculates the total RGBA values of a given path through a texture */
     //The direction from the front position to back position.
@@ -87,19 +112,32 @@ float getPathRGBA(vec3 startPos, vec3 dir, float steps, sampler2D tex){
     //vec4 dataSample;
     vec4 dataSample;
     float alphaSample;
+    //The steps taken so far, which jump over empty bricks.
+    float taken = 0.0;
+    float skip;
     //Perform the ray marching iterations
     for(int i = 0; i < int(steps); i++){
-        //Get the voxel intensity value from the 3D texture.    
-        dataSample = getRGBAfromDataTex(dataTexture, currentPosition, dataShape, textureShape);
-        //Store the alpha accumulated so far.
-        accumulatedAlpha += (1.0 - accumulatedAlpha) * dataSample.a;
+        skip = stepsToSkip(currentPosition, deltaDirection);
+        if (skip == 0.0){
+            //Get the voxel intensity value from the 3D texture.    
+            dataSample = getRGBAfromDataTex(dataTexture, currentPosition, dataShape, textureShape);
+            //Store the alpha accumulated so far.
+            accumulatedAlpha += (1.0 - accumulatedAlpha) * dataSample.a;
+            skip = 1.0;
+        }
     
         //Advance the ray.
-        currentPosition += deltaDirection;
-        accumulatedLength += deltaDirectionLength;
+        currentPosition += deltaDirection * skip;
+        accumulatedLength += deltaDirectionLength * skip;
+        taken += skip;
                   
         //If the length traversed is more than the ray length, or if the alpha accumulated reaches 1.0 then exit.
-        if(accumulatedLength >= rayLength || accumulatedAlpha >= (1.0 - ambient) ){
+        if(accumulatedLength >= rayLength || accumulatedAlpha >= (1.0 - ambient) || taken >= steps){
+            break;
+        }
+        //Rays which have left the volume can not reach any more data.
+        vec3 beyond = mix(-currentPosition, currentPosition - 1.0, step(0.0, deltaDirection));
+        if(any(greaterThan(beyond * abs(sign(deltaDirection)), vec3(0.0)))){
             break;
         }
     }
@@ -111,7 +149,7 @@ vec3 mapTo3D(vec3 pos, float sliceW, float sliceH, int nSlicesPerRow, int nSlice
     //Fix to put rows in the right order
     int sliceIndex = (((maxRow - sliceRow) * nSlicesPerRow) + (sliceCol));
 	vec2 pxy = (pos.xy / vec2(sliceW, sliceH)) - vec2(sliceCol, sliceRow);
-	//pos.z in {0,1,2}
+	//pos.z in {0,1,2,3}
 	int z = ((int(pos.z) * nSlices) + sliceIndex);
 	float pz = float(z)/texLevels;
 	return vec3(pxy, pz);
@@ -130,6 +168,12 @@ void main() {
    float gOut = getPathRGBA(gPoint, lightDirection, steps, dataTexture);
    vec3 absorbed = vec3(rOut, gOut, bOut);
    vec3 light = vec3(1.0) - absorbed;
-   gl_FragColor = vec4(absorbed, 1.0);
+   float aOut = 1.0;
+   if (nChannels == 4){
+       vec3 aInCoord = vec3(v_texCoord*textureShape, 3.0);
+       vec3 aPoint = mapTo3D(aInCoord, sliceW, sliceH, nSlicesPerRow, nSlices);
+       aOut = getPathRGBA(aPoint, lightDirection, steps, dataTexture);
+   }
+   gl_FragColor = vec4(absorbed, aOut);
    //gl_FragColor = vec4(v_texCoord, 0.0 ,1.0);
 }
\ No newline at end of file
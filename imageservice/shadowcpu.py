@@ -0,0 +1,447 @@
+from __future__ import division
+
+import multiprocessing as mp
+import numpy as np
+
+"""
+shadowcpu.py is a pure numpy port of the ray marching in shadow_frag.glsl.
+It lets shadows be calculated on headless workers which have no display
+stack or OpenGL driver. Called by shadowproc.py
+
+The functions mirror the glsl functions of the same name, but operate on
+whole blocks of pixels at once. Arithmetic is done in float32 as on the GPU.
+The result is checked against tests/data/shadows_gl.npz, shadows rendered
+by the gl engine on Mesa's llvmpipe driver (see make_shadows_gl.py there),
+which it matches exactly. Other drivers may sample and blend differently,
+so the gl engine is allowed GL_TOLERANCE 8 bit levels per channel.
+
+"""
+
+GL_TOLERANCE = 2
+
+_worker = {}
+
+
+def makeTexture(dataArray):
+    '''
+    Converts from 0-255 to 0-1 float32, as shadowproc.makeTexture does
+    before the data is uploaded to the GPU.
+
+    Args:
+        * dataArray (array)
+
+    returns np.Array
+
+    '''
+    maxVal = dataArray.max()
+    if maxVal == 0:
+        return np.zeros(dataArray.shape, dtype=np.float32)
+    return (dataArray / maxVal).astype(np.float32)
+
+
+def makeLookup(dataArray):
+    '''
+    The float32 texture value of each uint8 level, so a uint8 texture
+    can be sampled as it is rather than copied into a float32 texture
+    four times the size. Gives the same values as makeTexture.
+
+    Args:
+        * dataArray (uint8 array)
+
+    returns np.Array of 256 values
+
+    '''
+    return makeTexture(np.arange(256)[:int(dataArray.max()) + 1])
+
+
+def getLayout(dataShape, textureShape, nChannels=3):
+    '''
+    Calculates the shader uniforms which describe how the volume is tiled
+    into the texture, as shadowproc.makeProgram does.
+
+    Args:
+        * dataShape (3-tuple)
+        * textureShape (2-tuple)
+        * nChannels (int): 3 (RGB) or 4 (RGBA)
+
+    returns dict
+
+    '''
+    nSlicesPerRow = int(textureShape[0]/dataShape[0])
+    nRows = int(textureShape[1]/dataShape[1])
+    nSlices = nSlicesPerRow * nRows
+    return {"sliceW": np.float32(dataShape[0]),
+            "sliceH": np.float32(dataShape[1]),
+            "nSlicesPerRow": nSlicesPerRow,
+            "maxRow": nRows - 1,
+            "nSlices": nSlices,
+            "nChannels": nChannels,
+            "texLevels": np.float32(nSlices * nChannels),
+            "textureShape": np.array(textureShape, dtype=np.float32)}
+
+
+def mapTo3D(x, y, channel, layout):
+    '''
+    Maps texture pixel coordinates and a channel onto a position
+    in the unit cube of the data volume.
+
+    Args:
+        * x, y (np.Array): pixel coordinates
+        * channel (int): 0, 1, 2, 3 for r, g, b, a
+        * layout (dict): see getLayout
+
+    returns np.Array of N x 3 positions
+
+    '''
+    sliceCol = np.floor(x / layout["sliceW"])
+    sliceRow = np.floor(y / layout["sliceH"])
+    sliceIndex = (layout["maxRow"] - sliceRow) * layout["nSlicesPerRow"] + sliceCol
+    px = x / layout["sliceW"] - sliceCol
+    py = y / layout["sliceH"] - sliceRow
+    z = channel * layout["nSlices"] + sliceIndex
+    pz = z.astype(np.float32) / layout["texLevels"]
+
+    return np.column_stack([px, py, pz]).astype(np.float32)
+
+
+def sample3DTexture(texture, p, layout):
+    '''
+    Samples the tiled texture at positions in the unit cube, using
+    nearest neighbour lookups and clamping to the texture edge.
+    Positions outside of the unit cube sample as 0.
+
+    Args:
+        * texture (np.Array): scaled i x j x 3 (or 4) texture, or uint8 data
+            when layout has a "lookup" (see makeLookup)
+        * p (np.Array): N x 3 positions
+        * layout (dict): see getLayout
+
+    returns np.Array of N samples
+
+    '''
+    height, width = texture.shape[:2]
+    inside = np.all((p <= 1.0) & (p >= 0.0), axis=1)
+
+    zLevel = np.floor(p[:, 2] * layout["texLevels"])
+    zIndex = np.floor(zLevel / layout["nSlices"])
+    sliceIndex = zLevel - zIndex * layout["nSlices"]
+    oSliceRow = np.floor(sliceIndex / layout["nSlicesPerRow"])
+    sliceRow = layout["maxRow"] - oSliceRow
+    sliceCol = sliceIndex - layout["nSlicesPerRow"] * oSliceRow
+
+    u = (p[:, 0] + sliceCol) * layout["sliceW"] / layout["textureShape"][0]
+    v = (p[:, 1] + sliceRow) * layout["sliceH"] / layout["textureShape"][1]
+    col = np.clip(np.floor(u * width), 0, width - 1).astype(np.intp)
+    row = np.clip(np.floor(v * height), 0, height - 1).astype(np.intp)
+
+    # zIndex of nChannels only occurs at p.z == 1.0, where the shader
+    # reads an unset datum. Treat it as empty.
+    valid = inside & (zIndex >= 0) & (zIndex < layout["nChannels"])
+    datum = np.zeros(p.shape[0], dtype=np.float32)
+    texel = texture[row[valid], col[valid], zIndex[valid].astype(np.intp)]
+    if "lookup" in layout:
+        texel = layout["lookup"][texel]
+    datum[valid] = texel
+
+    return datum
+
+
+def makeOccupancy(texture, layout, brickSizes=(4, 16)):
+    '''
+    Builds a pyramid of which bricks of the volume hold any data, so
+    that rays can jump over empty space. Each level divides the volume
+    (in texels of a slice, and texture levels) into cubes of brickSize
+    texels.
+
+    Occupied texels are grown by one texel in every direction first, so
+    a position which rounds onto a neighbouring texel when sampled is
+    still covered. Only square textures, as made by tileArray, map one
+    volume texel to one texture texel; None is returned for others.
+
+    Args:
+        * texture (np.Array): i x j x 3 texture (scaled or uint8)
+        * layout (dict): see getLayout
+        * brickSizes (tuple): brick size of each level, finest first
+
+    returns list of dicts, one per level, of the nbz x nby x nbx
+    "occupied" bricks and the "brickShape" of a brick in the unit cube
+
+    '''
+    if texture.shape[0] != texture.shape[1]:
+        return None
+
+    sliceW, sliceH = int(layout["sliceW"]), int(layout["sliceH"])
+    nLevels = int(layout["texLevels"])
+    jj, ii = np.mgrid[0:sliceH, 0:sliceW]
+    px = ((ii.ravel() + 0.5) / sliceW).astype(np.float32)
+    py = ((jj.ravel() + 0.5) / sliceH).astype(np.float32)
+    volume = np.empty([nLevels, sliceH, sliceW], dtype=bool)
+    for z in range(nLevels):
+        pz = np.empty_like(px)
+        pz.fill((z + 0.5) / nLevels)
+        p = np.column_stack([px, py, pz])
+        volume[z] = (sample3DTexture(texture, p, layout) > 0).reshape(sliceH, sliceW)
+
+    for axis in range(3):
+        grown = volume.copy()
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        grown[tuple(upper)] |= volume[tuple(lower)]
+        grown[tuple(lower)] |= volume[tuple(upper)]
+        volume = grown
+
+    levels = []
+    for size in brickSizes:
+        nBricks = [-(-n // size) for n in volume.shape]
+        padded = np.zeros([n * size for n in nBricks], dtype=bool)
+        padded[:nLevels, :sliceH, :sliceW] = volume
+        occupied = padded.reshape(nBricks[0], size, nBricks[1], size, nBricks[2], size)
+        occupied = occupied.any(axis=5).any(axis=3).any(axis=1)
+        levels.append({"occupied": occupied,
+                       "brickShape": np.array([size / sliceW, size / sliceH, size / nLevels],
+                                              dtype=np.float32)})
+
+    return levels
+
+
+def stepsToSkip(position, deltaDirection, occupancy):
+    '''
+    The number of steps each ray can take before it can reach any data,
+    using the coarsest empty brick of the occupancy pyramid that it is in.
+    0 for rays in an occupied brick of the finest level, which need
+    sampling.
+
+    Args:
+        * position (np.Array): N x 3 current positions
+        * deltaDirection (np.Array): the step of the rays
+        * occupancy (list): see makeOccupancy
+
+    returns np.Array of N step counts
+
+    '''
+    skip = np.zeros(position.shape[0], dtype=np.int64)
+    moving = deltaDirection != 0
+    for level in occupancy:
+        occupied = level["occupied"]
+        brick = np.floor(position / level["brickShape"])
+        index = np.clip(brick, 0, np.array(occupied.shape[::-1]) - 1).astype(np.intp)
+        empty = ~occupied[index[:, 2], index[:, 1], index[:, 0]]
+        if not empty.any():
+            # coarser levels contain this one, so are occupied too
+            break
+
+        # steps until the ray crosses the face of the brick it is heading for
+        lower = brick[empty] * level["brickShape"]
+        face = np.where(deltaDirection > 0, lower + level["brickShape"], lower)
+        exit = np.where(moving, (face - position[empty]) / np.where(moving, deltaDirection, 1), np.inf)
+        steps = np.maximum(np.floor(exit.min(axis=1)), 1).astype(np.int64)
+        skip[empty] = np.maximum(skip[empty], steps)
+
+    return skip
+
+
+def getPathRGBA(texture, startPos, direction, steps, alphaCorrection, ambient, layout,
+                occupancy=None):
+    '''
+    Calculates the total alpha along paths through the texture,
+    marching all rays in step.
+
+    Rays stop once they have absorbed (1 - ambient) of the light, as in
+    the shader. Rays which have left the unit cube can never re-enter it,
+    so only sample 0 and are dropped early. With an occupancy pyramid,
+    rays jump over bricks with no data rather than sampling 0 at every
+    step, so the work scales with the amount of cloud.
+
+    Args:
+        * texture (np.Array): scaled i x j x 3 texture
+        * startPos (np.Array): N x 3 start positions
+        * direction (3-tuple): direction of the light
+        * steps (int): how many steps to take through the data
+        * alphaCorrection (float): alpha scaling per unit of data
+        * ambient (float): amount of ambient light in the scene
+        * layout (dict): see getLayout
+        * occupancy (list): see makeOccupancy
+
+    returns np.Array of N alphas
+
+    '''
+    direction = np.asarray(direction, dtype=np.float32)
+    rayLength = np.float32(np.sqrt(np.sum(direction**2)))
+    delta = np.float32(1.0 / steps)
+    deltaDirection = (direction / rayLength * delta).astype(np.float32)
+    threshold = np.float32(1.0 - ambient)
+
+    # the steps taken before the ray length is reached
+    maxSteps = 0
+    accumulatedLength = np.float32(0.0)
+    for _ in range(int(steps)):
+        maxSteps += 1
+        accumulatedLength += delta
+        if accumulatedLength >= rayLength:
+            break
+
+    accumulatedAlpha = np.zeros(startPos.shape[0], dtype=np.float32)
+    active = np.arange(startPos.shape[0])
+    currentPosition = startPos.copy()
+    taken = np.zeros(startPos.shape[0], dtype=np.int64)
+
+    while active.size:
+        if occupancy is None:
+            skip = np.zeros(active.size, dtype=np.int64)
+        else:
+            skip = stepsToSkip(currentPosition, deltaDirection, occupancy)
+        sample = skip == 0
+        datum = sample3DTexture(texture, currentPosition[sample], layout)
+        alpha = accumulatedAlpha[active[sample]]
+        alpha += (1.0 - alpha) * datum * np.float32(alphaCorrection)
+        accumulatedAlpha[active[sample]] = alpha
+
+        skip[sample] = 1
+        if occupancy is None:
+            currentPosition += deltaDirection
+        else:
+            currentPosition += deltaDirection * skip[:, np.newaxis].astype(np.float32)
+        taken += skip
+
+        left = np.any(((currentPosition > 1.0) & (deltaDirection > 0)) |
+                      ((currentPosition < 0.0) & (deltaDirection < 0)), axis=1)
+        keep = (accumulatedAlpha[active] < threshold) & ~left & (taken < maxSteps)
+        active = active[keep]
+        currentPosition = currentPosition[keep]
+        taken = taken[keep]
+
+    return np.minimum(accumulatedAlpha, 1.0)
+
+
+def _initWorker(texture, layout, occupancy, lightPositions, steps, alphaCorrection, ambience):
+    _worker.update(texture=texture,
+                   layout=layout,
+                   occupancy=occupancy,
+                   lightPositions=lightPositions,
+                   steps=steps,
+                   alphaCorrection=alphaCorrection,
+                   ambience=ambience)
+
+
+def _shadeBlock(rows):
+    '''
+    Calculates the shadows of every light for a block of texture rows
+    using the state set up by _initWorker. The ray start positions are
+    worked out once and shared by the lights.
+
+    '''
+    texture = _worker["texture"]
+    layout = _worker["layout"]
+    lightPositions = _worker["lightPositions"]
+    height, width = texture.shape[:2]
+    rowStart, rowStop = rows
+
+    jj, ii = np.mgrid[rowStart:rowStop, 0:width]
+    # v_texCoord * textureShape, at the pixel centres
+    x = ((ii.ravel() + 0.5) / width * layout["textureShape"][0]).astype(np.float32)
+    y = ((jj.ravel() + 0.5) / height * layout["textureShape"][1]).astype(np.float32)
+
+    block = np.empty([len(lightPositions), rowStop - rowStart, width, layout["nChannels"]],
+                     dtype=np.uint8)
+    for channel in range(layout["nChannels"]):
+        startPos = mapTo3D(x, y, channel, layout)
+        for light, lightPosition in enumerate(lightPositions):
+            absorbed = getPathRGBA(texture, startPos,
+                                   lightPosition,
+                                   _worker["steps"],
+                                   _worker["alphaCorrection"],
+                                   _worker["ambience"],
+                                   layout,
+                                   _worker["occupancy"])
+            # quantise as the 8 bit framebuffer does
+            block[light, ..., channel] = np.floor(absorbed * 255 + 0.5).reshape(block.shape[1:3])
+
+    return block
+
+
+def procShadows(dataArray,
+                dataShape=(623, 812, 70),
+                lightPosition=(20, 0, 0),
+                steps=81,
+                alphaScale=2,
+                ambience=0.3,
+                processes=None,
+                blockRows=64,
+                skipEmpty=True):
+    '''
+    Given a tiled data array and a light position, computes the shadows
+    on the data without OpenGL. Takes the same arguments and gives the same
+    output as shadowproc.procShadows.
+
+    Args:
+        * dataArray (array): data for which to calculate shadows
+        * dataShape (3-tuple): 3D shape of the data field
+        * lightPosition (3-tuple): position of the point light
+        * steps (int): how many steps to take through the data in calculations
+        * alphaScale (int): factor to scale the light absorption
+        * ambience (float): amount of ambient light in the scene
+        * processes (int): number of worker processes, defaults to all cores
+        * blockRows (int): number of texture rows processed per task
+        * skipEmpty (bool): jump over empty space, see makeOccupancy
+
+    returns i x j x 3 (or 4, as dataArray) uint8 np.Array
+
+    '''
+    return procShadowsBatch(dataArray, [lightPosition],
+                            dataShape=dataShape,
+                            steps=steps,
+                            alphaScale=alphaScale,
+                            ambience=ambience,
+                            processes=processes,
+                            blockRows=blockRows,
+                            skipEmpty=skipEmpty)[0]
+
+
+def procShadowsBatch(dataArray,
+                     lightPositions,
+                     dataShape=(623, 812, 70),
+                     steps=81,
+                     alphaScale=2,
+                     ambience=0.3,
+                     processes=None,
+                     blockRows=64,
+                     skipEmpty=True):
+    '''
+    Computes the shadows for several lights in one pass over the
+    texture, sharing the worker pool, the texture and the ray start
+    positions between them. Takes the same arguments as procShadows,
+    but with a list of light positions.
+
+    returns N x i x j x 3 (or 4) uint8 np.Array, the shadows of each light
+
+    '''
+    layout = getLayout(dataShape, dataArray.shape[:2], dataArray.shape[2])
+    if dataArray.dtype == np.uint8:
+        texture = dataArray
+        layout["lookup"] = makeLookup(dataArray)
+    else:
+        texture = makeTexture(dataArray)
+    occupancy = makeOccupancy(texture, layout) if skipEmpty else None
+    initargs = (texture, layout, occupancy, list(lightPositions), steps, alphaScale/float(steps), ambience)
+
+    height = dataArray.shape[0]
+    blocks = [(start, min(start + blockRows, height))
+              for start in range(0, height, blockRows)]
+
+    if processes is None:
+        processes = mp.cpu_count()
+
+    if processes == 1:
+        _initWorker(*initargs)
+        shaded = [_shadeBlock(rows) for rows in blocks]
+    else:
+        pool = mp.Pool(processes, initializer=_initWorker, initargs=initargs)
+        try:
+            shaded = pool.map(_shadeBlock, blocks)
+        finally:
+            pool.close()
+            pool.join()
+
+    return np.concatenate(shaded, axis=1)
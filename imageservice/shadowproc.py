@@ -1,14 +1,25 @@
 from __future__ import division
 
 import numpy as np
-from vispy import app
-from vispy import gloo
-from vispy.gloo.util import _screenshot
-import OpenGL.GL as gl
 import os
 homeDir = os.path.dirname(__file__)
 
-app.use_app("glfw")
+import sys
+sys.path.append(".")
+import metrics
+import shadowcpu
+
+import config as conf
+
+try:
+    from vispy import app
+    from vispy import gloo
+    from vispy.gloo.util import _screenshot
+    import OpenGL.GL as gl
+    app.use_app(conf.gl_backend)
+except (ImportError, RuntimeError):
+    # headless workers without a display stack can still use the cpu engine
+    app = gloo = gl = None
 
 
 def makeTexture(dataArray):
@@ -19,7 +30,13 @@ def makeTexture(dataArray):
     
     returns gloo.Texture2D
 
+    uint8 data is uploaded as it is, and read by the shader as 0-1
+    of 255 rather than of its max (see procShadows).
+
     '''
+    if dataArray.dtype == np.uint8:
+        return gloo.Texture2D(dataArray)
+
     scaledData = dataArray / dataArray.max()
     tex = gloo.Texture2D(scaledData.astype(np.float32))
 
@@ -36,19 +53,52 @@ def getShader(shaderPath):
     returns string
 
     '''
-    shaderFile = open(shaderPath, 'rb')
+    shaderFile = open(shaderPath, 'r')
     shader = shaderFile.read()
     shaderFile.close()
 
     return shader
 
 
-def makeProgram(vShader, fShader, texture, dataShape, textureShape, tileLayout):
+def makeOccupancyTexture(dataArray, dataShape, skipEmpty=True):
+    '''
+    Makes a texture of which bricks of the volume hold any data (the
+    finest level of shadowcpu.makeOccupancy), so the shader can jump
+    over empty space. Without skipEmpty, or for textures which
+    makeOccupancy does not support, the whole volume is one occupied
+    brick so every step is sampled.
+
+    Args:
+        * dataArray (array): tiled data
+        * dataShape (3-tuple)
+        * skipEmpty (bool)
+
+    returns gloo.Texture2D, occupancy shape and brick shape
+
+    '''
+    occupancy = None
+    if skipEmpty:
+        layout = shadowcpu.getLayout(dataShape, dataArray.shape[:2], dataArray.shape[2])
+        occupancy = shadowcpu.makeOccupancy(dataArray, layout)
+    if occupancy is None:
+        return gloo.Texture2D(np.full([1, 1], 255, dtype=np.uint8)), (1, 1, 1), (1, 1, 1)
+
+    occupied = occupancy[0]["occupied"]
+    nbz, nby, nbx = occupied.shape
+    # nbz * nby rows of nbx bricks
+    tex = gloo.Texture2D((occupied.reshape(nbz * nby, nbx) * 255).astype(np.uint8))
+
+    return tex, (nbx, nby, nbz), tuple(occupancy[0]["brickShape"])
+
+
+def makeProgram(vShader, fShader, texture, dataShape, textureShape, tileLayout,
+                occupancy=None, nChannels=3):
     '''
     Sets up a program with the given vertex and fragment shaders, and sets 
     the following shader attributes:
         dataTexture, textureShape, u_resolution, dataShape,
-        nSlices, texLevels, nSlicesPerRow, maxRow, a_position
+        nSlices, nChannels, texLevels, nSlicesPerRow, maxRow, a_position,
+        occupancyTexture, occupancyShape, brickShape
     
     Args:
         * vShader (str)
@@ -57,6 +107,8 @@ def makeProgram(vShader, fShader, texture, dataShape, textureShape, tileLayout):
         * dataShape (3-tuple)
         * textureShape (2-tuple)
         * tileLayout (2-tuple)
+        * occupancy (tuple): see makeOccupancyTexture
+        * nChannels (int): 3 (RGB) or 4 (RGBA) texture
 
     returns gloo.Program
 
@@ -69,10 +121,15 @@ def makeProgram(vShader, fShader, texture, dataShape, textureShape, tileLayout):
 
     nTiles = tileLayout[0] * tileLayout[1]
     program['nSlices'] = nTiles
-    program['texLevels'] = nTiles * 3
+    program['nChannels'] = nChannels
+    program['texLevels'] = nTiles * nChannels
     program['nSlicesPerRow'] = tileLayout[0]
     program['maxRow'] = tileLayout[1] - 1
 
+    if occupancy is None:
+        occupancy = makeOccupancyTexture(None, dataShape, skipEmpty=False)
+    program['occupancyTexture'], program['occupancyShape'], program['brickShape'] = occupancy
+
     width = textureShape[0]
     height = textureShape[1]
     my_positions_array = np.array([ (0, 0), (0, height), (width, 0), (width, height) ])
@@ -116,8 +173,8 @@ def setAmbientLight(program, strength):
     program['ambient'] = strength
 
 
-class Canvas(app.Canvas):
-    def __init__(self, size, program):
+class Canvas(app.Canvas if app is not None else object):
+    def __init__(self, size, program, lightPositions):
         # We hide the canvas upon creation.
         app.Canvas.__init__(self, show=False, size=size)
         # Texture where we render the scene.
@@ -128,20 +185,23 @@ class Canvas(app.Canvas):
                                      gloo.RenderBuffer(self.true_size))
         # Regular program that will be rendered to the FBO.
         self.program = program
-        self.shadowsArray = None
-
-        self.update()
-
-    def on_draw(self, event):
-        # Render in the FBO.
+        self.lightPositions = lightPositions
+        self.shadowsArrays = []
+
+    def render(self):
+        # Render in the FBO, once for each light, reusing the
+        # program and the texture already on the GPU. This draws
+        # directly rather than from the event loop, which can only
+        # be run once per process with some backends.
+        self.set_current()
         with self._fbo:
-            gloo.clear((1,1,1,1))
             gloo.set_viewport(0, 0, *self.true_size)
-            self.program.draw(gl.GL_TRIANGLE_STRIP)
-            # Retrieve the contents of the FBO texture.
-            self.shadowsArray = _screenshot((0, 0, self.true_size[0], self.true_size[1]))
-        # Immediately exit the application.
-        app.quit()
+            for position in self.lightPositions:
+                setLightPosition(self.program, position)
+                gloo.clear((1,1,1,1))
+                self.program.draw(gl.GL_TRIANGLE_STRIP)
+                # Retrieve the contents of the FBO texture.
+                self.shadowsArrays.append(_screenshot((0, 0, self.true_size[0], self.true_size[1])))
 
 
 def procShadows(dataArray,
@@ -149,21 +209,83 @@ def procShadows(dataArray,
                 lightPosition=(20, 0, 0),
                 steps=81,
                 alphaScale=2,
-                ambience=0.3):
+                ambience=0.3,
+                engine="gl",
+                processes=None,
+                skipEmpty=True):
     '''
     Given a tiled data PNG file and a light position, computes the shadows
     on the data and writes them to a second PNG.
 
+    The "gl" engine renders with the shader in shadow_frag.glsl and needs
+    an OpenGL driver, and a display unless conf.gl_backend is "egl". The "cpu" engine is a numpy port of the
+    same shader (see shadowcpu.py) which runs on headless workers.
+
     Args:
         * dataArray (array): data for which to calculate shadows
         * dataShape (3-tuple): 3D shape of the data field
         * lightPosition (3-tuple): position of the point light
         * steps (int): how many steps to take through the data in calculations
         * alphaScale (int): factor to scale the light absorption
+        * ambience (float): amount of ambient light in the scene
+        * engine (str): "gl" or "cpu"
+        * processes (int): number of processes used by the cpu engine,
+            defaults to all cores
+        * skipEmpty (bool): jump over empty space when ray marching,
+            which gives the same shadows in less time
         
     '''
+    return procShadowsBatch(dataArray, [lightPosition],
+                            dataShape=dataShape,
+                            steps=steps,
+                            alphaScale=alphaScale,
+                            ambience=ambience,
+                            engine=engine,
+                            processes=processes,
+                            skipEmpty=skipEmpty)[0]
+
+
+@metrics.timed("procShadows")
+def procShadowsBatch(dataArray,
+                     lightPositions,
+                     dataShape=(623, 812, 70),
+                     steps=81,
+                     alphaScale=2,
+                     ambience=0.3,
+                     engine="gl",
+                     processes=None,
+                     skipEmpty=True):
+    '''
+    Computes the shadows on the data for several lights at once, e.g.
+    a set of sun angles. The texture, program and canvas (or the cpu
+    engine's workers and ray start positions) are set up once and shared
+    by all of the lights.
+
+    Takes the same arguments as procShadows, but with a list of
+    light positions.
+
+    returns N x i x j x 3 (or 4, as dataArray) uint8 np.Array, the
+    shadows of each light
+
+    '''
+    if engine == "cpu":
+        return shadowcpu.procShadowsBatch(dataArray, lightPositions,
+                                          dataShape=dataShape,
+                                          steps=steps,
+                                          alphaScale=alphaScale,
+                                          ambience=ambience,
+                                          processes=processes,
+                                          skipEmpty=skipEmpty)
+    elif engine != "gl":
+        raise ValueError("Unknown shadow engine %s" % engine)
+    if app is None:
+        raise RuntimeError("The gl shadow engine needs vispy and OpenGL - use the cpu engine on headless workers")
 
     dataTexture = makeTexture(dataArray)
+    if dataArray.dtype == np.uint8:
+        # the shader reads uint8 texels as 0-1 of 255, so scale the
+        # absorption to give the same alpha as scaling the data by its max
+        alphaScale = alphaScale * 255.0 / max(dataArray.max(), 1)
     textureShape = dataArray.shape[:2]
     tileLayout = (int(textureShape[0]/dataShape[0]),
                   int(textureShape[1]/dataShape[1]))
@@ -173,15 +295,17 @@ def procShadows(dataArray,
     program = makeProgram(vertex, fragment, dataTexture,
                         dataShape=dataShape, 
                         textureShape=textureShape,
-                        tileLayout=tileLayout)
-    setLightPosition(program, lightPosition)
+                        tileLayout=tileLayout,
+                        occupancy=makeOccupancyTexture(dataArray, dataShape, skipEmpty),
+                        nChannels=dataArray.shape[2])
     setResolution(program, steps, alphaScale)
     setAmbientLight(program, ambience)
 
-    c = Canvas(size=textureShape, program=program)
-    app.run()
+    c = Canvas(size=textureShape, program=program, lightPositions=lightPositions)
+    c.render()
+    c.close()
 
-    render = c.shadowsArray[:, :, :3]
+    render = np.stack([shadows[:, :, :dataArray.shape[2]] for shadows in c.shadowsArrays])
 
     return render
 
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+import argparse as ap
+import glob
+import json
+import numpy as np
+import os
+import tempfile
+
+import sys
+sys.path.append(".")
+import config as conf
+import imageproc
+
+"""
+volumestore.py keeps the intermediate volumes of each time slice on
+disk as .npy files, so that later stages can be rerun without
+regridding again, e.g. after changing the shadow parameters. The
+volumes are read back memory-mapped, so they are not copied into
+memory until they are used. Used by serveupimage.py with
+profile.volume_store. The volumes are only reused for the same input
+data, so a file which is published again with corrections is
+processed again.
+
+A stage can be rebuilt for a whole run from the stage before it:
+
+    ./volumestore.py --profile default --run 2015-01-01T00:00:00.000Z --stage shadows
+    ./volumestore.py --profile default --run 2015-01-01T00:00:00.000Z --stage post
+
+"""
+
+# each stage is made from the one before it
+STAGES = ["proced", "tiled", "shadows"]
+
+
+def stageSettings(profile, lod_factor=1, phenomenon=None, input_key=None):
+    """
+    The input and profile settings each stage depends on, so that
+    volumes made from other data or with other settings are not reused.
+
+    Args:
+        * profile (namespace): see config.profiles
+        * lod_factor (int): downsampling factor of the level of detail
+        * phenomenon (dict): one of profile.phenomena, defaults to the first
+        * input_key (str): identifies the time slice's data, see
+            resultcache.dataKey
+
+    """
+    if phenomenon is None:
+        phenomenon = profile.phenomena[0]
+    proced = {"input": input_key,
+              "extent": list(profile.extent),
+              "regrid_shape": list(profile.regrid_shape),
+              "restratify_engine": profile.restratify_engine,
+              "lean": profile.lean,
+              "lod_factor": lod_factor,
+              "value_range": list(phenomenon["value_range"])}
+    layout = imageproc.planProfileTexture(profile, lod_factor)
+    tiled = dict(proced, field_width=layout["width"],
+                 field_height=layout["height"],
+                 channels=layout["channels"])
+    shadows = dict(tiled, light_positions=[list(p) for p in profile.light_positions],
+                   shadow_engine=profile.shadow_engine)
+
+    return {"proced": proced, "tiled": tiled, "shadows": shadows}
+
+
+def _writeAtomic(path, write):
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        write(f)
+    # rename is atomic, so readers never see a partial file
+    os.rename(temp_path, path)
+
+
+class SliceVolumes(object):
+    """
+    The stored volumes of one time slice at one level of detail.
+
+    Args:
+        * path (str): directory of the slice's volumes
+        * settings (dict): settings of each stage, see stageSettings
+
+    """
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    def load(self, stage):
+        """
+        Returns a stage's volume as a read only memory-mapped array, or
+        None if it is not stored or was made with other settings.
+
+        """
+        try:
+            with open(self._path(stage + ".json")) as f:
+                settings = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if settings != json.loads(json.dumps(self.settings[stage])):
+            return None
+
+        return np.load(self._path(stage + ".npy"), mmap_mode="r")
+
+    def loadLayout(self, stage="tiled"):
+        """
+        The layout a stage's texture was tiled with, see save.
+
+        """
+        with open(self._path(stage + "_layout.json")) as f:
+            return json.load(f)
+
+    def storedInput(self):
+        """
+        The input key (see stageSettings) of the stored volumes, or
+        None if there are none.
+
+        """
+        for stage in STAGES:
+            try:
+                with open(self._path(stage + ".json")) as f:
+                    return json.load(f).get("input")
+            except (IOError, OSError, ValueError):
+                continue
+        return None
+
+    def save(self, stage, volume, layout=None):
+        """
+        Stores a stage's volume, replacing the volumes of the later
+        stages which were made from the old one. A tiled texture is
+        stored with its layout (see imageproc.textureLayout), which
+        its shadows are rendered with.
+
+        """
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # made by another process in the meantime
+                pass
+        for later in STAGES[STAGES.index(stage):]:
+            try:
+                os.remove(self._path(later + ".json"))
+            except OSError:
+                pass
+        _writeAtomic(self._path(stage + ".npy"),
+                     lambda f: np.save(f, np.ascontiguousarray(volume)))
+        if layout is not None:
+            _writeAtomic(self._path(stage + "_layout.json"),
+                         lambda f: f.write(json.dumps(layout).encode("utf-8")))
+        _writeAtomic(self._path(stage + ".json"),
+                     lambda f: f.write(json.dumps(self.settings[stage]).encode("utf-8")))
+
+    def loadPayload(self):
+        with open(self._path("payload.json")) as f:
+            return json.load(f)
+
+    def savePayload(self, payload):
+        """
+        Stores the post metadata, so the slice can be posted again
+        from its volumes, see networking.getPostDict.
+
+        """
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass
+        _writeAtomic(self._path("payload.json"),
+                     lambda f: f.write(json.dumps(payload).encode("utf-8")))
+
+
+class VolumeStore(object):
+    """
+    A directory of slice volumes, by profile, run (forecast reference
+    time), forecast time and level of detail, and phenomenon.
+
+    Args:
+        * path (str): store directory
+
+    """
+    def __init__(self, path=conf.volume_store_dir):
+        self.path = path
+
+    def slice(self, profilename, run, forecast_time, settings, lod_factor=1,
+              phenomenon="cloud_fraction_in_a_layer"):
+        """
+        The volumes of a slice, see SliceVolumes.
+
+        """
+        name = forecast_time if lod_factor == 1 else "%s_lod%d" % (forecast_time, lod_factor)
+        return SliceVolumes(os.path.join(self.path, profilename, run, name, phenomenon), settings)
+
+    def slices(self, profilename, run, profile):
+        """
+        The stored slices of a run, in forecast time order, with the
+        profile's settings and the input they were stored from.
+        Phenomena which are no longer in the profile are left out.
+
+        """
+        phenomena = dict((p["name"], p) for p in profile.phenomena)
+        volumes = []
+        for path in sorted(glob.glob(os.path.join(self.path, profilename, run, "*", "*"))):
+            name = os.path.basename(os.path.dirname(path))
+            lod_factor = int(name.split("_lod")[1]) if "_lod" in name else 1
+            phenomenon = phenomena.get(os.path.basename(path))
+            if phenomenon is not None:
+                slice_volumes = SliceVolumes(path, None)
+                slice_volumes.settings = stageSettings(profile, lod_factor, phenomenon,
+                                                       slice_volumes.storedInput())
+                volumes.append(slice_volumes)
+
+        return volumes
+
+
+def _require(volumes, stage):
+    volume = volumes.load(stage)
+    if volume is None:
+        raise IOError("%s has no %s volume with the current settings" % (volumes.path, stage))
+    return volume
+
+
+def rebuildStage(volumes, stage, profile):
+    """
+    Remakes a stage of a slice from the stage before it, or with
+    stage "post", encodes and posts the slice again.
+
+    """
+    import encoders
+    import networking
+    import shadowproc
+
+    settings = volumes.settings["tiled"]
+    if stage == "tiled":
+        proced = np.asarray(_require(volumes, "proced"))
+        layout = imageproc.textureLayout(proced.shape, settings["field_width"],
+                                         settings["field_height"], settings["channels"])
+        volumes.save("tiled", imageproc.tileArray(proced,
+                                                  settings["field_width"],
+                                                  settings["field_height"],
+                                                  settings["channels"]),
+                     layout)
+    elif stage == "shadows":
+        volumes.save("shadows", shadowproc.procShadowsBatch(_require(volumes, "tiled"),
+                                                            profile.light_positions,
+                                                            dataShape=tuple(volumes.loadLayout()["dataShape"]),
+                                                            engine=profile.shadow_engine))
+    elif stage == "post":
+        img_array = np.concatenate([_require(volumes, "tiled")] +
+                                   list(_require(volumes, "shadows")), 1)
+        encoder = encoders.makeEncoder(profile)
+        payload = dict(volumes.loadPayload(), mime_type=encoder.mime_type)
+        img = networking.encodeImage(img_array, settings["field_width"], settings["field_height"],
+                                     encoder=encoder)
+        networking.postEncodedImage(img, payload)
+    else:
+        raise ValueError("Cannot rebuild stage %s" % stage)
+
+
+if __name__ == "__main__":
+    argparser = ap.ArgumentParser()
+    argparser.add_argument("-a", "--profile", default="default",
+        type=str, help="Name of analysis settings, as defined in config.py")
+    argparser.add_argument("-r", "--run", required=True,
+        type=str, help="Forecast reference time of the run, as posted")
+    argparser.add_argument("-s", "--stage", required=True,
+        choices=STAGES[1:] + ["post"], help="Stage to rebuild from the one before it")
+    call_args = argparser.parse_args()
+    profile = ap.Namespace(**conf.profiles[call_args.profile])
+
+    store = VolumeStore()
+    for volumes in store.slices(call_args.profile, call_args.run, profile):
+        print("Rebuilding %s of %s" % (call_args.stage, volumes.path))
+        rebuildStage(volumes, call_args.stage, profile)
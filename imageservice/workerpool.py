@@ -0,0 +1,120 @@
+import logging
+import multiprocessing as mp
+import signal
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+"""
+workerpool.py contains a fixed pool of long lived worker processes,
+fed from a bounded job queue. Used by imageservice.py so that each
+file does not pay for starting a new python process and re-importing
+iris, vispy etc.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def _work(target, jobs, initializer):
+    # interrupts are handled by the parent, which drains the queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer()
+    while True:
+        job = jobs.get()
+        try:
+            if job is None:
+                return
+            target(*job)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            jobs.task_done()
+
+
+class WorkerPool(object):
+    """
+    A fixed number of warm worker processes which take jobs from a
+    bounded queue. Submitting blocks when the queue is full, which
+    applies backpressure to whoever is submitting.
+
+    Workers are not daemonic so that they can start their own
+    processes (e.g. the cpu shadow engine).
+
+    Args:
+        * target (callable): module level function called with the
+            arguments of each job
+        * processes (int): number of worker processes
+        * maxsize (int): maximum number of jobs waiting in the queue
+        * initializer (callable): called once in each worker on start up,
+            e.g. to import modules and load static data
+
+    """
+    def __init__(self, target, processes=2, maxsize=16, initializer=None):
+        self.target = target
+        self.processes = processes
+        self.initializer = initializer
+        self.jobs = mp.JoinableQueue(maxsize)
+        self.workers = []
+        self.closed = False
+
+    def _startWorker(self):
+        worker = mp.Process(target=_work, args=(self.target, self.jobs, self.initializer))
+        worker.start()
+        return worker
+
+    def start(self):
+        self.workers = [self._startWorker() for _ in range(self.processes)]
+        return self
+
+    def submit(self, *args, **kwargs):
+        """
+        Queues a job, blocking while the queue is full.
+
+        Args:
+            * args: arguments for the target
+            * timeout (float): raise Queue.Full if the job cannot be
+                queued within timeout seconds (default wait forever)
+
+        """
+        if self.closed:
+            raise ValueError("Pool is draining, no new jobs can be submitted")
+        timeout = kwargs.pop("timeout", None)
+        try:
+            self.jobs.put(args, block=False)
+        except queue.Full:
+            logger.warning("Job queue full, waiting to submit %s" % (args,))
+            self.jobs.put(args, timeout=timeout)
+
+    def qsize(self):
+        try:
+            return self.jobs.qsize()
+        except NotImplementedError:
+            # not available on all platforms
+            return -1
+
+    def checkWorkers(self):
+        """
+        Replaces any worker which has died (e.g. crashed in a driver),
+        so the pool stays at full strength.
+
+        """
+        for i, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                logger.warning("Worker %s exited with %s, restarting" % (worker.pid, worker.exitcode))
+                self.workers[i] = self._startWorker()
+
+    def drain(self):
+        """
+        Stops accepting jobs, waits for all queued jobs to finish
+        and then stops the workers.
+
+        """
+        self.closed = True
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import argparse as ap
+import numpy as np
+import os
+
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "imageservice"))
+import config as conf
+
+"""
+make_shadows_gl.py renders shadows_gl.npz, the fixture of ShadowTests:
+a synthetic 40 x 38 x 34 volume of two blobs and some noise, tiled
+into a 256 x 256 RGB texture, and its shadows for two lights rendered
+by the gl engine. The committed file was rendered with Mesa's llvmpipe
+driver through the egl backend:
+
+    EGL_PLATFORM=surfaceless ./tests/data/make_shadows_gl.py --gl-backend egl
+
+"""
+
+
+def makeVolume():
+    """
+    The synthetic volume, as uint8 data.
+
+    """
+    x, y, z = np.meshgrid(np.linspace(-1, 1, 40),
+                          np.linspace(-1, 1, 38),
+                          np.linspace(-1, 1, 34), indexing="ij")
+    blob = np.exp(-((x - 0.2)**2 + y**2 + (z + 0.3)**2) * 4) + \
+           0.5 * np.exp(-((x + 0.5)**2 + (y - 0.4)**2 + z**2) * 10)
+    noise = 0.1 * np.random.RandomState(1).rand(*blob.shape)
+
+    return (np.clip(blob + noise - 0.15, 0, 1) * 255).astype(np.uint8)
+
+
+def parseArgs():
+    parser = ap.ArgumentParser(description="Renders the gl engine shadows fixture")
+    parser.add_argument("--gl-backend", default=conf.gl_backend,
+                        help="vispy backend, e.g. egl to render without a display")
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         "shadows_gl.npz"))
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    call_args = parseArgs()
+    # the backend is chosen when shadowproc is imported
+    conf.gl_backend = call_args.gl_backend
+    import imageproc
+    import shadowproc
+
+    volume = makeVolume()
+    light_positions = np.array([(20, 0, 0), (0, 20, 5)])
+    tiled = imageproc.tileArray(volume, 256, 256)
+    data_shape = imageproc.textureLayout(volume.shape, 256, 256)["dataShape"]
+    shadows = shadowproc.procShadowsBatch(tiled, [tuple(p) for p in light_positions],
+                                          dataShape=data_shape)
+
+    np.savez_compressed(call_args.output, tiled=tiled, data_shape=np.array(data_shape),
+                        light_positions=light_positions, shadows=shadows)
@@ -6,18 +6,37 @@ import imageservice
 from imageservice import serveupimage
 from imageservice import networking
 from imageservice import shadowproc
+from imageservice import shadowcpu
 from imageservice import imageproc
+from imageservice import intake
+from imageservice import jobqueue
 from imageservice import dataproc
+from imageservice import encoders
+from imageservice import metrics
+from imageservice import resultcache
+from imageservice import volumestore
 from imageservice import config as conf
 import numpy as np
 import iris
-from numpy.testing import assert_array_equal
+import io
+import png
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 import os
 import shutil
+import tempfile
+import threading
 import time
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 fileDir = os.path.dirname(__file__)
 
+import sys
+sys.path.append(os.path.join(fileDir, "..", "benchmarks"))
+import stages
+
 class UnitTests(unittest.TestCase):
     def setUp(self):
         self.profile = ap.Namespace(**conf.profiles["default"])
@@ -39,14 +58,40 @@ class UnitTests(unittest.TestCase):
         proced_data = dataproc.procDataCube(rg_data)
 
         self.assertTrue(proced_data.data.max() <= conf.max_val)
-        assert_array_equal(self.proced_data.data, proced_data.data)
+        # floating point differences in the restratification can move a
+        # value across a rounding boundary of the 8 bit scaling
+        diff = np.abs(self.proced_data.data.astype(int) - proced_data.data.astype(int))
+        self.assertTrue(diff.max() <= 1)
+
+    def test_dataproc_downsample(self):
+        san_data = dataproc.sanitizeAlt(self.data)
+        rg_data = dataproc.regridData(san_data,
+                                      regrid_shape=self.profile.regrid_shape,
+                                      extent=self.profile.extent)
+        ds_data = dataproc.downsampleCube(rg_data, 2)
+
+        self.assertEqual(ds_data.shape, tuple(n // 2 for n in rg_data.shape))
+        self.assertAlmostEqual(ds_data.data[1, 1, 1], rg_data.data[2:4, 2:4, 2:4].mean())
+        self.assertAlmostEqual(ds_data.coord("altitude").points[0],
+                               rg_data.coord("altitude").points[:2].mean())
+
+    def test_dataproc_phenomena(self):
+        humidity = self.data.copy(data=self.data.data * 100)
+        rg_data = serveupimage.regridPhenomena([self.data.copy(), humidity],
+                                               self.profile.extent,
+                                               self.profile.regrid_shape)
+        proced_data = [dataproc.procDataCube(rg_data[0]),
+                       dataproc.procDataCube(rg_data[1], value_range=(0, 100))]
+
+        self.assertEqual(rg_data[0].shape, rg_data[1].shape)
+        assert_array_almost_equal(proced_data[0].data, proced_data[1].data)
 
     def test_imageproc(self):
         data_tiled = imageproc.tileArray(self.proced_data.data,
                                         self.profile.field_width,
                                         self.profile.field_height)
 
-        assert_array_equal(self.tiled_data, data_tiled)
+        assert_array_equal(self.tiled_data.astype(np.uint8), data_tiled)
 
     def test_shadowproc(self):
         tiled_shadows = shadowproc.procShadows(self.tiled_data,
@@ -62,6 +107,613 @@ class UnitTests(unittest.TestCase):
                              self.profile.field_height)
 
 
+class SyntheticDataprocTests(unittest.TestCase):
+    """
+    Processing of a synthetic UKV-like cube (see benchmarks/stages.py),
+    which runs without the model data files.
+
+    """
+    def setUp(self):
+        self.profile = ap.Namespace(**conf.profiles["default"])
+        self.regrid_shape = [40, 40, 10]
+        self.data = stages.makeCube(60, 50, 20)
+
+    def test_stream_cube(self):
+        # two times of model level data, without the altitude coord, which
+        # is derived from the topography file as the slices are streamed
+        times = []
+        for seed, hour in enumerate([394203, 394204]):
+            data = stages.makeCube(60, 50, 20, seed=seed)
+            data.coord("time").points = [hour]
+            times.append(data)
+        data = iris.cube.CubeList(times).merge_cube()
+        # as in the UKV files, so the levels are read as the Z axis
+        data.coord("model_level_number").attributes["positive"] = "up"
+        surface_altitude = data.coord("surface_altitude")
+        data.remove_aux_factory(data.aux_factory("altitude"))
+        data.remove_coord(surface_altitude)
+        topography = iris.cube.Cube(surface_altitude.points,
+                                    standard_name="surface_altitude",
+                                    units=surface_altitude.units,
+                                    dim_coords_and_dims=[(data.coord("grid_longitude").copy(), 0),
+                                                         (data.coord("grid_latitude").copy(), 1)])
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            data_file = os.path.join(temp_dir, "data.nc")
+            topog_file = os.path.join(temp_dir, "topography.nc")
+            iris.save(data, data_file)
+            iris.save(topography, topog_file)
+
+            time_slices = list(serveupimage.streamCube(data_file, topog_file, None,
+                                                       self.profile.extent,
+                                                       self.regrid_shape))
+            self.assertEqual(len(time_slices), 2)
+            for time_slice, seed in zip(time_slices, [0, 1]):
+                rg_data = dataproc.regridData(dataproc.sanitizeAlt(stages.makeCube(60, 50, 20, seed=seed)),
+                                              regrid_shape=self.regrid_shape,
+                                              extent=self.profile.extent)
+                rg_subset = dataproc.regridData(dataproc.sanitizeAlt(time_slice),
+                                                regrid_shape=self.regrid_shape,
+                                                extent=self.profile.extent)
+                assert_array_almost_equal(rg_data.data, rg_subset.data)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_dataproc_restratify(self):
+        san_data = dataproc.sanitizeAlt(self.data)
+        rs_data = dataproc.restratifyAltLevels(san_data, self.regrid_shape[2], engine="numpy")
+
+        log_alt = san_data.coord("log_altitude").points
+        log_alt = log_alt.transpose(np.argsort(san_data.coord_dims("log_altitude")))
+        log_levs = np.log(rs_data.coord("altitude").points)
+        # (19, 40) is on a hill, so its lowest levels are below ground
+        for i, j in [(0, 0), (10, 20), (19, 40), (-1, -1)]:
+            expected = np.interp(log_levs, log_alt[i, j], san_data.data[i, j],
+                                 left=np.nan, right=np.nan)
+            assert_array_almost_equal(np.ma.filled(rs_data.data[i, j], np.nan), expected)
+
+    def test_dataproc_lean(self):
+        san_data = dataproc.sanitizeAlt(self.data)
+        proced_data = dataproc.procDataCube(dataproc.regridData(san_data.copy(),
+                                                                regrid_shape=self.regrid_shape,
+                                                                extent=self.profile.extent))
+        lean_data = dataproc.procDataCube(dataproc.regridData(san_data.copy(),
+                                                              regrid_shape=self.regrid_shape,
+                                                              extent=self.profile.extent,
+                                                              dtype=np.float32),
+                                          lean=True)
+
+        self.assertEqual(lean_data.data.dtype, np.uint8)
+        diff = np.abs(proced_data.data.astype(np.uint8).astype(int) - lean_data.data)
+        self.assertTrue(diff.max() <= 1)
+
+    def test_dataproc_chunked(self):
+        rg_data = dataproc.regridData(dataproc.sanitizeAlt(self.data.copy()),
+                                      regrid_shape=self.regrid_shape,
+                                      extent=self.profile.extent,
+                                      shared={})
+        # small enough that every stage of the synthetic cube takes several blocks
+        chunked_data = dataproc.regridData(dataproc.sanitizeAlt(self.data.copy()),
+                                           regrid_shape=self.regrid_shape,
+                                           extent=self.profile.extent,
+                                           shared={},
+                                           budget=0.1)
+
+        assert_array_equal(rg_data.data.data, chunked_data.data.data)
+        assert_array_equal(rg_data.data.mask, chunked_data.data.mask)
+        for crd in rg_data.coords():
+            self.assertEqual(crd, chunked_data.coord(crd.name()))
+        assert_array_equal(dataproc.downsampleCube(rg_data, 2).data,
+                           dataproc.downsampleCube(chunked_data, 2, budget=0.1).data)
+        assert_array_equal(dataproc.procDataCube(rg_data).data.astype(np.uint8),
+                           dataproc.procDataCube(chunked_data, chunked=True).data)
+
+    def test_dataproc_regrid_weights(self):
+        san_data = dataproc.sanitizeAlt(self.data)
+        rs_data = dataproc.restratifyAltLevels(san_data, self.regrid_shape[2])
+        nlat, nlon = self.regrid_shape[1], self.regrid_shape[0]
+        rg_data = dataproc.horizRegrid(rs_data, nlat, nlon, self.profile.extent)
+
+        weights = dataproc.calcRegridWeights(rs_data, nlat, nlon, self.profile.extent)
+        cached_rg_data = dataproc.applyRegridWeights(rs_data, weights, nlat, nlon,
+                                                     self.profile.extent)
+
+        assert_array_equal(rg_data.data.mask, cached_rg_data.data.mask)
+        assert_array_almost_equal(rg_data.data, cached_rg_data.data)
+
+
+class ImageprocTests(unittest.TestCase):
+    def setUp(self):
+        self.volume = np.random.RandomState(0).randint(0, 256, (40, 38, 34)).astype(np.uint8)
+        self.tiled_data = imageproc.tileArray(self.volume, 256, 256)
+
+    def test_untile(self):
+        assert_array_equal(imageproc.untileArray(self.tiled_data, self.volume.shape), self.volume)
+
+        volume = self.volume[:, :, :4]
+        data_tiled = imageproc.tileArray(volume, 256, 256)
+        data_untiled = imageproc.untileArray(data_tiled, volume.shape)
+        assert_array_equal(data_untiled, volume)
+        self.assertTrue(np.may_share_memory(data_untiled, data_tiled))
+
+    def test_plan(self):
+        layout = imageproc.planTexture(self.volume.shape)
+        self.assertEqual((layout["width"], layout["height"], layout["channels"]), (128, 128, 4))
+        self.assertEqual((layout["nSlicesPerRow"], layout["maxRow"], layout["texLevels"]), (3, 2, 36))
+        self.assertEqual(layout["dataShape"], (42, 40, 34))
+        self.assertEqual(imageproc.planTexture(self.volume.shape, channels=[3])["width"], 256)
+        self.assertRaises(ValueError, imageproc.planTexture, self.volume.shape, max_size=64)
+
+    def test_rgba(self):
+        self.assertRaises(ValueError, imageproc.tileArray, self.volume, 128, 128)
+        data_tiled = imageproc.tileArray(self.volume, 128, 128, 4)
+        assert_array_equal(imageproc.untileArray(data_tiled, self.volume.shape), self.volume)
+
+        tiled_shadows = shadowproc.procShadows(data_tiled, dataShape=(42, 40, 34),
+                                               engine="cpu", processes=1)
+        self.assertEqual(tiled_shadows.shape, (128, 128, 4))
+
+    def test_png(self):
+        img = io.BytesIO()
+        imageproc.writePng(self.tiled_data, img,
+                           height=self.tiled_data.shape[0],
+                           width=self.tiled_data.shape[1],
+                           filter_type=4,
+                           threads=4)
+        width, height, rows, info = png.Reader(bytes=img.getvalue()).asDirect()
+        rows = np.vstack([np.asarray(row, dtype=np.uint8) for row in rows])
+
+        assert_array_equal(self.tiled_data.reshape(height, -1), rows)
+
+    def test_png_alpha(self):
+        rgba = imageproc.tileArray(self.volume, 128, 128, 4)
+        img = io.BytesIO()
+        imageproc.writePng(rgba, img, height=128, width=128, alpha=True)
+        width, height, rows, info = png.Reader(bytes=img.getvalue()).asDirect()
+        rows = np.vstack([np.asarray(row, dtype=np.uint8) for row in rows])
+
+        self.assertTrue(info["alpha"])
+        assert_array_equal(rgba.reshape(height, -1), rows)
+
+
+class EncoderTests(unittest.TestCase):
+    def setUp(self):
+        self.encoders = [encoders.PngEncoder(), encoders.RawEncoder(codec="zlib")]
+        if encoders.Image is not None:
+            self.encoders.append(encoders.WebpEncoder())
+
+    def test_rgb(self):
+        img = np.random.RandomState(0).randint(0, 256, (64, 128, 3)).astype(np.uint8)
+        for encoder in self.encoders:
+            data = networking.encodeImage(img, 64, 64, encoder=encoder)
+            assert_array_equal(encoder.decode(data), img)
+
+    def test_rgba(self):
+        img = np.random.RandomState(0).randint(0, 256, (64, 128, 4)).astype(np.uint8)
+        # data under fully transparent pixels must survive too
+        img[:32, :, 3] = 0
+        for encoder in self.encoders:
+            data = networking.encodeImage(img, 64, 64, encoder=encoder)
+            assert_array_equal(encoder.decode(data), img)
+
+    def test_grayscale(self):
+        for nchannels in [1, 2]:
+            img = np.random.RandomState(0).randint(0, 256, (64, 128, nchannels)).astype(np.uint8)
+            for encoder in self.encoders:
+                if isinstance(encoder, encoders.WebpEncoder):
+                    self.assertRaises(ValueError, encoder.encode, img)
+                    continue
+                data = networking.encodeImage(img, 64, 64, encoder=encoder)
+                assert_array_equal(encoder.decode(data), img)
+
+        profile = ap.Namespace(**dict(conf.profiles["default"], encoder="webp",
+                                      texture_plan=True, texture_channels=[1, 3]))
+        self.assertRaises(ValueError, encoders.makeEncoder, profile)
+
+
+class DeltaTests(unittest.TestCase):
+    def setUp(self):
+        self.frame = np.random.RandomState(0).randint(0, 256, (1024, 1024, 3)).astype(np.uint8)
+        self.changed = self.frame.copy()
+        self.changed[:40, :38] = 0
+
+    def test_delta(self):
+        delta = imageproc.encodeDelta(self.frame, self.changed)
+
+        assert_array_equal(imageproc.applyDelta(self.frame, delta), self.changed)
+        self.assertTrue(len(delta) < self.changed.nbytes / 100)
+
+    def test_delta_encoder(self):
+        img = b"0" * self.frame.nbytes
+        encoder = networking.DeltaEncoder(keyframe_interval=2)
+
+        frame_types = []
+        for i, f in enumerate([self.frame, self.changed, self.frame]):
+            body, payload = encoder.encode(f, img, {"forecast_time": str(i)})
+            frame_types.append(payload["frame_type"])
+        self.assertEqual(frame_types, ["key", "delta", "key"])
+        self.assertEqual(payload["forecast_time"], "2")
+
+
+class ShadowTests(unittest.TestCase):
+    """
+    Against shadows_gl.npz, the shadows of a synthetic 40 x 38 x 34
+    volume rendered by the gl engine (see data/make_shadows_gl.py).
+
+    """
+    def setUp(self):
+        fixture = np.load(os.path.join(fileDir, "data", "shadows_gl.npz"))
+        self.tiled_data = fixture["tiled"]
+        self.data_shape = tuple(fixture["data_shape"])
+        self.light_positions = [tuple(p) for p in fixture["light_positions"]]
+        self.gl_shadows = fixture["shadows"]
+
+    def test_cpu(self):
+        tiled_shadows = shadowproc.procShadowsBatch(self.tiled_data, self.light_positions,
+                                                    dataShape=self.data_shape,
+                                                    engine="cpu",
+                                                    processes=1)
+
+        assert_array_equal(tiled_shadows, self.gl_shadows)
+
+    def test_gl(self):
+        if shadowproc.app is None:
+            self.skipTest("vispy and OpenGL are not available")
+        tiled_shadows = shadowproc.procShadowsBatch(self.tiled_data, self.light_positions,
+                                                    dataShape=self.data_shape)
+
+        diff = np.abs(tiled_shadows.astype(int) - self.gl_shadows.astype(int))
+        self.assertTrue(diff.max() <= shadowcpu.GL_TOLERANCE)
+
+    def engines(self):
+        if shadowproc.app is None:
+            return ["cpu"]
+        return ["cpu", "gl"]
+
+    def test_batch(self):
+        for engine in self.engines():
+            tiled_shadows = shadowproc.procShadowsBatch(self.tiled_data, self.light_positions,
+                                                        dataShape=self.data_shape,
+                                                        engine=engine,
+                                                        processes=1)
+
+            self.assertEqual(tiled_shadows.shape, (2,) + self.tiled_data.shape)
+            for shadows, light in zip(tiled_shadows, self.light_positions):
+                assert_array_equal(shadows, shadowproc.procShadows(self.tiled_data,
+                                                                   dataShape=self.data_shape,
+                                                                   lightPosition=light,
+                                                                   engine=engine,
+                                                                   processes=1))
+
+    def test_skip_empty(self):
+        for engine in self.engines():
+            tiled_shadows = shadowproc.procShadowsBatch(self.tiled_data, self.light_positions,
+                                                        dataShape=self.data_shape,
+                                                        engine=engine,
+                                                        processes=1,
+                                                        skipEmpty=False)
+            skipped_shadows = shadowproc.procShadowsBatch(self.tiled_data, self.light_positions,
+                                                          dataShape=self.data_shape,
+                                                          engine=engine,
+                                                          processes=1)
+
+            assert_array_equal(tiled_shadows, skipped_shadows)
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        metrics.drain()
+        metrics.setLabels(profile="test")
+
+    def test_merge(self):
+        metrics.record("stage", 1.0, nbytes=10)
+        snapshot = metrics.drain()
+        metrics.record("stage", 2.0, nbytes=5)
+        metrics.merge(snapshot)
+
+        counters = metrics.drain()[("stage", (("profile", "test"),))]
+        self.assertEqual(counters["calls"], 2)
+        self.assertEqual(counters["seconds"], 3.0)
+        self.assertEqual(counters["max_seconds"], 2.0)
+        self.assertEqual(counters["bytes"], 15)
+
+    def test_rss_growth(self):
+        # the peak of the process before and after each call
+        peaks = iter([100, 150, 150, 170])
+        maxRss = metrics.maxRss
+        metrics.maxRss = lambda: next(peaks)
+        try:
+            metrics.timed("stage")(lambda: None)()
+            metrics.timed("stage")(lambda: None)()
+        finally:
+            metrics.maxRss = maxRss
+
+        counters = metrics.drain()[("stage", (("profile", "test"),))]
+        self.assertEqual(counters["max_rss_growth_bytes"], 50)
+
+    def test_prometheus(self):
+        metrics.timed("stage")(lambda: None)()
+        metrics.setGauge("queue_depth", 3)
+        text = metrics.prometheusText()
+
+        self.assertIn('imageservice_stage_calls_total{stage="stage",profile="test"} 1', text)
+        self.assertIn('imageservice_queue_depth{profile="test"} 3', text)
+
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get(self):
+        cache = resultcache.ResultCache(self.path, max_bytes=100, max_entries=10)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", b"image")
+
+        self.assertEqual(cache.get("a"), b"image")
+
+    def test_keys_only(self):
+        cache = resultcache.ResultCache(self.path, max_bytes=100, max_entries=10,
+                                        keep_images=False)
+        cache.put("a", b"image")
+
+        self.assertTrue(cache.contains("a"))
+        self.assertIsNone(cache.get("a"))
+
+    def test_evict(self):
+        cache = resultcache.ResultCache(self.path, max_bytes=35, max_entries=10)
+        for i, key in enumerate("abc"):
+            cache.put(key, b"0123456789")
+            # order the entries by use, whatever the file system's time resolution
+            os.utime(os.path.join(self.path, key + ".result"), (i, i))
+        cache.get("a")
+        cache.put("d", b"0123456789")
+
+        self.assertEqual([cache.contains(key) for key in "abcd"], [True, False, True, True])
+
+    def test_info(self):
+        cache = resultcache.ResultCache(self.path, max_bytes=15, max_entries=10)
+        cache.put("a", b"0123456789", {"texture_layout": "{}"})
+        self.assertEqual(cache.getInfo("a"), {"texture_layout": "{}"})
+        cache.put("b", b"0123456789")
+
+        self.assertFalse(cache.contains("a"))
+        self.assertEqual(cache.getInfo("a"), {})
+
+    def test_scan_puts(self):
+        cache = resultcache.ResultCache(self.path, max_bytes=100, max_entries=10, scan_puts=3)
+        scans = []
+        evict = cache.evict
+        cache.evict = lambda: scans.append(cache.puts) or evict()
+        for key in "abcdefg":
+            cache.put(key, b"0")
+
+        # the first put, then every third
+        self.assertEqual(scans, [0, 3, 3])
+        self.assertEqual((cache.entries, cache.total), (7, 7))
+
+
+class VolumeStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.profile = ap.Namespace(**conf.profiles["default"])
+        self.store = volumestore.VolumeStore(self.path)
+        self.volumes = self.store.slice("default", "run", "time",
+                                        volumestore.stageSettings(self.profile))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_load(self):
+        tiled = np.arange(24, dtype=np.uint8).reshape(2, 4, 3)
+        self.assertIsNone(self.volumes.load("tiled"))
+        self.volumes.save("tiled", tiled)
+
+        assert_array_equal(self.volumes.load("tiled"), tiled)
+        self.assertIsInstance(self.volumes.load("tiled"), np.memmap)
+        other = ap.Namespace(**dict(vars(self.profile), field_width=4096))
+        self.assertIsNone(self.store.slices("default", "run", other)[0].load("tiled"))
+
+    def test_input(self):
+        tiled = np.zeros([2, 4, 3], dtype=np.uint8)
+        volumes = self.store.slice("default", "run", "time",
+                                   volumestore.stageSettings(self.profile, input_key="a"))
+        volumes.save("tiled", tiled)
+        republished = self.store.slice("default", "run", "time",
+                                       volumestore.stageSettings(self.profile, input_key="b"))
+
+        self.assertIsNone(republished.load("tiled"))
+        # reruns use the stored volumes, whatever their input
+        assert_array_equal(self.store.slices("default", "run", self.profile)[0].load("tiled"), tiled)
+
+    def test_layout(self):
+        volume = np.random.RandomState(0).randint(0, 256, (10, 12, 5)).astype(np.uint8)
+        layout = imageproc.textureLayout(volume.shape, 64, 64)
+        tiled = imageproc.tileArray(volume, 64, 64)
+        self.volumes.save("tiled", tiled, layout)
+
+        self.assertEqual(self.volumes.loadLayout()["dataShape"], [12, 14, 5])
+        # the shadows are rendered with the layout the volume was tiled with
+        shadows = shadowproc.procShadows(tiled, dataShape=layout["dataShape"],
+                                         engine="cpu", processes=1)
+        assert_array_equal(serveupimage.volumesToImage(self.volumes, "cpu", 1),
+                           np.concatenate([tiled, shadows], 1))
+
+    def test_later_stages(self):
+        self.volumes.save("shadows", np.zeros([1, 2, 4, 3], dtype=np.uint8))
+        self.volumes.save("tiled", np.zeros([2, 4, 3], dtype=np.uint8))
+
+        self.assertIsNone(self.volumes.load("shadows"))
+
+    def test_image(self):
+        tiled = np.ones([2, 4, 3], dtype=np.uint8)
+        shadows = np.zeros([2, 2, 4, 3], dtype=np.uint8)
+        self.assertIsNone(serveupimage.volumesToImage(self.volumes))
+        self.volumes.save("tiled", tiled)
+        self.volumes.save("shadows", shadows)
+
+        assert_array_equal(serveupimage.volumesToImage(self.volumes),
+                           np.concatenate([tiled, shadows[0], shadows[1]], 1))
+
+
+class FileIntakeTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file = os.path.join(self.path, "test.nc")
+        with open(self.file, "wb") as f:
+            f.write(b"CDF\x01")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_settle(self):
+        files = intake.FileIntake(None, settle=3)
+        self.assertTrue(files.add(self.file))
+        self.assertFalse(files.add(self.file))
+        start = time.time()
+
+        self.assertEqual(files.check(start + 1), ([], []))
+        with open(self.file, "ab") as f:
+            f.write(b"more")
+        self.assertEqual(files.check(start + 2), ([], []))
+        self.assertEqual(files.check(start + 4), ([], []))
+        self.assertEqual(files.check(start + 5), ([self.file], []))
+        # unchanged files are only handed on once
+        self.assertFalse(files.add(self.file))
+
+    def test_header(self):
+        with open(self.file, "wb") as f:
+            f.write(b"partial")
+        files = intake.FileIntake(None, settle=1)
+        files.add(self.file)
+        start = time.time()
+
+        self.assertEqual(files.check(start + 2), ([], []))
+        self.assertEqual(files.check(start + 11), ([], [self.file]))
+        self.assertEqual(files.qsize(), 0)
+
+
+class JobQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.jobs = jobqueue.JobQueue(os.path.join(self.path, "jobs.sqlite"), max_attempts=2)
+
+    def tearDown(self):
+        self.jobs.close()
+        shutil.rmtree(self.path)
+
+    def test_claim(self):
+        self.assertTrue(self.jobs.enqueue("a.nc", "default", "1"))
+        self.assertFalse(self.jobs.enqueue("a.nc", "default", "1"))
+        job = self.jobs.claim("node1", lease=60)
+
+        self.assertEqual((job.path, job.profile, job.attempts), ("a.nc", "default", 1))
+        self.assertIsNone(self.jobs.claim("node2", lease=60))
+        self.assertTrue(self.jobs.heartbeat(job, "node1", lease=60))
+        self.assertTrue(self.jobs.complete(job, "node1"))
+        self.assertEqual(self.jobs.counts(), {"done": 1})
+
+    def test_expired_lease(self):
+        self.jobs.enqueue("a.nc", "default")
+        job = self.jobs.claim("node1", lease=-1)
+        retry = self.jobs.claim("node2", lease=-1)
+
+        self.assertEqual((retry.id, retry.attempts), (job.id, 2))
+        self.assertFalse(self.jobs.complete(job, "node1"))
+        # out of attempts
+        self.assertIsNone(self.jobs.claim("node3"))
+        self.assertEqual(self.jobs.counts(), {"failed": 1})
+
+    def test_work(self):
+        for name in "abc":
+            self.jobs.enqueue(name + ".nc", "default")
+        done = []
+        jobqueue.work(self.jobs.path, lambda path, profile: done.append(path), once=True)
+
+        self.assertEqual(done, ["a.nc", "b.nc", "c.nc"])
+        self.assertEqual(self.jobs.counts(), {"done": 3})
+
+
+class StandInDataService(BaseHTTPRequestHandler):
+    """
+    Accepts posts with a 201, after failing the first
+    `failures` posts with a 503.
+
+    """
+    failures = 0
+    posts = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        StandInDataService.posts.append(body)
+        if len(StandInDataService.posts) <= StandInDataService.failures:
+            self.send_response(503)
+        else:
+            self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class UploadClientTests(unittest.TestCase):
+    def setUp(self):
+        StandInDataService.failures = 0
+        StandInDataService.posts = []
+        self.server = HTTPServer(("127.0.0.1", 0), StandInDataService)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = networking.UploadClient(url="http://127.0.0.1:%s/" % self.server.server_port,
+                                              concurrency=2, timeout=5, retries=2, backoff=0.01)
+        self.payload = {"forecast_time": "2015-01-01T00:00:00.000Z", "mime_type": "image/png"}
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_post(self):
+        for i in range(4):
+            self.client.submit(b"image%d" % i, self.payload)
+        self.client.join()
+
+        summary = self.client.summary()
+        self.assertEqual(summary["posts"], 4)
+        self.assertEqual(summary["failed"], 0)
+        self.assertEqual(summary["bytes"], 24)
+        self.assertEqual(len(StandInDataService.posts), 4)
+
+    def test_ordered(self):
+        # one upload thread, as processFile uses with ordered_posts
+        client = networking.UploadClient(url=self.client.url, concurrency=1)
+        try:
+            for i in range(6):
+                client.submit(b"image%d" % i, self.payload)
+            client.join()
+        finally:
+            client.close()
+
+        for i, post in enumerate(StandInDataService.posts):
+            self.assertTrue(b"image%d" % i in post)
+
+    def test_retry(self):
+        StandInDataService.failures = 2
+        self.client.post(b"image", self.payload)
+
+        summary = self.client.summary()
+        self.assertEqual(summary["retries"], 2)
+        self.assertEqual(len(StandInDataService.posts), 3)
+
+    def test_retries_exhausted(self):
+        StandInDataService.failures = 3
+        self.assertRaises(IOError, self.client.post, b"image", self.payload)
+        self.assertEqual(self.client.summary()["failed"], 1)
+
+
 class IntegrationTest(unittest.TestCase):
 
     def test_integration(self):